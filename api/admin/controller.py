@@ -89,6 +89,7 @@ from password_admin_authentication_provider import PasswordAdminAuthenticationPr
 
 from api.controller import CirculationManagerController
 from api.coverage import MetadataWranglerCollectionRegistrar
+from api.monitor import DashboardStatsMonitor
 from core.app_server import entry_response
 from core.app_server import (
     entry_response,
@@ -1693,119 +1694,15 @@ class LanesController(AdminCirculationManagerController):
 class DashboardController(AdminCirculationManagerController):
 
     def stats(self):
-        patron_count = self._db.query(Patron).count()
-
-        active_loans_patron_count = self._db.query(
-            distinct(Patron.id)
-        ).join(
-            Patron.loans
-        ).filter(
-            Loan.end >= datetime.now(),
-        ).count()
-
-        active_patrons = select(
-            [Patron.id]
-        ).select_from(
-            join(
-                Loan,
-                Patron,
-                and_(
-                    Patron.id == Loan.patron_id,
-                    Loan.id != None,
-                    Loan.end >= datetime.now()
-                )
-            )
-        ).union(
-            select(
-                [Patron.id]
-            ).select_from(
-                join(
-                    Hold,
-                    Patron,
-                    Patron.id == Hold.patron_id
-                )
-            )
-        ).alias()
-
-
-        active_loans_or_holds_patron_count_query = select(
-            [func.count(distinct(active_patrons.c.id))]
-        ).select_from(
-            active_patrons
-        )
-
-        result = self._db.execute(active_loans_or_holds_patron_count_query)
-        active_loans_or_holds_patron_count = [r[0] for r in result][0]
-
-        loan_count = self._db.query(
-            Loan
-        ).filter(
-            Loan.end >= datetime.now()
-        ).count()
-
-        hold_count = self._db.query(Hold).count()
-
-        data_sources = dict(
-            overdrive=DataSource.OVERDRIVE,
-            bibliotheca=DataSource.BIBLIOTHECA,
-            axis360=DataSource.AXIS_360,
-        )
-        vendor_counts = dict()
-
-        for key, data_source in data_sources.iteritems():
-            data_source_count = self._db.query(
-                LicensePool
-            ).join(
-                DataSource
-            ).filter(
-                LicensePool.licenses_owned > 0
-            ).filter(
-                DataSource.name == data_source
-            ).count()
-
-            if data_source_count > 0:
-                vendor_counts[key] = data_source_count
-
-        open_access_count = self._db.query(
-            LicensePool
-         ).filter(
-            LicensePool.open_access == True
-         ).count()
-
-        if open_access_count > 0:
-            vendor_counts['open_access'] = open_access_count
-
-        title_count = self._db.query(LicensePool).count()
-
-        # The sum queries return None instead of 0 if there are
-        # no license pools in the db.
-
-        license_count = self._db.query(
-            func.sum(LicensePool.licenses_owned)
-        ).filter(
-            LicensePool.open_access == False,
-        ).all()[0][0] or 0
-
-        available_license_count = self._db.query(
-            func.sum(LicensePool.licenses_available)
-        ).filter(
-            LicensePool.open_access == False,
-        ).all()[0][0] or 0
-
+        stats = DashboardStatsMonitor.stored(self._db)
+        if not stats:
+            # The monitor hasn't run yet, so the statistics have to be
+            # calculated on the spot.
+            stats = DashboardStatsMonitor.calculate(self._db)
         return dict(
-            patrons=dict(
-                total=patron_count,
-                with_active_loans=active_loans_patron_count,
-                with_active_loans_or_holds=active_loans_or_holds_patron_count,
-                loans=loan_count,
-                holds=hold_count,
-            ),
-            inventory=dict(
-                titles=title_count,
-                licenses=license_count,
-                available_licenses=available_license_count,
-            ),
-            vendors=vendor_counts,
+            patrons=stats['patrons'],
+            inventory=stats['inventory'],
+            vendors=stats['vendors'],
         )
 
     def circulation_events(self):
@@ -40,11 +40,15 @@ class AdobeVendorIDController(object):
     """Flask controllers that implement the Account Service and
     Authorization Service portions of the Adobe Vendor ID protocol.
     """
-    def __init__(self, _db, library, vendor_id, node_value, authenticator):
+    def __init__(self, _db, library, vendor_id, node_value, authenticator,
+                 authdata_utilities=None):
         self._db = _db
         self.library = library
         self.request_handler = AdobeVendorIDRequestHandler(vendor_id)
-        self.model = AdobeVendorIDModel(_db, library, authenticator, node_value)
+        self.model = AdobeVendorIDModel(
+            _db, library, authenticator, node_value,
+            authdata_utilities=authdata_utilities
+        )
 
     def create_authdata_handler(self, patron):
         """Create an authdata token for the given patron.
@@ -339,8 +343,14 @@ class AdobeVendorIDModel(object):
     VENDOR_ID_UUID_TOKEN_TYPE = "Vendor ID UUID"
 
     def __init__(self, _db, library, authenticator, node_value,
-                 temporary_token_duration=None):
+                 temporary_token_duration=None, authdata_utilities=None):
+        """Constructor.
+
+        :param authdata_utilities: A dictionary mapping library IDs
+        to preloaded AuthdataUtility objects.
+        """
         self.library = library
+        self.authdata_utilities = authdata_utilities
         self._db = _db
         self.authenticator = authenticator
         self.temporary_token_duration = (
@@ -399,7 +409,9 @@ class AdobeVendorIDModel(object):
 
         # Look up or create a DelegatedPatronIdentifier using the 
         # anonymized patron identifier we just looked up or created.
-        utility = AuthdataUtility.from_config(patron.library, self._db)
+        utility = AuthdataUtility.for_library(
+            patron.library, self.authdata_utilities, self._db
+        )
         return self.to_delegated_patron_identifier_uuid(
             utility.library_uri, adobe_account_id_patron_identifier_credential.credential,
             value_generator=new_value
@@ -459,7 +471,9 @@ class AdobeVendorIDModel(object):
             return None, None
         
         library_uri = foreign_patron_identifier = None
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = AuthdataUtility.for_library(
+            self.library, self.authdata_utilities, self._db
+        )
         if utility:
             # Hopefully this is an authdata JWT generated by another
             # library's circulation manager.
@@ -495,7 +509,9 @@ class AdobeVendorIDModel(object):
 
     def short_client_token_lookup(self, token, signature):
         """Validate a short client token that came in as username/password."""
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = AuthdataUtility.for_library(
+            self.library, self.authdata_utilities, self._db
+        )
         library_uri = foreign_patron_identifier = None
         if utility:
             # Hopefully this is a short client token generated by
@@ -747,6 +763,20 @@ class AuthdataUtility(object):
             )
         return cls(vendor_id, library_uri, library_short_name, secret,
                    other_libraries)
+
+    @classmethod
+    def for_library(cls, library, authdata_utilities=None, _db=None):
+        """Find the AuthdataUtility for a library.
+
+        :param authdata_utilities: A dictionary mapping library IDs
+        to AuthdataUtility objects (or None, for libraries that don't
+        have one), as kept by the CirculationManager. If the library
+        isn't mentioned, its AuthdataUtility is loaded from site
+        configuration.
+        """
+        if authdata_utilities is not None and library.id in authdata_utilities:
+            return authdata_utilities[library.id]
+        return cls.from_config(library, _db)
         
     def encode(self, patron_identifier):
         """Generate an authdata JWT suitable for putting in an OPDS feed, where
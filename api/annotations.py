@@ -1,9 +1,17 @@
 from nose.tools import set_trace
 from pyld import jsonld
+import calendar
 import json
+from copy import deepcopy
 from datetime import datetime
 import os
 
+from sqlalchemy import (
+    case,
+    func,
+)
+from sqlalchemy.orm.session import Session
+
 from core.model import (
     Annotation,
     Identifier,
@@ -46,52 +54,154 @@ class AnnotationWriter(object):
     JSONLD_CONTEXT = "http://www.w3.org/ns/anno.jsonld"
     LDP_CONTEXT = "http://www.w3.org/ns/ldp.jsonld"
 
+    # A client can't ask for more than this many annotations at once.
+    MAX_PAGE_SIZE = 500
+
+    # Compacting JSON-LD is slow, so the compacted form of each
+    # annotation target and body is kept here, keyed by the JSON
+    # stored in the database.
+    MAX_COMPACTED_CACHE_SIZE = 10000
+    compacted_cache = {}
+
     @classmethod
-    def annotations_for(cls, patron, identifier=None):
-        annotations = [annotation for annotation in patron.annotations if annotation.active]
+    def _annotations(cls, patron, identifier=None, active=True):
+        _db = Session.object_session(patron)
+        qu = _db.query(Annotation).filter(
+            Annotation.patron_id==patron.id
+        )
+        if active is not None:
+            qu = qu.filter(Annotation.active==active)
         if identifier:
-            annotations = [annotation for annotation in annotations if annotation.identifier == identifier]
-        return annotations
+            qu = qu.filter(Annotation.identifier_id==identifier.id)
+        return qu
+
+    @classmethod
+    def annotations_for(cls, patron, identifier=None, after=None, size=None,
+                        since=None, active=True):
+        """Find a patron's active annotations, most recently created
+        first.
+
+        :param after: Only find annotations that come after the
+          annotation with this ID.
+
+        :param size: Find at most this many annotations.
+
+        :param since: Only find annotations that were created or
+          modified after this time.
+
+        :param active: Set this to False to find annotations that have
+          been deleted instead.
+        """
+        qu = cls._annotations(patron, identifier, active=active)
+        if since:
+            qu = qu.filter(Annotation.timestamp > since)
+        if after:
+            qu = qu.filter(Annotation.id < after)
+        qu = qu.order_by(Annotation.id.desc())
+        if size:
+            qu = qu.limit(size)
+        return qu.all()
 
     @classmethod
-    def annotation_container_for(cls, patron, identifier=None):
+    def container_version(cls, patron, identifier=None):
+        """Find out enough about a patron's annotations to tell whether
+        they've changed, without loading any of them.
+
+        :return: A 3-tuple (number of active annotations, latest
+          timestamp of an active annotation, latest timestamp of any
+          annotation, including deleted ones).
+        """
+        active = Annotation.active==True
+        return cls._annotations(patron, identifier, active=None).with_entities(
+            func.count(case([(active, Annotation.id)])),
+            func.max(case([(active, Annotation.timestamp)])),
+            func.max(Annotation.timestamp),
+        ).one()
+
+    @classmethod
+    def etag(cls, total, latest_change):
+        """Create a weak ETag for an annotation container."""
+        return 'W/"%s"' % cls.etag_value(total, latest_change)
+
+    @classmethod
+    def etag_value(cls, total, latest_change):
+        """The opaque part of the container's ETag, as it will be
+        compared against an If-None-Match header.
+        """
+        if not total and not latest_change:
+            return ""
+        return "%s/%s" % (
+            latest_change and latest_change.isoformat() or "", total
+        )
+
+    @classmethod
+    def last_modified(cls, latest_change):
+        """Convert the latest (UTC) annotation timestamp into seconds
+        since the epoch, the precision of a Last-Modified header.
+        """
+        return calendar.timegm(latest_change.utctimetuple())
+
+    @classmethod
+    def _url(cls, patron, identifier=None, **kwargs):
         if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
+            return url_for('annotations_for_work',
+                           identifier_type=identifier.type,
+                           identifier=identifier.identifier,
+                           library_short_name=patron.library.short_name,
+                           _external=True, **kwargs)
+        return url_for("annotations", library_short_name=patron.library.short_name,
+                       _external=True, **kwargs)
 
-        latest_timestamp = None
-        if len(annotations) > 0:
-            # patron.annotations is already sorted by timestamp, so the first
-            # annotation is the most recent.
-            latest_timestamp = annotations[0].timestamp
+    @classmethod
+    def annotation_container_for(cls, patron, identifier=None, size=None,
+                                 since=None):
+        url = cls._url(patron, identifier)
+
+        # Count the annotations and find the latest timestamp in the
+        # database, rather than loading every annotation.
+        total, latest_timestamp, ignore = cls.container_version(
+            patron, identifier
+        )
 
         container = dict()
         container["@context"] = [cls.JSONLD_CONTEXT, cls.LDP_CONTEXT]
         container["id"] = url
         container["type"] = ["BasicContainer", "AnnotationCollection"]
-        container["total"] = len(annotations)
-        container["first"] = cls.annotation_page_for(patron, identifier=identifier, with_context=False)
+        container["total"] = total
+        container["first"] = cls.annotation_page_for(
+            patron, identifier=identifier, with_context=False, size=size,
+            since=since
+        )
         return container, latest_timestamp
-        
 
     @classmethod
-    def annotation_page_for(cls, patron, identifier=None, with_context=True):
-        if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
-        details = [cls.detail(annotation, with_context=with_context) for annotation in annotations]
+    def annotation_page_for(cls, patron, identifier=None, with_context=True,
+                            after=None, size=None, since=None):
+        """Create an AnnotationPage.
+
+        :param after: The page starts after the annotation with this ID.
+
+        :param size: The maximum number of annotations on the page. If
+          there might be more, the page links to the next page.
+
+        :param since: Only include annotations created or modified
+          after this time. The page also lists the IDs of annotations
+          deleted after this time, under "deleted".
+        """
+        since_arg = since and since.isoformat() or None
+        url = cls._url(
+            patron, identifier, after=after, size=size, since=since_arg
+        )
+        annotations = cls.annotations_for(
+            patron, identifier=identifier, after=after, size=size,
+            since=since
+        )
+        library_short_name = patron.library.short_name
+        details = [
+            cls.detail(annotation, with_context=with_context,
+                       library_short_name=library_short_name)
+            for annotation in annotations
+        ]
 
         page = dict()
         if with_context:
@@ -99,29 +209,64 @@ class AnnotationWriter(object):
         page["id"] = url
         page["type"] = "AnnotationPage"
         page["items"] = details
+        if since and not after:
+            # Clients that are catching up also need to know which
+            # annotations have gone away.
+            deleted = cls.annotations_for(
+                patron, identifier=identifier, since=since, active=False
+            )
+            page["deleted"] = [
+                cls.annotation_url(annotation, library_short_name)
+                for annotation in deleted
+            ]
+        if size and len(annotations) == size:
+            page["next"] = cls._url(
+                patron, identifier, after=annotations[-1].id, size=size,
+                since=since_arg
+            )
         return page
 
     @classmethod
-    def detail(cls, annotation, with_context=True):
+    def annotation_url(cls, annotation, library_short_name=None):
+        library_short_name = (
+            library_short_name or annotation.patron.library.short_name
+        )
+        return url_for("annotation_detail", annotation_id=annotation.id,
+                       library_short_name=library_short_name,
+                       _external=True)
+
+    @classmethod
+    def compact(cls, data):
+        """Compact a JSON-LD document stored in the database.
+
+        :param data: A JSON string.
+        :return: A dictionary, without its @context.
+        """
+        compacted = cls.compacted_cache.get(data)
+        if compacted is None:
+            compacted = jsonld.compact(json.loads(data), cls.JSONLD_CONTEXT)
+            del compacted["@context"]
+            if len(cls.compacted_cache) >= cls.MAX_COMPACTED_CACHE_SIZE:
+                cls.compacted_cache.clear()
+            cls.compacted_cache[data] = compacted
+        # The caller might modify what we give them.
+        return deepcopy(compacted)
+
+    @classmethod
+    def detail(cls, annotation, with_context=True, library_short_name=None):
         item = dict()
         if with_context:
             item["@context"] = cls.JSONLD_CONTEXT
-        item["id"] = url_for("annotation_detail", annotation_id=annotation.id,
-                             library_short_name=annotation.patron.library.short_name,
-                             _external=True)
+        item["id"] = cls.annotation_url(annotation, library_short_name)
         item["type"] = "Annotation"
         item["motivation"] = annotation.motivation
+        if annotation.timestamp:
+            item["modified"] = annotation.timestamp.isoformat()
         item["body"] = annotation.content
         if annotation.target:
-            target = json.loads(annotation.target)
-            compacted = jsonld.compact(target, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["target"] = compacted
+            item["target"] = cls.compact(annotation.target)
         if annotation.content:
-            body = json.loads(annotation.content)
-            compacted = jsonld.compact(body, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["body"] = compacted
+            item["body"] = cls.compact(annotation.content)
 
         return item
 
@@ -194,4 +339,10 @@ class AnnotationParser(object):
         annotation.active = True
         annotation.timestamp = datetime.now()
 
+        # Compact the annotation now, so it doesn't have to be done
+        # when the annotation is served.
+        AnnotationWriter.compact(annotation.target)
+        if annotation.content:
+            AnnotationWriter.compact(annotation.content)
+
         return annotation
@@ -33,14 +33,18 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import or_
 from problem_details import *
+from util.lazy import LazyDict
 from util.patron import PatronUtility
 from api.opds import LibraryAnnotator
 
+from collections import OrderedDict
 import datetime
+import hashlib
 import logging
 from money import Money
 import os
 import re
+from threading import Lock
 import urlparse
 import urllib
 import uuid
@@ -377,18 +381,33 @@ class Authenticator(object):
     """Route requests to the appropriate LibraryAuthenticator.
     """
 
-    def __init__(self, _db, analytics=None):
+    def __init__(self, _db, analytics=None, reuse=None):
+        """Constructor.
+
+        :param reuse: A dictionary mapping library short names to
+          LibraryAuthenticators that are still good and can be used
+          instead of creating new ones.
+        """
         self.library_authenticators = {}
 
-        self.populate_authenticators(_db, analytics)
+        self.populate_authenticators(_db, analytics, reuse)
 
     @property
     def current_library_short_name(self):
         return flask.request.library.short_name
 
-    def populate_authenticators(self, _db, analytics):
-        for library in _db.query(Library):
-            self.library_authenticators[library.short_name] = LibraryAuthenticator.from_config(_db, library, analytics)
+    def populate_authenticators(self, _db, analytics, reuse=None):
+        """Get ready to create a LibraryAuthenticator for each library.
+
+        Creating a LibraryAuthenticator may mean connecting to a
+        remote server, so a library's LibraryAuthenticator isn't
+        created until it's needed.
+        """
+        def create(short_name):
+            library = Library.lookup(_db, short_name)
+            return LibraryAuthenticator.from_config(_db, library, analytics)
+        short_names = [x for [x] in _db.query(Library.short_name)]
+        self.library_authenticators = LazyDict(create, short_names, reuse)
 
     def invoke_authenticator_method(self, method_name, *args, **kwargs):
         short_name = self.current_library_short_name
@@ -1293,6 +1312,15 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
     DEFAULT_IDENTIFIER_LABEL = u"Barcode"
     DEFAULT_PASSWORD_LABEL = u"PIN"
 
+    # Successful authentications may be remembered for a while, so
+    # that the source of truth doesn't have to be consulted on every
+    # request.
+    CREDENTIAL_CACHE_TTL = u"credential_cache_ttl"
+
+    # No more than this many sets of credentials are remembered at
+    # once; the oldest are forgotten first.
+    MAX_CACHED_CREDENTIALS = 10000
+
     # If the identifier label is one of these strings, it will be
     # automatically localized. Otherwise, the same label will be displayed
     # to everyone.
@@ -1375,6 +1403,12 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
           "label": _("Label for password entry"),
           "optional": True,
         },
+        { "key": CREDENTIAL_CACHE_TTL,
+          "label": _("Number of seconds to remember a patron's verified credentials"),
+          "description": _("If this is set, a patron who was recently authenticated with the same identifier and password will not be checked against the source of truth again until this many seconds have passed. Leave blank to check every time."),
+          "type": "number",
+          "optional": True,
+        },
     ] + AuthenticationProvider.SETTINGS
     
     # Used in the constructor to signify that the default argument
@@ -1436,6 +1470,29 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             or self.DEFAULT_PASSWORD_LABEL
         )
 
+        self.credential_cache_ttl = integration.setting(
+            self.CREDENTIAL_CACHE_TTL).int_value or 0
+
+        # Maps a salted hash of a username and password to a 2-tuple
+        # (expiration time, PatronData). Credentials are never stored
+        # in the clear, and the salt never leaves this process.
+        #
+        # Every entry lives for the same length of time, so entries
+        # are kept in the order they expire.
+        self.credential_cache = OrderedDict()
+        self.credential_cache_salt = os.urandom(16)
+
+        # Maps a username to the key under which its PatronData was
+        # most recently cached, so that the entry can be invalidated
+        # when the patron starts using a different password, and
+        # back again.
+        self.credential_cache_key_for_username = {}
+        self.credential_cache_username_for_key = {}
+
+        # The cache is shared by every request thread. All of the
+        # above are read and changed only while holding this lock.
+        self.credential_cache_lock = Lock()
+
     @property
     def collects_password(self):
         """Does this BasicAuthenticationProvider expect a username
@@ -1513,6 +1570,23 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # need to be checked with the source of truth.
             return server_side_validation_result
 
+        # If these credentials were verified recently, we may be able
+        # to avoid checking them with the source of truth.
+        patrondata = self.cached_patrondata(username, password)
+        if patrondata:
+            patron = self.local_patron_lookup(_db, username, patrondata)
+            if patron and not patron.block_reason:
+                # Reapplying the cached data doesn't count as a sync
+                # with the source of truth.
+                last_external_sync = patron.last_external_sync
+                self.apply_patrondata(patrondata, patron)
+                patron.last_external_sync = last_external_sync
+                return patron
+
+            # The cached data is no longer useful -- perhaps the
+            # patron has been blocked since it was cached.
+            self.invalidate_cached_credentials(username)
+
         # Check these credentials with the source of truth.
         patrondata = self.remote_authenticate(username, password)
         if not patrondata or isinstance(patrondata, ProblemDetail):
@@ -1537,6 +1611,7 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # We found them! Make sure their data is up to date
             # with whatever we just got from remote.
             self.apply_patrondata(patrondata, patron)
+            self.cache_patrondata(username, password, patrondata)
             return patron
         
         # We didn't find them. Now the question is: _why_ didn't the
@@ -1579,8 +1654,102 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
         # update the Patron record with the account information we
         # just got from the source of truth.
         self.apply_patrondata(patrondata, patron)
+        self.cache_patrondata(username, password, patrondata)
         return patron
 
+    def credential_cache_key(self, username, password):
+        """Turn a username and password into a salted hash suitable
+        for use as a key into the credential cache.
+        """
+        h = hashlib.sha256(self.credential_cache_salt)
+        for value in (username, password):
+            value = value or ''
+            if isinstance(value, unicode):
+                value = value.encode("utf8")
+            h.update(value)
+            h.update('\0')
+        return h.hexdigest()
+
+    def cached_patrondata(self, username, password):
+        """Find a PatronData that was cached the last time these
+        credentials were verified.
+
+        :return: A PatronData, or None if the credentials have not
+        been verified recently.
+        """
+        if not self.credential_cache_ttl:
+            return None
+        key = self.credential_cache_key(username, password)
+        with self.credential_cache_lock:
+            cached = self.credential_cache.get(key)
+            if not cached:
+                return None
+            expires, patrondata = cached
+            if expires < datetime.datetime.utcnow():
+                self._forget_cached_key(key)
+                return None
+            return patrondata
+
+    def cache_patrondata(self, username, password, patrondata):
+        """Remember that these credentials were just verified and
+        correspond to the given PatronData.
+
+        A PatronData that says the patron is blocked is never cached,
+        since it's important to find out as soon as the block is lifted.
+        """
+        if not self.credential_cache_ttl:
+            return
+        key = self.credential_cache_key(username, password)
+        cacheable = (
+            isinstance(patrondata, PatronData) and not patrondata.block_reason
+        )
+        with self.credential_cache_lock:
+            # Whatever was cached for this username before is obsolete,
+            # especially if it was cached under a different password.
+            self._forget_cached_username(username)
+            if not cacheable:
+                return
+            now = datetime.datetime.utcnow()
+            self._expire_cached_credentials(now)
+            expires = now + datetime.timedelta(
+                seconds=self.credential_cache_ttl
+            )
+            self.credential_cache[key] = (expires, patrondata)
+            self.credential_cache_key_for_username[username] = key
+            self.credential_cache_username_for_key[key] = username
+
+    def invalidate_cached_credentials(self, username):
+        """Forget any cached PatronData for the given username."""
+        with self.credential_cache_lock:
+            self._forget_cached_username(username)
+
+    def _expire_cached_credentials(self, now):
+        """Forget cached PatronData that has expired, and make room
+        for one more entry if the cache is full.
+
+        The caller must hold `credential_cache_lock`.
+        """
+        while self.credential_cache:
+            key, (expires, patrondata) = next(
+                self.credential_cache.iteritems()
+            )
+            if (expires >= now and
+                len(self.credential_cache) < self.MAX_CACHED_CREDENTIALS):
+                break
+            self._forget_cached_key(key)
+
+    def _forget_cached_username(self, username):
+        """The caller must hold `credential_cache_lock`."""
+        key = self.credential_cache_key_for_username.get(username)
+        if key:
+            self._forget_cached_key(key)
+
+    def _forget_cached_key(self, key):
+        """The caller must hold `credential_cache_lock`."""
+        self.credential_cache.pop(key, None)
+        username = self.credential_cache_username_for_key.pop(key, None)
+        self.credential_cache_key_for_username.pop(username, None)
+
     def apply_patrondata(self, patrondata, patron):
         """Apply a PatronData object to the given patron and make sure
         any fields that need to be updated as a result of new data
@@ -282,6 +282,18 @@ class Axis360CirculationMonitor(CollectionMonitor):
             Axis360BibliographicCoverageProvider(collection, api_class=self.api)
         )
 
+        # Every book is processed with the same Analytics and
+        # ReplacementPolicy, so the analytics integrations are only
+        # loaded once.
+        self.analytics = Analytics(self._db)
+        self.replacement_policy = ReplacementPolicy(
+            identifiers=False,
+            subjects=True,
+            contributions=True,
+            formats=True,
+            analytics=self.analytics,
+        )
+
     def run_once(self, start, cutoff):
         # Give us five minutes of overlap because it's very important
         # we don't miss anything.
@@ -289,32 +301,117 @@ class Axis360CirculationMonitor(CollectionMonitor):
         availability = self.api.availability(since=since)
         status_code = availability.status_code
         content = availability.content
-        count = 0
-        for bibliographic, circulation in BibliographicParser(self.collection).process_all(
+        batch = []
+        for book in BibliographicParser(self.collection).process_all(
                 content):
-            self.process_book(bibliographic, circulation)
-            count += 1
-            if count % self.batch_size == 0:
-                self._db.commit()
+            batch.append(book)
+            if len(batch) >= self.batch_size:
+                self.process_batch(batch)
+                batch = []
+        if batch:
+            self.process_batch(batch)
+
+    def process_batch(self, books):
+        """Process a number of books from the availability feed, then
+        commit.
+
+        The Identifiers, LicensePools and Editions the books already
+        have are looked up with one query each, rather than one book
+        at a time.
+
+        :param books: A list of (Metadata, CirculationData) 2-tuples.
+        """
+        collection = self.collection
+        identifiers, pools, editions = self._existing_objects(
+            collection, [bibliographic for bibliographic, ignore in books]
+        )
+        for bibliographic, availability in books:
+            key = self._key(bibliographic.primary_identifier)
+            identifier = identifiers.get(key)
+            license_pool = edition = None
+            if identifier:
+                license_pool = pools.get(identifier.id)
+                edition = editions.get(identifier.id)
+            self.process_book(
+                bibliographic, availability, license_pool=license_pool,
+                edition=edition, collection=collection
+            )
+        self._db.commit()
+
+    @classmethod
+    def _key(cls, identifier_data):
+        return (identifier_data.type, identifier_data.identifier)
 
-    def process_book(self, bibliographic, availability):
+    def _existing_objects(self, collection, bibliographics):
+        """Find the Identifiers, LicensePools and Editions that already
+        exist for a number of books.
 
-        analytics = Analytics(self._db)
-        license_pool, new_license_pool = availability.license_pool(
-            self._db, self.collection, analytics
+        :return: A 3-tuple of dictionaries. The first maps (type,
+          identifier) 2-tuples to Identifiers; the others map
+          Identifier IDs to LicensePools and Editions.
+        """
+        by_type = dict()
+        for bibliographic in bibliographics:
+            type, identifier = self._key(bibliographic.primary_identifier)
+            by_type.setdefault(type, []).append(identifier)
+
+        identifiers = dict()
+        for type, values in by_type.items():
+            qu = self._db.query(Identifier).filter(
+                Identifier.type==type
+            ).filter(
+                Identifier.identifier.in_(values)
+            )
+            for identifier in qu:
+                identifiers[(identifier.type, identifier.identifier)] = identifier
+        if not identifiers:
+            return identifiers, {}, {}
+        identifier_ids = [identifier.id for identifier in identifiers.values()]
+
+        pools = dict(
+            (pool.identifier_id, pool)
+            for pool in self._db.query(LicensePool).filter(
+                LicensePool.collection_id==collection.id
+            ).filter(
+                LicensePool.identifier_id.in_(identifier_ids)
+            )
         )
-        edition, new_edition = bibliographic.edition(self._db)
-        license_pool.edition = edition
-        policy = ReplacementPolicy(
-            identifiers=False,
-            subjects=True,
-            contributions=True,
-            formats=True,
-            analytics=analytics,
+
+        data_source = DataSource.lookup(self._db, DataSource.AXIS_360)
+        editions = dict(
+            (edition.primary_identifier_id, edition)
+            for edition in self._db.query(Edition).filter(
+                Edition.data_source==data_source
+            ).filter(
+                Edition.primary_identifier_id.in_(identifier_ids)
+            )
         )
-        availability.apply(self._db, self.collection, replace=policy)
+        return identifiers, pools, editions
+
+    def process_book(self, bibliographic, availability, license_pool=None,
+                     edition=None, collection=None):
+        """Update a book's LicensePool and Edition.
+
+        :param license_pool: The book's LicensePool, if it's already
+          been looked up.
+
+        :param edition: The book's Edition, if it's already been
+          looked up.
+        """
+        collection = collection or self.collection
+        analytics = self.analytics
+        new_license_pool = new_edition = False
+        if not license_pool:
+            license_pool, new_license_pool = availability.license_pool(
+                self._db, collection, analytics
+            )
+        if not edition:
+            edition, new_edition = bibliographic.edition(self._db)
+        license_pool.edition = edition
+        policy = self.replacement_policy
+        availability.apply(self._db, collection, replace=policy)
         if new_edition:
-            bibliographic.apply(edition, self.collection, replace=policy)
+            bibliographic.apply(edition, collection, replace=policy)
 
         if new_license_pool or new_edition:
             # At this point we have done work equivalent to that done by 
@@ -88,14 +88,33 @@ class BaseCirculationManagerController(object):
         Since this is called on pretty much every request, it's also
         an appropriate time to check whether the site configuration
         has been changed and needs to be updated.
+
+        The library is found through the CirculationManager's
+        configuration snapshot, without going to the database. A
+        library that's not in the snapshot (because it was created or
+        renamed since the snapshot was taken) is looked up in the
+        database.
         """
         self.manager.reload_settings_if_changed()
-        
-        if library_short_name:
-            library = Library.lookup(self._db, short_name=library_short_name)
-        else:
-            library = Library.default(self._db)
-        
+
+        library = None
+        configuration = getattr(self.manager, 'configuration', None)
+        if configuration:
+            library_id = configuration.library_id(library_short_name)
+            if library_id is not None:
+                library = configuration.library(self._db, library_id)
+            if library and library_short_name and (
+                library.short_name != library_short_name
+            ):
+                library = None
+        if not library:
+            if library_short_name:
+                library = Library.lookup(
+                    self._db, short_name=library_short_name
+                )
+            else:
+                library = Library.default(self._db)
+
         if not library:
             return LIBRARY_NOT_FOUND
         flask.request.library = library
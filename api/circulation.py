@@ -1,13 +1,22 @@
 from nose.tools import set_trace
 from circulation_exceptions import *
+import bisect
 import datetime
 from collections import defaultdict
-from threading import Thread
+from threading import (
+    Lock,
+    Thread,
+)
 import flask
 import logging
+import Queue
 import re
 import time
 from flask_babel import lazy_gettext as _
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+)
 
 from core.config import CannotLoadConfiguration
 from core.cdn import cdnify
@@ -278,13 +287,242 @@ class HoldInfo(CirculationInfo):
         )
 
 
+class PatronActivityTask(object):
+    """Ask one circulation API about a patron's loans and holds."""
+
+    def __init__(self, api, patron, pin, results, collection_id=None):
+        """Constructor.
+
+        :param results: A Queue.Queue. Once this task has run, it will
+        put itself into this queue.
+
+        :param collection_id: The ID of the Collection whose API is
+        being asked.
+        """
+        self.api = api
+        self.patron = patron
+        self.pin = pin
+        self.results = results
+        self.collection_id = collection_id
+        self.activity = None
+        self.exception = None
+        self.elapsed = None
+
+        # Set by the PatronActivityExecutor when a worker thread picks
+        # up this task, or when the task is given up on before then.
+        self.started = None
+        self.abandoned = False
+
+    @property
+    def vendor(self):
+        return self.api.__class__.__name__
+
+    @property
+    def key(self):
+        """Tasks with the same key count against the same limit on
+        running requests.
+        """
+        return (self.vendor, self.collection_id)
+
+    def run(self):
+        before = time.time()
+        try:
+            self.activity = self.api.patron_activity(self.patron, self.pin)
+        except Exception, e:
+            self.exception = e
+        self.elapsed = time.time() - before
+        self.results.put(self)
+
+
+class PatronActivityExecutor(object):
+    """A long-lived pool of worker threads that run PatronActivityTasks.
+
+    This also keeps track of how long each vendor takes to respond.
+    """
+
+    DEFAULT_WORKERS = 10
+
+    # By default, a patron's bookshelf sync will not wait more than
+    # this many seconds for any vendor to respond.
+    DEFAULT_TIMEOUT = 20
+
+    # By default, requests to a single collection can occupy no more
+    # than this share of the worker threads, so that a vendor that
+    # stops responding can't tie up every one of them.
+    DEFAULT_SHARE_PER_COLLECTION = 0.5
+
+    # The upper bounds, in seconds, of the buckets in the latency
+    # histograms. There's an implicit final bucket for anything slower.
+    LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 5, 10, 20, 60]
+
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 vendor_timeouts=None, max_tasks_per_collection=None,
+                 session=None):
+        """Constructor.
+
+        :param workers: The number of worker threads.
+
+        :param timeout: The number of seconds to wait for a vendor to
+        respond once a worker thread has started asking it. A vendor
+        that takes longer than this is treated as having failed. If
+        this is None, wait indefinitely.
+
+        :param vendor_timeouts: A dictionary mapping vendor names to
+        timeouts that should be used instead of `timeout`.
+
+        :param max_tasks_per_collection: The number of requests to a
+        single collection's API that can be running at once. If this
+        is None, it's derived from `workers` and
+        DEFAULT_SHARE_PER_COLLECTION.
+
+        :param session: A scoped database session. Each worker thread
+        removes its session after every task, so a vendor's API
+        doesn't leave connections checked out.
+        """
+        self.log = logging.getLogger("Patron activity executor")
+        self.workers = workers
+        self.timeout = timeout
+        self.vendor_timeouts = vendor_timeouts or {}
+        if max_tasks_per_collection is None:
+            max_tasks_per_collection = max(
+                int(workers * self.DEFAULT_SHARE_PER_COLLECTION), 1
+            )
+        self.max_tasks_per_collection = max_tasks_per_collection
+        self.session = session
+        self.tasks = Queue.Queue()
+        self.threads = []
+
+        # `lock` controls access to the threads, the state of each
+        # task, and the statistics.
+        self.lock = Lock()
+        self.running = defaultdict(int)
+        self.latency = defaultdict(lambda: [0] * (len(self.LATENCY_BUCKETS)+1))
+        self.timeouts = defaultdict(int)
+        self.rejections = defaultdict(int)
+
+    def timeout_for(self, vendor):
+        """How long to wait for the given vendor to respond."""
+        return self.vendor_timeouts.get(vendor, self.timeout)
+
+    def submit(self, task):
+        """Queue a PatronActivityTask to be run by a worker thread.
+
+        :return: True if the task was queued; False if too many
+        requests to its collection's API are already running.
+        """
+        with self.lock:
+            if not self.threads:
+                for i in range(self.workers):
+                    thread = Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            if self.running[task.key] >= self.max_tasks_per_collection:
+                self.rejections[task.vendor] += 1
+                return False
+        self.tasks.put(task)
+        return True
+
+    def deadline(self, task, submitted):
+        """When should we stop waiting for the given task?
+
+        A task's timeout starts when a worker thread picks it up. A
+        task that's still waiting for a worker is given up on once it
+        has waited as long as its timeout.
+
+        :param submitted: The time at which the task was submitted.
+        :return: A time, or None to wait indefinitely.
+        """
+        timeout = self.timeout_for(task.vendor)
+        if timeout is None:
+            return None
+        with self.lock:
+            return (task.started or submitted) + timeout
+
+    def abandon_if_expired(self, task, submitted, now):
+        """Stop waiting for the given task if its deadline has passed.
+
+        A task that's abandoned before a worker thread picks it up
+        will never be run.
+
+        :return: True if the task was abandoned.
+        """
+        timeout = self.timeout_for(task.vendor)
+        if timeout is None:
+            return False
+        with self.lock:
+            if (task.started or submitted) + timeout > now:
+                return False
+            task.abandoned = True
+            if task.started is None:
+                self.rejections[task.vendor] += 1
+            else:
+                self.timeouts[task.vendor] += 1
+            return True
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                # We're shutting down.
+                return
+            with self.lock:
+                if task.abandoned:
+                    # Nobody is waiting for this task anymore.
+                    continue
+                task.started = time.time()
+                self.running[task.key] += 1
+            try:
+                task.run()
+            finally:
+                with self.lock:
+                    self.running[task.key] -= 1
+                if self.session is not None:
+                    self.session.remove()
+            self.record_latency(task.vendor, task.elapsed)
+
+    def shutdown(self):
+        """Stop all the worker threads once they're finished with their
+        current tasks.
+        """
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for thread in threads:
+            self.tasks.put(None)
+
+    def record_latency(self, vendor, elapsed):
+        with self.lock:
+            bucket = bisect.bisect_left(self.LATENCY_BUCKETS, elapsed)
+            self.latency[vendor][bucket] += 1
+
+    def latency_histograms(self):
+        """Summarize how long each vendor has taken to respond.
+
+        :return: A dictionary mapping vendor names to lists of
+        (upper bound, count) 2-tuples. The upper bound of the last
+        bucket is None.
+        """
+        bounds = self.LATENCY_BUCKETS + [None]
+        with self.lock:
+            return dict(
+                (vendor, zip(bounds, counts))
+                for vendor, counts in self.latency.items()
+            )
+
+
 class CirculationAPI(object):
     """Implement basic circulation logic and abstract away the details
     between different circulation APIs behind generic operations like
     'borrow'.
     """
 
-    def __init__(self, _db, library, analytics=None, api_map=None):
+    # Once there are this many records of recent bookshelf syncs,
+    # outdated records are cleared out.
+    MAX_BOOKSHELF_SYNC_RECORDS = 10000
+
+    def __init__(self, _db, library, analytics=None, api_map=None,
+                 executor=None, configuration=None):
         """Constructor.
 
         :param _db: A database session (probably a scoped session, which is
@@ -304,10 +542,20 @@ class CirculationAPI(object):
            Since instantiating these API classes may result in API
            calls, we only instantiate one CirculationAPI per library,
            and keep them around as long as possible.
+
+        :param executor: A PatronActivityExecutor to use when checking
+           a patron's activity with every vendor. If this is not
+           provided, a temporary one will be created on every check.
+
+        :param configuration: A ConfigurationSnapshot to use when
+           looking up the library's settings. If this is not provided,
+           settings are read from the database.
         """
         self._db = _db
+        self.configuration = configuration or Configuration
         self.library_id = library.id
         self.analytics = analytics
+        self.executor = executor
         self.initialization_exceptions = dict()
         api_map = api_map or self.default_api_map
 
@@ -321,6 +569,18 @@ class CirculationAPI(object):
         # from any other Collections.
         self.collection_ids_for_sync = []
 
+        # If this is set, a patron's loans and holds in a given
+        # collection are not synced with the vendor more often than
+        # once every this many seconds, unless the sync is forced.
+        self.minimum_sync_interval = library.setting(
+            Configuration.MINIMUM_BOOKSHELF_SYNC_INTERVAL
+        ).int_value or 0
+
+        # Maps (patron ID, collection ID) to the last time that
+        # patron's bookshelf was successfully synced with that
+        # collection's vendor.
+        self.last_bookshelf_sync = {}
+
         self.log = logging.getLogger("Circulation API")
         for collection in library.collections:
             if collection.protocol in api_map:
@@ -392,7 +652,9 @@ class CirculationAPI(object):
         """
         # Short-circuit the request if the patron lacks borrowing
         # privileges.
-        PatronUtility.assert_borrowing_privileges(patron)        
+        PatronUtility.assert_borrowing_privileges(
+            patron, self.configuration
+        )
         
         now = datetime.datetime.utcnow()
         if licensepool.open_access:
@@ -416,6 +678,10 @@ class CirculationAPI(object):
             # with a collection that this library doesn't have access to.
             raise NoLicenses()
 
+        # Whatever happens next, our record of the patron's activity
+        # in this collection may become out of date.
+        self.invalidate_bookshelf_sync(patron, licensepool.collection)
+
         must_set_delivery_mechanism = (
             api.SET_DELIVERY_MECHANISM_AT == BaseCirculationAPI.BORROW_STEP)
 
@@ -427,7 +693,9 @@ class CirculationAPI(object):
         internal_format = api.internal_format(delivery_mechanism)
 
         if patron.fines:
-            max_fines = Configuration.max_outstanding_fines(patron.library)
+            max_fines = self.configuration.max_outstanding_fines(
+                patron.library
+            )
             if patron.fines >= max_fines.amount:
                 raise OutstandingFines()
 
@@ -446,10 +714,10 @@ class CirculationAPI(object):
             # certain error conditions (like NoAvailableCopies) mean
             # something different if you already have a confirmed
             # active loan.
-
-            # TODO: This would be a great place to pass in only the
-            # single API that needs to be synced.
-            self.sync_bookshelf(patron, pin)
+            #
+            # Only the API for this book's collection needs to be
+            # synced.
+            self.sync_collection(patron, pin, licensepool.collection)
             existing_loan = get_one(
                 self._db, Loan, patron=patron, license_pool=licensepool,
                 on_multiple='interchangeable'
@@ -457,7 +725,7 @@ class CirculationAPI(object):
 
         new_loan = False
 
-        loan_limit = patron.library.setting(Configuration.LOAN_LIMIT).int_value
+        loan_limit = self.configuration.loan_limit(patron.library)
         non_open_access_loans_with_end_date = [loan for loan in patron.loans if loan.license_pool.open_access == False and loan.end]
         at_loan_limit = (loan_limit and len(non_open_access_loans_with_end_date) >= loan_limit)
 
@@ -562,7 +830,7 @@ class CirculationAPI(object):
         # Checking out a book didn't work, so let's try putting
         # the book on hold.
         if not hold_info:
-            hold_limit = patron.library.setting(Configuration.HOLD_LIMIT).int_value
+            hold_limit = self.configuration.hold_limit(patron.library)
             if hold_limit and len(patron.holds) >= hold_limit:
                 raise PatronHoldLimitReached()
 
@@ -661,11 +929,9 @@ class CirculationAPI(object):
         if not loan and not self.can_fulfill_without_loan(
             patron, licensepool, delivery_mechanism
         ):
-            if sync_on_failure:
-                # Sync and try again.
-                # TODO: Pass in only the single collection or LicensePool
-                # that needs to be synced.
-                self.sync_bookshelf(patron, pin)
+            if sync_on_failure and patron:
+                # Sync the collection containing this book and try again.
+                self.sync_collection(patron, pin, licensepool.collection)
                 return self.fulfill(
                     patron, pin, licensepool=licensepool,
                     delivery_mechanism=delivery_mechanism,
@@ -767,6 +1033,7 @@ class CirculationAPI(object):
         )
         if loan:
             if not licensepool.open_access:
+                self.invalidate_bookshelf_sync(patron, licensepool.collection)
                 api = self.api_for_license_pool(licensepool)
                 try:
                     api.checkin(patron, pin, licensepool)
@@ -800,6 +1067,7 @@ class CirculationAPI(object):
             on_multiple='interchangeable'
         )
         if not licensepool.open_access:
+            self.invalidate_bookshelf_sync(patron, licensepool.collection)
             api = self.api_for_license_pool(licensepool)
             try:
                 api.release_hold(patron, pin, licensepool)
@@ -825,62 +1093,91 @@ class CirculationAPI(object):
 
         return True
 
-    def patron_activity(self, patron, pin):
+    def patron_activity(self, patron, pin, collection_ids=None):
         """Return a record of the patron's current activity
         vis-a-vis all relevant external loan sources.
 
-        We check each source in a separate thread for speed.
+        We check each source in a separate thread for speed. Results
+        are processed as they come in; a source that doesn't respond
+        within its timeout, or that already has too many requests
+        running, is treated as having failed.
 
-        :return: A 2-tuple (loans, holds) containing `HoldInfo` and
-        `LoanInfo` objects.
+        :param collection_ids: If this is provided, only the sources
+        for the Collections with these IDs are checked.
+
+        :return: A 3-tuple (loans, holds, complete). `loans` and
+        `holds` contain `LoanInfo` and `HoldInfo` objects. `complete`
+        is False if any source failed to respond.
         """
-        log = self.log
-        class PatronActivityThread(Thread):
-            def __init__(self, api, patron, pin):
-                self.api = api
-                self.patron = patron
-                self.pin = pin
-                self.activity = None
-                self.exception = None
-                super(PatronActivityThread, self).__init__()
-
-            def run(self):
-                before = time.time()
-                try:
-                    self.activity = self.api.patron_activity(
-                        self.patron, self.pin)
-                except Exception, e:
-                    self.exception = e
-                after = time.time()
-                log.debug(
-                    "Synced %s in %.2f sec", self.api.__class__.__name__,
-                    after-before
-                )
+        apis = [
+            (collection_id, api)
+            for collection_id, api in self.api_for_collection.items()
+            if collection_ids is None or collection_id in collection_ids
+        ]
+        executor = self.executor
+        if not executor:
+            workers = max(len(apis), 1)
+            executor = PatronActivityExecutor(
+                workers=workers, timeout=None,
+                max_tasks_per_collection=workers
+            )
 
-        threads = []
         before = time.time()
-        for api in self.api_for_collection.values():
-            thread = PatronActivityThread(api, patron, pin)
-            threads.append(thread)
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+        results = Queue.Queue()
+        pending = set()
+        complete = True
+        for collection_id, api in apis:
+            task = PatronActivityTask(
+                api, patron, pin, results, collection_id=collection_id
+            )
+            if not executor.submit(task):
+                # This collection is already busy with other requests,
+                # probably because its vendor has stopped responding.
+                complete = False
+                self.log.error(
+                    "%s has too many requests running; not checking it",
+                    task.vendor
+                )
+                continue
+            pending.add(task)
+
         loans = []
         holds = []
-        complete = True
-        for thread in threads:
-            if thread.exception:
+        timed_out = []
+        while pending:
+            now = time.time()
+            for task in list(pending):
+                # Each vendor has its own timeout.
+                if executor.abandon_if_expired(task, before, now):
+                    pending.discard(task)
+                    timed_out.append(task)
+            if not pending:
+                break
+            upcoming = [
+                executor.deadline(task, before) for task in pending
+            ]
+            upcoming = [x for x in upcoming if x is not None]
+            try:
+                if upcoming:
+                    task = results.get(timeout=max(min(upcoming)-now, 0))
+                else:
+                    task = results.get()
+            except Queue.Empty:
+                continue
+            pending.discard(task)
+            self.log.debug(
+                "Synced %s in %.2f sec", task.vendor, task.elapsed
+            )
+            if task.exception:
                 # Something went wrong, so we don't have a complete
                 # picture of the patron's loans.
                 complete = False
                 self.log.error(
-                    "%s errored out: %s", thread.api.__class__.__name__,
-                    thread.exception,
-                    exc_info=thread.exception
+                    "%s errored out: %s", task.vendor, task.exception,
+                    exc_info=task.exception
                 )
-            if thread.activity:
-                for i in thread.activity:
+            if task.activity:
+                for i in task.activity:
                     l = None
                     if isinstance(i, LoanInfo):
                         l = loans
@@ -893,6 +1190,25 @@ class CirculationAPI(object):
                         )
                     if l is not None:
                         l.append(i)
+
+        for task in timed_out:
+            # This source is taking too long. We won't wait for it, but
+            # we also don't have a complete picture of the patron's
+            # loans.
+            complete = False
+            if task.started is None:
+                self.log.error(
+                    "%s was not checked within %s sec; all workers were busy",
+                    task.vendor, executor.timeout_for(task.vendor)
+                )
+            else:
+                self.log.error(
+                    "%s did not respond within %s sec", task.vendor,
+                    executor.timeout_for(task.vendor)
+                )
+
+        if executor is not self.executor:
+            executor.shutdown()
         after = time.time()
         self.log.debug("Full sync took %.2f sec", after-before)
         return loans, holds, complete
@@ -911,15 +1227,146 @@ class CirculationAPI(object):
             Hold.patron==patron
         )
 
-    def sync_bookshelf(self, patron, pin):
+    def license_pools_for_remote(self, infos):
+        """Look up the LicensePools for a number of LoanInfo and
+        HoldInfo objects with a single query.
 
-        # Get the external view of the patron's current state.
-        remote_loans, remote_holds, complete = self.patron_activity(patron, pin)
+        :return: A dictionary mapping (collection ID, identifier type,
+        identifier) to a list of LicensePools.
+        """
+        pools = defaultdict(list)
+        if not infos:
+            return pools
+        collection_ids = set(x.collection_id for x in infos)
+        identifiers = set(x.identifier for x in infos)
+        qu = self._db.query(LicensePool).join(
+            LicensePool.identifier
+        ).join(
+            LicensePool.data_source
+        ).filter(
+            LicensePool.collection_id.in_(collection_ids)
+        ).filter(
+            Identifier.identifier.in_(identifiers)
+        ).options(
+            contains_eager(LicensePool.identifier),
+            contains_eager(LicensePool.data_source),
+        )
+        for pool in qu:
+            key = (pool.collection_id, pool.identifier.type,
+                   pool.identifier.identifier)
+            pools[key].append(pool)
+        return pools
+
+    def license_pool_for_remote(self, pools, info):
+        """Find the LicensePool for a LoanInfo or HoldInfo in the
+        output of license_pools_for_remote, creating it if necessary.
+        """
+        data_source_name = info.data_source_name
+        if isinstance(data_source_name, DataSource):
+            data_source_name = data_source_name.name
+        key = (info.collection_id, info.identifier_type, info.identifier)
+        for pool in pools.get(key, []):
+            if pool.data_source.name == data_source_name:
+                return pool
+        return info.license_pool(self._db)
+
+    def invalidate_bookshelf_sync(self, patron, collection):
+        """Make sure the next sync of this patron's bookshelf checks
+        with the vendor for the given collection.
+        """
+        self.last_bookshelf_sync.pop((patron.id, collection.id), None)
+
+    def collections_needing_sync(self, patron):
+        """Find the collections where this patron's loans and holds
+        have not been synced with the vendor recently.
 
-        # Get our internal view of the patron's current state.
+        :return: A list of Collection IDs.
+        """
+        return [
+            collection_id for collection_id in self.collection_ids_for_sync
+            if PatronUtility.needs_bookshelf_sync(
+                self.last_bookshelf_sync.get((patron.id, collection_id)),
+                self.minimum_sync_interval
+            )
+        ]
+
+    def record_bookshelf_sync(self, patron, collection_ids, now):
+        """Note that this patron's bookshelf was just synced with the
+        vendors for the given collections.
+        """
+        for collection_id in collection_ids:
+            self.last_bookshelf_sync[(patron.id, collection_id)] = now
+
+        # Don't let this grow indefinitely. A record older than the
+        # minimum sync interval is no more useful than no record.
+        if len(self.last_bookshelf_sync) > self.MAX_BOOKSHELF_SYNC_RECORDS:
+            cutoff = now - datetime.timedelta(
+                seconds=self.minimum_sync_interval
+            )
+            for key, last_sync in self.last_bookshelf_sync.items():
+                if last_sync < cutoff:
+                    del self.last_bookshelf_sync[key]
+
+    def sync_collection(self, patron, pin, collection):
+        """Bring our local record of a patron's loans and holds in a
+        single collection into line with what that collection's
+        vendor says.
+
+        Loans and holds in other collections are left alone, and no
+        other vendor is contacted.
+
+        :return: A 2-tuple (loans, holds).
+        """
+        return self.sync_bookshelf(
+            patron, pin, collection_ids=[collection.id]
+        )
+
+    def sync_bookshelf(self, patron, pin, force=False, collection_ids=None):
+        """Bring our local record of a patron's loans and holds into
+        line with what the vendors say.
+
+        :param force: Check with every vendor, even if the patron's
+        bookshelf was recently synced with that vendor.
+
+        :param collection_ids: Check only with the vendors for the
+        Collections with these IDs, whether or not they were synced
+        recently. Only loans and holds in these Collections will be
+        changed.
+
+        :return: A 2-tuple (loans, holds).
+        """
+        if collection_ids is not None:
+            collection_ids = [
+                x for x in collection_ids if x in self.collection_ids_for_sync
+            ]
+        elif self.minimum_sync_interval and not force:
+            # We may be able to skip some or all of the vendors.
+            collection_ids = self.collections_needing_sync(patron)
+            if not collection_ids:
+                # Every vendor was checked recently. Our internal view
+                # of the patron's current state is good enough.
+                return (
+                    list(self.local_loans(patron)),
+                    list(self.local_holds(patron))
+                )
+        if collection_ids is None:
+            synced_collection_ids = set(self.collection_ids_for_sync)
+            remote_loans, remote_holds, complete = self.patron_activity(
+                patron, pin
+            )
+        else:
+            synced_collection_ids = set(collection_ids)
+            remote_loans, remote_holds, complete = self.patron_activity(
+                patron, pin, collection_ids=collection_ids
+            )
+
+        # Get our internal view of the patron's current state. The
+        # LicensePools and Identifiers are loaded along with the loans
+        # and holds, so that keying them doesn't cost a query apiece.
         __transaction = self._db.begin_nested()
-        local_loans = self.local_loans(patron)
-        local_holds = self.local_holds(patron)
+        eager = joinedload("license_pool").joinedload("identifier")
+        local_loans = self.local_loans(patron).options(eager)
+        local_holds = self.local_holds(patron).options(eager)
 
         now = datetime.datetime.utcnow()
         local_loans_by_identifier = {}
@@ -951,19 +1398,38 @@ class CirculationAPI(object):
             key = (i.type, i.identifier)
             local_holds_by_identifier[key] = h
 
+        # Find the LicensePools for all the remote loans and holds we
+        # don't already know about, in a single query.
+        pools = self.license_pools_for_remote(
+            [x for x in remote_loans
+             if (x.identifier_type, x.identifier)
+             not in local_loans_by_identifier] +
+            [x for x in remote_holds
+             if (x.identifier_type, x.identifier)
+             not in local_holds_by_identifier]
+        )
+
         active_loans = []
         active_holds = []
+        matched_loans_by_identifier = {}
+        matched_holds_by_identifier = {}
+        new_loans_by_identifier = {}
+        new_holds_by_identifier = {}
         for loan in remote_loans:
             # This is a remote loan. Find or create the corresponding
             # local loan.
-            pool = loan.license_pool(self._db)
             start = loan.start_date
             end = loan.end_date
             key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
+            if (key in matched_loans_by_identifier
+                or key in new_loans_by_identifier):
+                # The vendor mentioned this loan twice.
+                continue
+            elif key in local_loans_by_identifier:
                 # We already have the Loan object, we don't need to look
                 # it up again.
                 local_loan = local_loans_by_identifier[key]
+                matched_loans_by_identifier[key] = local_loan
 
                 # But maybe the remote's opinions as to the loan's
                 # start or end date have changed.
@@ -972,7 +1438,16 @@ class CirculationAPI(object):
                 if end:
                     local_loan.end = end
             else:
-                local_loan, new = pool.loan_to(patron, start, end)
+                # We checked local_loans, so the patron definitely
+                # doesn't have a loan on this LicensePool. Create one
+                # without asking the database again.
+                pool = self.license_pool_for_remote(pools, loan)
+                local_loan = Loan(
+                    patron=patron, license_pool=pool, start=start or now,
+                    end=end
+                )
+                self._db.add(local_loan)
+                new_loans_by_identifier[key] = local_loan
 
             if loan.locked_to:
                 # The loan source is letting us know that the loan is
@@ -983,50 +1458,58 @@ class CirculationAPI(object):
                 loan.locked_to.apply(local_loan, autocommit=False)
             active_loans.append(local_loan)
 
-            # Check the local loan off the list we're keeping so we
-            # don't delete it later.
-            key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
-                del local_loans_by_identifier[key]
-
         for hold in remote_holds:
             # This is a remote hold. Find or create the corresponding
             # local hold.
-            pool = hold.license_pool(self._db)
             start = hold.start_date
             end = hold.end_date
             position = hold.hold_position
             key = (hold.identifier_type, hold.identifier)
-            if key in local_holds_by_identifier:
+            if (key in matched_holds_by_identifier
+                or key in new_holds_by_identifier):
+                # The vendor mentioned this hold twice.
+                continue
+            elif key in local_holds_by_identifier:
                 # We already have the Hold object, we don't need to look
                 # it up again.
                 local_hold = local_holds_by_identifier[key]
-
-                # But maybe the remote's opinions as to the hold's
-                # start or end date have changed.
-                local_hold.update(start, end, position)
+                matched_holds_by_identifier[key] = local_hold
             else:
-                local_hold, new = pool.on_hold_to(patron, start, end, position)
+                pool = self.license_pool_for_remote(pools, hold)
+                local_hold = Hold(
+                    patron=patron, license_pool=pool, start=start or now
+                )
+                self._db.add(local_hold)
+                new_holds_by_identifier[key] = local_hold
+
+            # Maybe the remote's opinions as to the hold's start or
+            # end date have changed.
+            local_hold.update(start, end, position)
             active_holds.append(local_hold)
 
-            # Check the local hold off the list we're keeping so that
-            # we don't delete it later.
-            if key in local_holds_by_identifier:
-                del local_holds_by_identifier[key]
+        # Any local loan or hold the remote lists didn't mention is stale.
+        stale_loans = [
+            loan for key, loan in local_loans_by_identifier.items()
+            if key not in matched_loans_by_identifier
+        ]
+        stale_holds = [
+            hold for key, hold in local_holds_by_identifier.items()
+            if key not in matched_holds_by_identifier
+        ]
 
         # We only want to delete local loans and holds if we were able to
         # successfully sync with all the providers. If there was an error,
         # the provider might still know about a loan or hold that we don't
         # have in the remote lists.
         if complete:
-            # Every loan remaining in loans_by_identifier is a hold that
+            # Every stale loan is a loan that
             # the provider doesn't know about. This usually means it's expired
             # and we should get rid of it, but it's possible the patron is
             # borrowing a book and syncing their bookshelf at the same time,
             # and the local loan was created after we got the remote loans.
             # If the loan's start date is less than a minute ago, we'll keep it.
-            for loan in local_loans_by_identifier.values():
-                if loan.license_pool.collection_id in self.collection_ids_for_sync:
+            for loan in stale_loans:
+                if loan.license_pool.collection_id in synced_collection_ids:
                     one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
                     if loan.start < one_minute_ago:
                         logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
@@ -1034,14 +1517,28 @@ class CirculationAPI(object):
                     else:
                         logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
 
-            # Every hold remaining in holds_by_identifier is a hold that
-            # the provider doesn't know about, which means it's expired
-            # and we should get rid of it.
-            for hold in local_holds_by_identifier.values():
-                if hold.license_pool.collection_id in self.collection_ids_for_sync:
+            # Every stale hold is a hold that the provider doesn't
+            # know about, which means it's expired and we should get
+            # rid of it.
+            for hold in stale_holds:
+                if hold.license_pool.collection_id in synced_collection_ids:
                     self._db.delete(hold)
 
+            self.record_bookshelf_sync(patron, synced_collection_ids, now)
+
         __transaction.commit()
+
+        if collection_ids is not None:
+            # Loans and holds in the collections we didn't sync are
+            # still active, as far as we know.
+            active_loans.extend(
+                x for x in stale_loans
+                if x.license_pool.collection_id not in synced_collection_ids
+            )
+            active_holds.extend(
+                x for x in stale_holds
+                if x.license_pool.collection_id not in synced_collection_ids
+            )
         return active_loans, active_holds
 
 
@@ -1,7 +1,13 @@
 import json
+import logging
+from collections import defaultdict
 import re
 from nose.tools import set_trace
 import contextlib
+from threading import (
+    Event,
+    Thread,
+)
 from copy import deepcopy
 from flask_babel import lazy_gettext as _
 from core.config import (
@@ -13,7 +19,18 @@ from core.config import (
 )
 from core.util import MoneyUtility
 from core.lane import Facets
-from core.model import ConfigurationSetting
+from core.model import (
+    Collection,
+    ConfigurationSetting,
+    ExternalIntegration,
+    Library,
+)
+from sqlalchemy import inspect
+from sqlalchemy.orm import (
+    Session,
+    make_transient_to_detached,
+)
+from sqlalchemy.orm.util import identity_key
 
 class Configuration(CoreConfiguration):
 
@@ -47,6 +64,10 @@ class Configuration(CoreConfiguration):
     LOAN_LIMIT = u"loan_limit"
     HOLD_LIMIT = u"hold_limit"
 
+    # The name of the per-library setting that controls how often a
+    # patron's bookshelf may be synced with each vendor.
+    MINIMUM_BOOKSHELF_SYNC_INTERVAL = u"minimum_bookshelf_sync_interval"
+
     # The name of the per-library setting that sets the default email
     # address to use when notifying patrons of changes.
     DEFAULT_NOTIFICATION_EMAIL_ADDRESS = u"default_notification_email_address"
@@ -179,6 +200,13 @@ class Configuration(CoreConfiguration):
             "type": "number",
             "optional": True,
         },
+        {
+            "key": MINIMUM_BOOKSHELF_SYNC_INTERVAL,
+            "label": _("Minimum number of seconds between syncs of a patron's bookshelf with each distributor"),
+            "description": _("If this is set, a patron who checks their loans repeatedly will see the loans and holds the circulation manager already knows about, rather than waiting for every distributor to be asked again. Borrowing or returning a book always causes a fresh sync with that book's distributor."),
+            "type": "number",
+            "optional": True,
+        },
         {
             "key": TERMS_OF_SERVICE,
             "label": _("Terms of Service URL"),
@@ -298,6 +326,18 @@ class Configuration(CoreConfiguration):
             cls.MAX_OUTSTANDING_FINES, library
         ).value
         return MoneyUtility.parse(max_fines)
+
+    @classmethod
+    def loan_limit(cls, library):
+        return ConfigurationSetting.for_library(
+            cls.LOAN_LIMIT, library
+        ).int_value
+
+    @classmethod
+    def hold_limit(cls, library):
+        return ConfigurationSetting.for_library(
+            cls.HOLD_LIMIT, library
+        ).int_value
     
     @classmethod
     def load(cls, _db=None):
@@ -382,7 +422,367 @@ class Configuration(CoreConfiguration):
                 type = 'text/html'
             yield type, value
             
-        
+
+
+class ConfigurationSnapshot(object):
+    """An in-memory copy of the site configuration, as of a given
+    moment.
+
+    A snapshot is never modified once it's created. When the site
+    configuration changes, a new snapshot is created and put in place
+    of the old one, so a request that's using a snapshot always sees
+    a consistent picture of the configuration.
+
+    Methods like max_outstanding_fines() have the same signatures as
+    the Configuration class methods that read the database, so either
+    can be used to look up a library's settings.
+    """
+
+    def __init__(self, version, libraries, default_library_id, settings,
+                 integrations=None, library_integrations=None,
+                 library_collections=None, library_objects=None,
+                 lending_policy=None, library_columns=None):
+        """Constructor.
+
+        :param version: The time of the configuration change this
+          snapshot reflects.
+
+        :param libraries: A dictionary mapping library short names
+          to library IDs.
+
+        :param default_library_id: The ID of the default library.
+
+        :param settings: A dictionary mapping (library ID, external
+          integration ID, key) to the value of a ConfigurationSetting.
+
+        :param integrations: A dictionary mapping external
+          integration IDs to (protocol, goal, name) 3-tuples.
+
+        :param library_integrations: A dictionary mapping library IDs
+          to the IDs of the external integrations they use, directly
+          or through their collections.
+
+        :param library_collections: A dictionary mapping library IDs
+          to a list of (collection ID, external account ID, parent ID)
+          3-tuples.
+
+        :param library_objects: A dictionary mapping library IDs to
+          detached Library objects.
+
+        :param lending_policy: The site's lending policy.
+
+        :param library_columns: A dictionary mapping library IDs to a
+          sorted list of (column name, value) 2-tuples, as found in the
+          library's row of the database.
+        """
+        self.version = version
+        self._libraries = libraries
+        self.default_library_id = default_library_id
+        self._settings = settings
+        self._integrations = integrations or {}
+        self._library_integrations = library_integrations or {}
+        self._library_collections = library_collections or {}
+        self._library_objects = library_objects or {}
+        self.lending_policy = lending_policy
+        self._library_columns = library_columns or {}
+
+        # Index the settings by the library and integration they
+        # belong to, and find the integrations that aren't associated
+        # with any particular library, so fingerprints are quick to
+        # calculate.
+        self._short_names = dict(
+            (id, short_name) for short_name, id in libraries.items()
+        )
+        self._settings_by_owner = defaultdict(list)
+        for (library_id, integration_id, key), value in settings.items():
+            self._settings_by_owner[(library_id, integration_id)].append(
+                (key, value)
+            )
+        used = set()
+        for integration_ids in self._library_integrations.values():
+            used.update(integration_ids)
+        self._unassociated_integrations = set(
+            id for id in self._integrations if id not in used
+        )
+
+    @classmethod
+    def from_database(cls, _db, version=None, lending_policy=None):
+        """Take a snapshot of the configuration in the database."""
+        libraries = {}
+        default_library_id = None
+        library_objects = {}
+        library_columns = {}
+
+        # Keep a copy of each Library that isn't attached to any
+        # session, so it can be put into a request's session without
+        # going to the database.
+        columns = [x.key for x in inspect(Library).column_attrs]
+        for row in _db.query(*[getattr(Library, x) for x in columns]):
+            values = dict(zip(columns, row))
+            library = Library(**values)
+            make_transient_to_detached(library)
+            library_objects[library.id] = library
+            library_columns[library.id] = sorted(values.items())
+            libraries[library.short_name] = library.id
+            if library.is_default:
+                default_library_id = library.id
+
+        settings = {}
+        for library_id, integration_id, key, value in _db.query(
+            ConfigurationSetting.library_id,
+            ConfigurationSetting.external_integration_id,
+            ConfigurationSetting.key, ConfigurationSetting.value
+        ):
+            settings[(library_id, integration_id, key)] = value
+
+        integrations = {}
+        for id, protocol, goal, name in _db.query(
+            ExternalIntegration.id, ExternalIntegration.protocol,
+            ExternalIntegration.goal, ExternalIntegration.name
+        ):
+            integrations[id] = (protocol, goal, name)
+
+        library_integrations = defaultdict(set)
+        for library_id, integration_id in _db.query(
+            Library.id, ExternalIntegration.id
+        ).join(Library.integrations):
+            library_integrations[library_id].add(integration_id)
+
+        library_collections = defaultdict(list)
+        for library_id, id, account_id, parent_id, integration_id in _db.query(
+            Library.id, Collection.id, Collection.external_account_id,
+            Collection.parent_id, Collection.external_integration_id
+        ).join(Library.collections):
+            library_collections[library_id].append(
+                (id, account_id, parent_id)
+            )
+            library_integrations[library_id].add(integration_id)
+
+        return cls(
+            version, libraries, default_library_id, settings,
+            integrations, dict(library_integrations),
+            dict(library_collections), library_objects, lending_policy,
+            library_columns
+        )
+
+    def library_id(self, short_name):
+        """Find the ID of the library with the given short name.
+
+        :param short_name: A library's short name, or None to get the
+          default library.
+
+        :return: A library ID, or None if there is no such library.
+        """
+        if short_name is None:
+            return self.default_library_id
+        return self._libraries.get(short_name)
+
+    def library(self, _db, library_id):
+        """Find a Library in the given database session.
+
+        If the session doesn't already have the Library, the
+        snapshot's copy is added to it without asking the database.
+
+        :return: A Library, or None if there is no such library.
+        """
+        library = _db.identity_map.get(identity_key(Library, library_id))
+        if library is not None:
+            return library
+        snapshot = self._library_objects.get(library_id)
+        if snapshot is None:
+            return _db.query(Library).get(library_id)
+        return _db.merge(snapshot, load=False)
+
+    @property
+    def libraries(self):
+        """A dictionary mapping library short names to library IDs."""
+        return dict(self._libraries)
+
+    @property
+    def library_ids(self):
+        return self._libraries.values()
+
+    def setting(self, key, library=None, integration=None):
+        """Look up the value of a ConfigurationSetting.
+
+        :param library: A Library or library ID, if this is a
+          per-library setting.
+
+        :param integration: An ExternalIntegration or integration ID,
+          if this is an integration setting.
+        """
+        library_id = getattr(library, 'id', library)
+        integration_id = getattr(integration, 'id', integration)
+        return self._settings.get((library_id, integration_id, key))
+
+    def sitewide(self, key):
+        return self.setting(key)
+
+    def for_library(self, key, library):
+        return self.setting(key, library=library)
+
+    def int_for_library(self, key, library):
+        value = self.for_library(key, library)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return None
+
+    def max_outstanding_fines(self, library):
+        return MoneyUtility.parse(
+            self.for_library(Configuration.MAX_OUTSTANDING_FINES, library)
+        )
+
+    def loan_limit(self, library):
+        return self.int_for_library(Configuration.LOAN_LIMIT, library)
+
+    def hold_limit(self, library):
+        return self.int_for_library(Configuration.HOLD_LIMIT, library)
+
+    def enabled_facets(self, group_name, library):
+        """Find the facets enabled for a library, the way
+        Library.enabled_facets does.
+        """
+        value = self.for_library(
+            Configuration.ENABLED_FACETS_KEY_PREFIX + group_name, library
+        )
+        try:
+            value = json.loads(value) if value else None
+        except ValueError, e:
+            logging.error(
+                "Invalid list of enabled facets for %s: %s",
+                group_name, value
+            )
+            value = None
+        if not value:
+            value = list(Facets.DEFAULT_ENABLED_FACETS.get(group_name, []))
+        return value
+
+    def default_facet(self, group_name, library):
+        value = self.for_library(
+            Configuration.DEFAULT_FACET_KEY_PREFIX + group_name, library
+        )
+        if not value:
+            value = Facets.DEFAULT_FACET.get(group_name)
+        return value
+
+    def facet_config(self, library):
+        """Build a FacetConfig for the given Library using the facet
+        settings in this snapshot.
+        """
+        from core.facets import FacetConfig
+        return FacetConfig.from_library(SnapshotFacetSettings(self, library))
+
+    def library_fingerprint(self, library_id):
+        """Summarize all the configuration that might affect the
+        objects created for a library.
+
+        If a library's fingerprint is the same in two snapshots, its
+        configuration didn't change in between, and objects created
+        for it under the old configuration can still be used.
+
+        This includes the library's own row in the database, since
+        objects like the LibraryAuthenticator hold on to its name and
+        UUID. Sitewide settings and integrations that aren't associated
+        with any library are included in every library's fingerprint,
+        since there's no telling which libraries they affect.
+        """
+        integration_ids = sorted(
+            self._unassociated_integrations |
+            self._library_integrations.get(library_id, set())
+        )
+        owners = [(None, None), (library_id, None)]
+        for id in integration_ids:
+            owners.extend([(None, id), (library_id, id)])
+        settings = [
+            (owner, sorted(self._settings_by_owner.get(owner, [])))
+            for owner in owners
+        ]
+        integrations = [
+            (id, self._integrations.get(id)) for id in integration_ids
+        ]
+        collections = sorted(self._library_collections.get(library_id, []))
+        return (
+            self._short_names.get(library_id),
+            library_id == self.default_library_id,
+            self._library_columns.get(library_id),
+            settings, integrations, collections
+        )
+
+
+class SnapshotFacetSettings(object):
+    """Stand in for a Library when building a FacetConfig, answering
+    questions about facets from a ConfigurationSnapshot.
+    """
+
+    def __init__(self, configuration, library):
+        self.configuration = configuration
+        self.library = library
+
+    def __getattr__(self, name):
+        return getattr(self.library, name)
+
+    def enabled_facets(self, group_name):
+        return self.configuration.enabled_facets(group_name, self.library)
+
+    def default_facet(self, group_name):
+        return self.configuration.default_facet(group_name, self.library)
+
+
+class SiteConfigurationWatcher(Thread):
+    """A background thread that keeps track of when the site
+    configuration last changed.
+
+    This lets web requests find out whether the configuration has
+    changed without going to the database.
+    """
+
+    DEFAULT_INTERVAL = 5
+
+    def __init__(self, bind, interval=DEFAULT_INTERVAL):
+        """Constructor.
+
+        :param bind: An Engine or Connection to use for checking the
+          database.
+
+        :param interval: Check the database this often, in seconds.
+        """
+        super(SiteConfigurationWatcher, self).__init__(
+            name="Site configuration watcher"
+        )
+        self.daemon = True
+        self.log = logging.getLogger("Site configuration watcher")
+        self.bind = bind
+        self.interval = interval
+        self.last_update = None
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Find out when the site configuration last changed."""
+        _db = Session(bind=self.bind)
+        try:
+            self.last_update = Configuration.site_configuration_last_update(
+                _db, timeout=0
+            )
+        except Exception, e:
+            self.log.error(
+                "Could not check for site configuration changes: %s", e,
+                exc_info=e
+            )
+        finally:
+            _db.close()
+        return self.last_update
+
+    def stop(self):
+        self.stopped.set()
+
+
 @contextlib.contextmanager
 def empty_config():
     with core_empty_config({}, [CoreConfiguration, Configuration]) as i:
@@ -5,8 +5,8 @@ import sys
 import urllib
 import datetime
 import base64
+import calendar
 from wsgiref.handlers import format_date_time
-from time import mktime
 
 from lxml import etree
 from sqlalchemy.orm import eagerload
@@ -96,8 +96,11 @@ from core.util.http import (
 
 from circulation_exceptions import *
 from custom_index import CustomIndexView
+from util.lazy import LazyDict
+from util.url import URLTemplateBuilder
 
 from opds import (
+    AcquisitionLinkCache,
     CirculationManagerAnnotator,
     LibraryAnnotator,
     SharedCollectionAnnotator,
@@ -117,6 +120,8 @@ from authenticator import (
 from config import (
     Configuration,
     CannotLoadConfiguration,
+    ConfigurationSnapshot,
+    SiteConfigurationWatcher,
 )
 
 from lanes import (
@@ -136,7 +141,10 @@ from adobe_vendor_id import (
     DeviceManagementProtocolController,
     AuthdataUtility,
 )
-from circulation import CirculationAPI
+from circulation import (
+    CirculationAPI,
+    PatronActivityExecutor,
+)
 from shared_collection import SharedCollectionAPI
 from odl import ODLWithConsolidatedCopiesAPI
 from novelist import (
@@ -167,6 +175,42 @@ class CirculationManager(object):
         self.site_configuration_last_update = (
             Configuration.site_configuration_last_update(self._db, timeout=0)
         )
+
+        # Outside of tests, a background thread keeps track of when
+        # the site configuration changes, so that requests don't
+        # have to ask the database.
+        self.configuration_watcher = None
+        if not testing:
+            self.configuration_watcher = SiteConfigurationWatcher(
+                self._db.get_bind()
+            )
+            self.configuration_watcher.last_update = (
+                self.site_configuration_last_update
+            )
+            self.configuration_watcher.start()
+
+        # All of the CirculationAPIs share a pool of worker threads
+        # for checking patron activity with the vendors. This survives
+        # configuration reloads. If the database session is scoped,
+        # the worker threads get their own sessions, which they need
+        # to clean up.
+        scoped_session = None
+        if hasattr(self._db, 'remove'):
+            scoped_session = self._db
+        self.patron_activity_executor = PatronActivityExecutor(
+            session=scoped_session
+        )
+        self.authdata_utilities = {}
+
+        # Objects created for individual libraries. These are kept
+        # across configuration reloads when a library's configuration
+        # hasn't changed.
+        self.auth = None
+        self.circulation_apis = {}
+        self.custom_index_views = {}
+        self.authentication_for_opds_documents = {}
+        self.configuration = None
+
         self.setup_one_time_controllers()
         self.load_settings()
 
@@ -174,10 +218,15 @@ class CirculationManager(object):
         """If the site configuration has been updated, reload the
         CirculationManager's configuration from the database.
         """
-        last_update = Configuration.site_configuration_last_update(self._db)
+        if self.configuration_watcher:
+            last_update = self.configuration_watcher.last_update
+        else:
+            last_update = Configuration.site_configuration_last_update(
+                self._db
+            )
         if last_update > self.site_configuration_last_update:
-            self.load_settings()
             self.site_configuration_last_update = last_update
+            self.load_settings()
 
     def load_settings(self):
         """Load all necessary configuration settings and external
@@ -190,33 +239,76 @@ class CirculationManager(object):
         """
         LogConfiguration.initialize(self._db)
         self.analytics = Analytics(self._db)
-        self.auth = Authenticator(self._db, self.analytics)
+
+        # Take a snapshot of the libraries and their settings, so
+        # that looking them up during a request doesn't require going
+        # to the database.
+        configuration = ConfigurationSnapshot.from_database(
+            self._db, self.site_configuration_last_update,
+            lending_policy=load_lending_policy(
+                Configuration.policy(Configuration.LENDING_POLICY, {})
+            )
+        )
+
+        # Objects created for a library whose configuration hasn't
+        # changed since the last time the settings were loaded can be
+        # kept.
+        unchanged = self.unchanged_libraries(
+            self.configuration, configuration
+        )
+        unchanged_names = [
+            short_name for short_name, library_id in
+            configuration.libraries.items() if library_id in unchanged
+        ]
+
+        self.auth = Authenticator(
+            self._db, self.analytics,
+            reuse=LazyDict.created_values(
+                getattr(self.auth, 'library_authenticators', None),
+                unchanged_names
+            )
+        )
 
         self.setup_external_search()
 
+        library_ids = configuration.library_ids
+
         # Track the Lane configuration for each library by mapping its
-        # short name to the top-level lane.
-        new_top_level_lanes = {}
-        # Create a CirculationAPI for each library.
-        new_circulation_apis = {}
+        # short name to the top-level lane. Lanes are cheap to load,
+        # and they're not part of the configuration snapshot, so
+        # they're always loaded again.
+        new_top_level_lanes = LazyDict(
+            self.library_factory(load_lanes, self._db), library_ids
+        )
+
+        # Create a CirculationAPI for each library, the first time
+        # it's needed.
+        new_circulation_apis = LazyDict(
+            self.library_factory(
+                self.setup_circulation, analytics=self.analytics,
+                configuration=configuration
+            ),
+            library_ids,
+            LazyDict.created_values(self.circulation_apis, unchanged)
+        )
 
         # Potentially load a CustomIndexView for each library
-        new_custom_index_views = {}
+        new_custom_index_views = LazyDict(
+            self.library_factory(CustomIndexView.for_library), library_ids,
+            LazyDict.created_values(self.custom_index_views, unchanged)
+        )
+
+        # Keep each library's AuthdataUtility, so that vendor ID
+        # sign-in and DRM tags don't need to look at the configuration.
+        # These are created right away, since we need to know whether
+        # any library uses Vendor IDs.
+        new_authdata_utilities = {}
 
         new_adobe_device_management = None
         for library in self._db.query(Library):
-            lanes = load_lanes(self._db, library)
-
-            new_top_level_lanes[library.id] = lanes
-
-            new_custom_index_views[library.id] = CustomIndexView.for_library(
-                library
+            authdata = self.setup_adobe_vendor_id(
+                self._db, library, new_authdata_utilities
             )
-
-            new_circulation_apis[library.id] = self.setup_circulation(
-                library, self.analytics
-            )
-            authdata = self.setup_adobe_vendor_id(self._db, library)
             if authdata and not new_adobe_device_management:
                 # There's at least one library on this system that
                 # wants Vendor IDs. This means we need to advertise support
@@ -226,16 +318,53 @@ class CirculationManager(object):
         self.top_level_lanes = new_top_level_lanes
         self.circulation_apis = new_circulation_apis
         self.custom_index_views = new_custom_index_views
+        self.authdata_utilities = new_authdata_utilities
         self.shared_collection_api = self.setup_shared_collection()
-        self.lending_policy = load_lending_policy(
-            Configuration.policy('lending', {})
-        )
+        self.lending_policy = configuration.lending_policy
 
-        self.patron_web_client_url = ConfigurationSetting.sitewide(
-            self._db, Configuration.PATRON_WEB_CLIENT_URL).value
+        self.patron_web_client_url = configuration.sitewide(
+            Configuration.PATRON_WEB_CLIENT_URL
+        )
 
         self.setup_configuration_dependent_controllers()
-        self.authentication_for_opds_documents = {}
+        self.authentication_for_opds_documents = LazyDict.created_values(
+            self.authentication_for_opds_documents, unchanged_names
+        )
+
+        # Acquisition links may depend on configuration that just
+        # changed, so start over with an empty cache.
+        self.acquisition_link_cache = AcquisitionLinkCache()
+
+        # URL templates may also depend on configuration (such as
+        # the CDN setup), so they're compiled again as needed.
+        self.url_builder = URLTemplateBuilder(flask.url_for)
+        self.cdn_url_builder = URLTemplateBuilder(cdn_url_for)
+
+        self.configuration = configuration
+
+    def unchanged_libraries(self, old_configuration, new_configuration):
+        """Find the libraries whose configuration is the same in two
+        ConfigurationSnapshots.
+
+        :return: A set of library IDs.
+        """
+        if not old_configuration:
+            return set()
+        unchanged = set()
+        for library_id in new_configuration.library_ids:
+            if (old_configuration.library_fingerprint(library_id)
+                == new_configuration.library_fingerprint(library_id)):
+                unchanged.add(library_id)
+        return unchanged
+
+    def library_factory(self, function, *args, **kwargs):
+        """Turn a function that creates an object for a Library into
+        a function that creates the same object given a library ID.
+        """
+        def create(library_id):
+            library = self._db.query(Library).get(library_id)
+            return function(*(args + (library,)), **kwargs)
+        return create
 
     @property
     def external_search(self):
@@ -286,13 +415,17 @@ class CirculationManager(object):
                 return None
             return search
 
-    def setup_circulation(self, library, analytics):
+    def setup_circulation(self, library, analytics, configuration=None):
         """Set up the Circulation object."""
         if self.testing:
             cls = MockCirculationAPI
         else:
             cls = CirculationAPI
-        return cls(self._db, library, analytics)
+        return cls(
+            self._db, library, analytics,
+            executor=self.patron_activity_executor,
+            configuration=configuration
+        )
 
     def setup_shared_collection(self):
         if self.testing:
@@ -329,12 +462,19 @@ class CirculationManager(object):
         """
         self.oauth_controller = OAuthController(self.auth)
 
-    def setup_adobe_vendor_id(self, _db, library):
+    def setup_adobe_vendor_id(self, _db, library, authdata_utilities=None):
         """If this Library has an Adobe Vendor ID integration,
         configure the controller for it.
 
+        :param authdata_utilities: A dictionary in which to keep the
+        library's AuthdataUtility, so that it doesn't have to be loaded
+        from the database on every request. Defaults to the
+        dictionary currently in use.
+
         :return: An Authdata object for `library`, if one could be created.
         """
+        if authdata_utilities is None:
+            authdata_utilities = self.authdata_utilities
         short_client_token_initialization_exceptions = dict()
         adobe = ExternalIntegration.lookup(
             _db, ExternalIntegration.ADOBE_VENDOR_ID,
@@ -361,7 +501,8 @@ class CirculationManager(object):
                     library,
                     vendor_id,
                     node_value,
-                    self.auth
+                    self.auth,
+                    authdata_utilities=authdata_utilities
                 )
             else:
                 self.log.warn("Adobe Vendor ID controller is disabled due to missing or incomplete configuration. This is probably nothing to worry about.")
@@ -377,10 +518,16 @@ class CirculationManager(object):
             ExternalIntegration.DISCOVERY_GOAL, library=library
         )
         authdata = None
+        authdata_utilities[library.id] = None
         if registry:
             try:
                 authdata = AuthdataUtility.from_config(library, _db)
+                authdata_utilities[library.id] = authdata
             except CannotLoadConfiguration, e:
+                # Don't keep anything for this library, so that the
+                # error comes up again whenever the configuration is
+                # used.
+                del authdata_utilities[library.id]
                 short_client_token_initialization_exceptions[library.id] = e
                 self.log.error(
                     "Short Client Token configuration for %s is present but not working. This may be cause for concern. Original error: %s",
@@ -401,6 +548,10 @@ class CirculationManager(object):
         # Some features are only available if a patron authentication
         # mechanism is set up for this library.
         authenticator = self.auth.library_authenticators.get(library.short_name)
+        kwargs.setdefault('acquisition_link_cache', self.acquisition_link_cache)
+        kwargs.setdefault('url_builder', self.url_builder)
+        kwargs.setdefault('cdn_url_builder', self.cdn_url_builder)
+        kwargs.setdefault('authdata_utilities', self.authdata_utilities)
         return LibraryAnnotator(
             self.circulation_apis[library.id], lane, library,
             top_level_title='All Books',
@@ -446,6 +597,17 @@ class CirculationManagerController(BaseCirculationManagerController):
         """Return the appropriate SharedCollectionAPI for the request library."""
         return self.manager.shared_collection_api
 
+    def facet_config(self, library=None):
+        """Find the facets enabled for a library (by default, the
+        request library), using the CirculationManager's configuration
+        snapshot if the library is in it.
+        """
+        library = library or flask.request.library
+        configuration = self.manager.configuration
+        if configuration and library.id in configuration.library_ids:
+            return configuration.facet_config(library)
+        return FacetConfig.from_library(library)
+
     def load_lane(self, lane_identifier):
         """Turn user input into a Lane object."""
         library_id = flask.request.library.id
@@ -650,7 +812,8 @@ class OPDSFeedController(CirculationManagerController):
             uses_customlists=lane.uses_customlists
         )
         facets = load_facets_from_request(
-            worklist=lane, base_class=FeaturedFacets,
+            facet_config=self.facet_config(), worklist=lane,
+            base_class=FeaturedFacets,
             base_class_constructor_kwargs=facet_class_kwargs
         )
         annotator = self.manager.annotator(lane)
@@ -674,7 +837,9 @@ class OPDSFeedController(CirculationManagerController):
         title = lane.display_name
 
         annotator = self.manager.annotator(lane)
-        facets = load_facets_from_request(worklist=lane)
+        facets = load_facets_from_request(
+            facet_config=self.facet_config(), worklist=lane
+        )
         if isinstance(facets, ProblemDetail):
             return facets
         pagination = load_pagination_from_request()
@@ -769,7 +934,8 @@ class OPDSFeedController(CirculationManagerController):
             languages = None
 
         facets = load_facets_from_request(
-            worklist=lane, base_class=SearchFacets
+            facet_config=self.facet_config(), worklist=lane,
+            base_class=SearchFacets
         )
         kwargs = dict()
         if languages:
@@ -808,6 +974,23 @@ class OPDSFeedController(CirculationManagerController):
 
 class LoanController(CirculationManagerController):
 
+    # When fulfillment content has to be fetched from a remote server,
+    # it's passed on to the client as it comes in, this many bytes at
+    # a time.
+    STREAMING_CHUNK_SIZE = 64 * 1024
+
+    # Headers from the client's request that are passed on to the
+    # remote server, so that the client can ask for part of a file.
+    STREAMING_REQUEST_HEADERS = ['Range', 'If-Range']
+
+    # Headers from the remote server's response that are passed on
+    # to the client.
+    STREAMING_RESPONSE_HEADERS = [
+        'Content-Type', 'Content-Length', 'Content-Encoding',
+        'Content-Range', 'Accept-Ranges', 'Content-Disposition',
+        'Last-Modified', 'ETag',
+    ]
+
     def get_patron_circ_objects(self, object_class, patron, license_pools):
         if not patron:
             return []
@@ -854,7 +1037,9 @@ class LoanController(CirculationManagerController):
 
         # Then make the feed.
         feed = LibraryLoanAndHoldAnnotator.active_loans_for(
-            self.circulation, patron)
+            self.circulation, patron,
+            authdata_utilities=self.manager.authdata_utilities
+        )
         return feed_response(feed, cache_for=None)
 
     def borrow(self, identifier_type, identifier, mechanism_id=None):
@@ -930,7 +1115,9 @@ class LoanController(CirculationManagerController):
         # serve a feed that talks about the hold.
         if loan:
             feed = LibraryLoanAndHoldAnnotator.single_loan_feed(
-                self.circulation, loan)
+                self.circulation, loan,
+                authdata_utilities=self.manager.authdata_utilities
+            )
         elif hold:
             feed = LibraryLoanAndHoldAnnotator.single_hold_feed(
                 self.circulation, hold)
@@ -1011,7 +1198,8 @@ class LoanController(CirculationManagerController):
             return problem_doc
         return best, mechanism
 
-    def fulfill(self, license_pool_id, mechanism_id=None, do_get=None):
+    def fulfill(self, license_pool_id, mechanism_id=None, do_get=None,
+                do_stream=None):
         """Fulfill a book that has already been checked out,
         or which can be fulfilled with no active loan.
 
@@ -1019,8 +1207,15 @@ class LoanController(CirculationManagerController):
         of the book, a key (such as a DRM license file or bearer
         token) which can be used to get the book, or an OPDS entry
         containing a link to the book.
+
+        :param do_get: A function like Representation.simple_http_get.
+          If this is provided, content on a remote server is fetched in
+          its entirety before being served.
+
+        :param do_stream: A function like HTTP.get_with_timeout, used
+          to stream content on a remote server to the client when
+          `do_get` is not provided.
         """
-        do_get = do_get or Representation.simple_http_get
 
         # Unlike most controller methods, this one has different
         # behavior whether or not the patron is authenticated. This is
@@ -1124,7 +1319,9 @@ class LoanController(CirculationManagerController):
             # If this is a streaming delivery mechanism, create an OPDS entry
             # with a fulfillment link to the streaming reader url.
             feed = LibraryLoanAndHoldAnnotator.single_fulfillment_feed(
-                self.circulation, loan, fulfillment)
+                self.circulation, loan, fulfillment,
+                authdata_utilities=self.manager.authdata_utilities
+            )
             if isinstance(feed, OPDSFeed):
                 content = unicode(feed)
             else:
@@ -1146,8 +1343,17 @@ class LoanController(CirculationManagerController):
                 # of redirecting to it, since it may be downloaded through an
                 # indirect acquisition link.
                 try:
-                    status_code, headers, content = do_get(fulfillment.content_link, headers=encoding_header)
-                    headers = dict(headers)
+                    if do_get:
+                        status_code, headers, content = do_get(fulfillment.content_link, headers=encoding_header)
+                        headers = dict(headers)
+                    else:
+                        response = self.stream_content_link(
+                            fulfillment.content_link, encoding_header,
+                            do_stream
+                        )
+                        if fulfillment.content_type:
+                            response.headers['Content-Type'] = fulfillment.content_type
+                        return response
                 except RemoteIntegrationException, e:
                     return e.as_problem_detail_document(debug=False)
             else:
@@ -1157,6 +1363,52 @@ class LoanController(CirculationManagerController):
 
         return Response(content, status_code, headers)
 
+    def stream_content_link(self, url, headers, do_stream=None):
+        """Pass on content from a remote server to the client without
+        holding all of it in memory.
+
+        :param headers: Headers to send to the remote server, in
+          addition to any Range headers sent by the client.
+
+        :return: A streaming Response.
+        """
+        do_stream = do_stream or HTTP.get_with_timeout
+        headers = dict(headers)
+        for name in self.STREAMING_REQUEST_HEADERS:
+            value = flask.request.headers.get(name)
+            if value:
+                headers[name] = value
+
+        remote = do_stream(url, headers=headers, stream=True)
+
+        response_headers = dict()
+        for name in self.STREAMING_RESPONSE_HEADERS:
+            value = remote.headers.get(name)
+            if value:
+                response_headers[name] = value
+
+        def content():
+            # The content is passed along exactly as the remote server
+            # sent it. If we asked for compressed content (as we do
+            # for Enki), the client gets the compressed content along
+            # with the Content-Encoding and Content-Length that
+            # describe it.
+            try:
+                while True:
+                    chunk = remote.raw.read(
+                        self.STREAMING_CHUNK_SIZE, decode_content=False
+                    )
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                remote.close()
+
+        return Response(
+            content(), remote.status_code, response_headers,
+            direct_passthrough=True
+        )
+
     def can_fulfill_without_loan(self, library, patron, pool, lpdm):
         """Is it acceptable to fulfill the given LicensePoolDeliveryMechanism
         for the given Patron without creating a Loan first?
@@ -1287,13 +1539,59 @@ class AnnotationController(CirculationManagerController):
                                '<http://www.w3.org/TR/annotation-protocol/>; rel="http://www.w3.org/ns/ldp#constrainedBy"']
             headers['Content-Type'] = AnnotationWriter.CONTENT_TYPE
 
-            container, timestamp = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
-            etag = 'W/""'
-            if timestamp:
-                etag = 'W/"%s"' % timestamp
-                headers['Last-Modified'] = format_date_time(mktime(timestamp.timetuple()))
-            headers['ETag'] = etag
+            # Find out whether the annotations have changed since the
+            # client last looked, before doing any real work.
+            total, ignore, latest_change = AnnotationWriter.container_version(
+                patron, identifier
+            )
+            headers['ETag'] = AnnotationWriter.etag(total, latest_change)
+            if latest_change:
+                headers['Last-Modified'] = format_date_time(
+                    AnnotationWriter.last_modified(latest_change)
+                )
+            if self.annotations_not_modified(total, latest_change):
+                return Response(status=304, headers=headers)
+
+            # Clients can ask for the annotations a page at a time, or
+            # for only the annotations that changed since their last
+            # sync.
+            paging = {}
+            for name in ('after', 'size'):
+                value = flask.request.args.get(name)
+                if value:
+                    try:
+                        paging[name] = int(value)
+                    except ValueError, e:
+                        paging[name] = None
+                    # Both are counts or IDs, so they must be positive.
+                    if paging[name] is None or paging[name] <= 0:
+                        return INVALID_INPUT.detailed(
+                            _("Invalid value for %(name)s: %(value)s",
+                              name=name, value=value)
+                        )
+            if 'size' in paging:
+                paging['size'] = min(
+                    paging['size'], AnnotationWriter.MAX_PAGE_SIZE
+                )
+            since = flask.request.args.get('since')
+            if since:
+                paging['since'] = self.parse_annotation_timestamp(since)
+                if not paging['since']:
+                    return INVALID_INPUT.detailed(
+                        _("Invalid value for %(name)s: %(value)s",
+                          name='since', value=since)
+                    )
+
+            if 'after' in paging:
+                # This is a request for a page after the first one.
+                page = AnnotationWriter.annotation_page_for(
+                    patron, identifier=identifier, **paging
+                )
+                return Response(json.dumps(page), status=200, headers=headers)
 
+            container, timestamp = AnnotationWriter.annotation_container_for(
+                patron, identifier=identifier, **paging
+            )
             content = json.dumps(container)
             return Response(content, status=200, headers=headers)
 
@@ -1309,6 +1607,34 @@ class AnnotationController(CirculationManagerController):
         headers['Content-Type'] = AnnotationWriter.CONTENT_TYPE
         return Response(content, status_code, headers)
 
+    def annotations_not_modified(self, total, latest_change):
+        """Has the client already seen this version of the annotations?"""
+        request = flask.request
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(
+                AnnotationWriter.etag_value(total, latest_change)
+            )
+        if request.if_modified_since and latest_change:
+            # Last-Modified only goes down to the second.
+            modified = AnnotationWriter.last_modified(latest_change)
+            return modified <= calendar.timegm(
+                request.if_modified_since.utctimetuple()
+            )
+        return False
+
+    def parse_annotation_timestamp(self, value):
+        """Parse a 'since' timestamp, as found in the 'modified' field of
+        an annotation.
+
+        :return: A datetime, or None if the value can't be parsed.
+        """
+        for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(value, format)
+            except ValueError, e:
+                continue
+        return None
+
     def container_for_work(self, identifier_type, identifier):
         id_obj, ignore = Identifier.for_foreign_id(
             self._db, identifier_type, identifier)
@@ -1334,6 +1660,9 @@ class AnnotationController(CirculationManagerController):
 
         if flask.request.method == 'DELETE':
             annotation.set_inactive()
+            # Clients syncing their annotations need to find out
+            # about the deletion.
+            annotation.timestamp = datetime.datetime.now()
             return Response()
 
         content = json.dumps(AnnotationWriter.detail(annotation))
@@ -1366,7 +1695,9 @@ class WorkController(CirculationManagerController):
         )
 
         annotator = self.manager.annotator(lane)
-        facets = load_facets_from_request(worklist=lane)
+        facets = load_facets_from_request(
+            facet_config=self.facet_config(), worklist=lane
+        )
         if isinstance(facets, ProblemDetail):
             return facets
         pagination = load_pagination_from_request()
@@ -1427,7 +1758,8 @@ class WorkController(CirculationManagerController):
 
         annotator = self.manager.annotator(lane)
         facets = load_facets_from_request(
-            worklist=lane, base_class=FeaturedSeriesFacets
+            facet_config=self.facet_config(), worklist=lane,
+            base_class=FeaturedSeriesFacets
         )
         if isinstance(facets, ProblemDetail):
             return facets
@@ -1464,7 +1796,9 @@ class WorkController(CirculationManagerController):
             return NO_SUCH_LANE.detailed(_("Recommendations not available"))
 
         annotator = self.manager.annotator(lane)
-        facets = load_facets_from_request(worklist=lane)
+        facets = load_facets_from_request(
+            facet_config=self.facet_config(), worklist=lane
+        )
         if isinstance(facets, ProblemDetail):
             return facets
         pagination = load_pagination_from_request()
@@ -1522,7 +1856,7 @@ class WorkController(CirculationManagerController):
         # In addition to the orderings enabled for this library, a
         # series collection may be ordered by series position, and is
         # ordered that way by default.
-        facet_config = FacetConfig.from_library(library)
+        facet_config = self.facet_config(library)
         facet_config.set_default_facet(
             Facets.ORDER_FACET_GROUP_NAME, Facets.ORDER_SERIES_POSITION
         )
@@ -1616,6 +1950,22 @@ class ServiceStatusController(CirculationManagerController):
         for k, v in sorted(timings.items()):
             statuses.append(" <li><b>%s</b>: %s</li>" % (k, v))
 
+        executor = self.manager.patron_activity_executor
+        for vendor, histogram in sorted(executor.latency_histograms().items()):
+            buckets = []
+            for upper_bound, count in histogram:
+                if upper_bound is None:
+                    label = "slower"
+                else:
+                    label = "&lt;=%ss" % upper_bound
+                buckets.append("%s: %d" % (label, count))
+            statuses.append(
+                " <li><b>%s patron activity latency</b>: %s (%d timeouts, %d rejected)</li>" % (
+                    vendor, ", ".join(buckets), executor.timeouts[vendor],
+                    executor.rejections[vendor]
+                )
+            )
+
         doc = self.template % dict(statuses="\n".join(statuses))
         return Response(doc, 200, {"Content-Type": "text/html"})
 
@@ -1,8 +1,20 @@
 from config import CannotLoadConfiguration
+import atexit
+import logging
+import os
 import uuid
 import unicodedata
 import urllib
 import re
+from Queue import (
+    Empty,
+    Full,
+    Queue,
+)
+from threading import (
+    Lock,
+    Thread,
+)
 from flask_babel import lazy_gettext as _
 from core.util.http import HTTP
 from core.model import (
@@ -12,6 +24,196 @@ from core.model import (
     get_one,
 )
 
+class AnalyticsEventSender(object):
+    """Send analytics hits to Google Analytics from a background
+    thread, so that a slow analytics server doesn't slow down
+    checkouts.
+
+    Hits wait in a bounded queue and are sent to the Measurement
+    Protocol's batch endpoint, up to BATCH_SIZE at a time. If the queue
+    fills up, hits are written to a spill file (if one is configured)
+    and sent later, or else dropped.
+    """
+
+    BATCH_SIZE = 20
+    MAX_QUEUE_SIZE = 1000
+
+    # How long the sender thread waits for a hit before checking
+    # the spill file.
+    IDLE_TIMEOUT = 5
+
+    SPILL_FILE_ENVIRONMENT_VARIABLE = "SIMPLIFIED_ANALYTICS_SPILL_FILE"
+
+    log = logging.getLogger("Google Analytics event sender")
+
+    def __init__(self, max_queue_size=None, batch_size=None,
+                 spill_path=None, background=True):
+        """Constructor.
+
+        :param spill_path: Write hits here when the queue is full.
+
+        :param background: If this is False, no thread is started and
+          hits are only sent when `flush` is called.
+        """
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.queue = Queue(maxsize=max_queue_size or self.MAX_QUEUE_SIZE)
+        self.spill_path = spill_path
+        self.background = background
+        self.thread = None
+        self.lock = Lock()
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    @property
+    def counts(self):
+        return dict(
+            queued=self.queued, sent=self.sent, dropped=self.dropped,
+            spilled=self.spilled,
+        )
+
+    def _count(self, counter, amount=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def enqueue(self, url, params):
+        """Queue a hit to be sent.
+
+        :return: True if the hit was queued or spilled to disk, False
+          if it was dropped.
+        """
+        if self.background:
+            self.start()
+        try:
+            self.queue.put_nowait((url, params))
+            self._count('queued')
+            return True
+        except Full:
+            pass
+
+        if self.spill_path:
+            try:
+                with self.lock:
+                    with open(self.spill_path, 'a') as spill:
+                        spill.write("%s\t%s\n" % (url, params))
+                    self.spilled += 1
+                return True
+            except IOError, e:
+                self.log.error(
+                    "Could not write to spill file %s", self.spill_path,
+                    exc_info=e
+                )
+        self._count('dropped')
+        return False
+
+    def start(self):
+        """Make sure the sender thread is running. It's started lazily,
+        so that each process gets its own after a fork.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                hit = self.queue.get(timeout=self.IDLE_TIMEOUT)
+            except Empty:
+                self.replay_spill()
+                continue
+            hits = [hit]
+            hits.extend(self._get_nowait(self.batch_size - 1))
+            self.send(hits)
+
+    def _get_nowait(self, limit):
+        hits = []
+        while len(hits) < limit:
+            try:
+                hits.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return hits
+
+    def flush(self):
+        """Send every queued hit right away, including any that were
+        spilled to disk.
+        """
+        while True:
+            hits = self._get_nowait(self.batch_size)
+            if not hits:
+                break
+            self.send(hits)
+        self.replay_spill()
+
+    def replay_spill(self):
+        """Send the hits in the spill file."""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        replay_path = self.spill_path + ".sending"
+        with self.lock:
+            try:
+                os.rename(self.spill_path, replay_path)
+            except OSError, e:
+                return
+        hits = []
+        with open(replay_path) as spill:
+            for line in spill:
+                url, params = line.rstrip("\n").split("\t", 1)
+                hits.append((url, params))
+                if len(hits) >= self.batch_size:
+                    self.send(hits)
+                    hits = []
+        if hits:
+            self.send(hits)
+        os.remove(replay_path)
+
+    def send(self, hits):
+        """Send a list of (url, params) hits, as few requests as possible."""
+        by_url = {}
+        for url, params in hits:
+            by_url.setdefault(url, []).append(params)
+        for url, params in by_url.items():
+            batch_url = self.batch_url(url)
+            if batch_url:
+                for i in range(0, len(params), self.batch_size):
+                    self._post(batch_url, params[i:i+self.batch_size])
+            else:
+                for hit in params:
+                    self._post(url, [hit])
+
+    def _post(self, url, hits):
+        try:
+            self.post(url, "\n".join(hits))
+            self._count('sent', len(hits))
+        except Exception, e:
+            self.log.error(
+                "Could not send %d analytics hits to %s", len(hits), url,
+                exc_info=e
+            )
+            self._count('dropped', len(hits))
+
+    def post(self, url, data):
+        HTTP.post_with_timeout(url, data)
+
+    @classmethod
+    def batch_url(cls, url):
+        """Find the batch endpoint that goes with a hit URL.
+
+        :return: A URL, or None if the hit URL isn't a Measurement
+          Protocol /collect URL.
+        """
+        if url.endswith("/collect"):
+            return url[:-len("collect")] + "batch"
+        return None
+
+
 class GoogleAnalyticsProvider(object):
     NAME = _("Google Analytics")
 
@@ -99,8 +301,26 @@ class GoogleAnalyticsProvider(object):
         params = re.sub(r"=None(&?)", r"=\1", urllib.urlencode(fields))
         self.post(self.url, params)
 
+    # Hits from every GoogleAnalyticsProvider in this process go through
+    # the same sender.
+    sender = None
+    sender_lock = Lock()
+
+    @classmethod
+    def event_sender(cls):
+        with cls.sender_lock:
+            if not GoogleAnalyticsProvider.sender:
+                GoogleAnalyticsProvider.sender = AnalyticsEventSender(
+                    spill_path=os.environ.get(
+                        AnalyticsEventSender.SPILL_FILE_ENVIRONMENT_VARIABLE
+                    )
+                )
+                # Send whatever's left when the process shuts down.
+                atexit.register(GoogleAnalyticsProvider.sender.flush)
+        return GoogleAnalyticsProvider.sender
+
     def post(self, url, params):
-        response = HTTP.post_with_timeout(url, params)
+        self.event_sender().enqueue(url, params)
 
         
 Provider = GoogleAnalyticsProvider
@@ -905,18 +905,15 @@ class RecommendationLane(WorkBasedLane):
         )
         _db = Session.object_session(library)
         self.api = novelist_api or NoveListAPI.from_config(library)
-        self.recommendations = self.fetch_recommendations(_db)
+        self.recommendations = self.fetch_recommendations(_db, library)
         if parent:
             parent.children.append(self)
 
-    def fetch_recommendations(self, _db):
+    def fetch_recommendations(self, _db, library):
         """Get identifiers of recommendations for this LicensePool"""
-
-        metadata = self.api.lookup(self.edition.primary_identifier)
-        if metadata:
-            metadata.filter_recommendations(_db)
-            return metadata.recommendations
-        return []
+        return self.api.recommendations(
+            library, self.edition.primary_identifier
+        )
 
     def apply_filters(self, _db, qu, facets, pagination, featured=False):
         if not self.recommendations:
@@ -22,7 +22,7 @@ from nose.tools import set_trace
 
 class MARCExtractor(object):
 
-    """Transform a MARC file into a list of Metadata objects."""
+    """Transform a MARC file into Metadata objects."""
 
     # Common things found in a MARC record after the name of the author
     # which we sould like to remove.
@@ -35,8 +35,14 @@ class MARCExtractor(object):
     
     @classmethod
     def parse(cls, file, data_source_name):
+        return list(cls.iterate(file, data_source_name))
+
+    @classmethod
+    def iterate(cls, file, data_source_name):
+        """Yield a Metadata object for each record in a MARC file, reading
+        the file one record at a time.
+        """
         reader = MARCReader(file)
-        metadata_records = []
 
         for record in reader:
             title = record.title()
@@ -93,7 +99,7 @@ class MARCExtractor(object):
                     
                     
                 
-            metadata_records.append(Metadata(
+            yield Metadata(
                 data_source=data_source_name,
                 title=title,
                 language='eng',
@@ -104,5 +110,4 @@ class MARCExtractor(object):
                 subjects=subjects,
                 contributors=contributors,
                 links=links
-            ))
-        return metadata_records
+            )
@@ -1,5 +1,6 @@
 import datetime
 import feedparser
+import json
 import logging
 import os
 import sys
@@ -9,17 +10,24 @@ from StringIO import StringIO
 
 from sqlalchemy import (
     and_,
+    distinct,
+    func,
+    join,
     or_,
+    select,
 )
 
 from core.monitor import (
     CollectionMonitor,
     EditionSweepMonitor,
+    Monitor,
     ReaperMonitor,
 )
 from core.model import (
     Annotation,
+    CirculationEvent,
     Collection,
+    ConfigurationSetting,
     DataSource,
     Edition,
     ExternalIntegration,
@@ -27,6 +35,7 @@ from core.model import (
     Identifier,
     LicensePool,
     Loan,
+    Patron,
 )
 from core.opds_import import (
     MetadataWranglerOPDSLookup,
@@ -367,3 +376,273 @@ class IdlingAnnotationReaper(ReaperMonitor):
             *restrictions
         )
 ReaperMonitor.REGISTRY.append(IdlingAnnotationReaper)
+
+
+class DashboardStatsMonitor(Monitor):
+    """Calculate the statistics shown on the admin dashboard and store
+    them as a sitewide setting, so that loading the dashboard doesn't
+    have to run a set of aggregate queries over the whole database.
+
+    In incremental mode, the stored inventory statistics are adjusted
+    using the circulation events that have come in since the last run,
+    the loan and hold counts are recalculated, and everything is
+    recalculated once FULL_REFRESH_INTERVAL has passed.
+    """
+
+    SERVICE_NAME = "Dashboard Statistics Monitor"
+    INTERVAL_SECONDS = 60 * 15
+
+    STATS_KEY = "dashboard_stats"
+    FULL_REFRESH_INTERVAL = datetime.timedelta(days=1)
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    # The data sources whose license pools are counted separately.
+    VENDORS = dict(
+        overdrive=DataSource.OVERDRIVE,
+        bibliotheca=DataSource.BIBLIOTHECA,
+        axis360=DataSource.AXIS_360,
+    )
+
+    def __init__(self, _db, incremental=False):
+        super(DashboardStatsMonitor, self).__init__(_db)
+        self.incremental = incremental
+
+    def run_once(self, start, cutoff):
+        now = datetime.datetime.utcnow()
+        stats = None
+        if self.incremental:
+            stats = self.stored(self._db)
+        if stats and not self.needs_full_refresh(stats, now):
+            self.apply_events(stats)
+        else:
+            # Note the most recent circulation event before starting,
+            # so an incremental run can pick up from there. Events
+            # that come in while the (slow) calculation is running
+            # are applied by the next incremental run.
+            last_event_id = self.latest_event_id(self._db)
+            stats = self.calculate(self._db)
+            stats['last_event_id'] = last_event_id
+            stats['full_refresh_at'] = now.strftime(self.TIME_FORMAT)
+        self.store(self._db, stats)
+
+    def needs_full_refresh(self, stats, now):
+        """Is it time to recalculate everything from scratch?"""
+        full_refresh_at = stats.get('full_refresh_at')
+        if not full_refresh_at or stats.get('last_event_id') is None:
+            return True
+        full_refresh_at = datetime.datetime.strptime(
+            full_refresh_at, self.TIME_FORMAT
+        )
+        return now - full_refresh_at >= self.FULL_REFRESH_INTERVAL
+
+    @classmethod
+    def latest_event_id(cls, _db):
+        return _db.query(func.max(CirculationEvent.id)).scalar() or 0
+
+    @classmethod
+    def stored(cls, _db):
+        """Find the statistics calculated by the last run.
+
+        :return: A dictionary, or None if the statistics have never
+          been calculated.
+        """
+        value = ConfigurationSetting.sitewide(_db, cls.STATS_KEY).value
+        if not value:
+            return None
+        return json.loads(value)
+
+    @classmethod
+    def store(cls, _db, stats):
+        ConfigurationSetting.sitewide(_db, cls.STATS_KEY).value = json.dumps(
+            stats
+        )
+
+    def apply_events(self, stats):
+        """Bring the statistics up to date using the circulation events
+        that have happened since they were calculated.
+
+        Loan and hold counts can't be kept up to date this way, since
+        loans expire and holds turn into loans without generating
+        events, so they're counted again. Those are cheap queries.
+
+        New license pools and patrons don't generate events either.
+        Those figures stay as they were at the last full refresh, and
+        get corrected at the next one.
+        """
+        now = datetime.datetime.now()
+        patrons = stats['patrons']
+        inventory = stats['inventory']
+        vendors = stats['vendors']
+        vendor_keys = dict((v, k) for k, v in self.VENDORS.items())
+
+        # An event about a license pool is recorded once for each of
+        # the libraries that use its collection. Those copies only
+        # count once.
+        qu = self._db.query(
+            func.max(CirculationEvent.id), CirculationEvent.type,
+            CirculationEvent.delta, LicensePool.open_access,
+            DataSource.name,
+        ).join(
+            CirculationEvent.license_pool
+        ).join(
+            LicensePool.data_source
+        ).filter(
+            CirculationEvent.id > stats['last_event_id']
+        ).group_by(
+            CirculationEvent.license_pool_id, CirculationEvent.type,
+            CirculationEvent.start, CirculationEvent.old_value,
+            CirculationEvent.new_value, CirculationEvent.delta,
+            CirculationEvent.foreign_patron_id, LicensePool.open_access,
+            DataSource.name,
+        )
+
+        last_event_id = stats['last_event_id']
+        for event_id, type, delta, open_access, data_source in qu:
+            last_event_id = max(last_event_id, event_id)
+            delta = delta or 0
+            if open_access:
+                # Open-access books aren't part of the license counts.
+                continue
+            if type in (CirculationEvent.DISTRIBUTOR_LICENSE_ADD,
+                          CirculationEvent.DISTRIBUTOR_LICENSE_REMOVE):
+                inventory['licenses'] += delta
+            elif type in (CirculationEvent.DISTRIBUTOR_CHECKIN,
+                          CirculationEvent.DISTRIBUTOR_CHECKOUT):
+                inventory['available_licenses'] += delta
+            elif (type in (CirculationEvent.DISTRIBUTOR_TITLE_ADD,
+                           CirculationEvent.DISTRIBUTOR_TITLE_REMOVE)
+                  and data_source in vendor_keys):
+                key = vendor_keys[data_source]
+                if type == CirculationEvent.DISTRIBUTOR_TITLE_ADD:
+                    vendors[key] = vendors.get(key, 0) + 1
+                else:
+                    vendors[key] = vendors.get(key, 0) - 1
+                if vendors[key] <= 0:
+                    del vendors[key]
+
+        patrons['loans'] = self.loan_count(self._db, now)
+        patrons['holds'] = self.hold_count(self._db)
+        for key in ('licenses', 'available_licenses'):
+            inventory[key] = max(inventory[key], 0)
+        stats['last_event_id'] = last_event_id
+        return stats
+
+    @classmethod
+    def loan_count(cls, _db, now):
+        return _db.query(
+            Loan
+        ).filter(
+            Loan.end >= now
+        ).count()
+
+    @classmethod
+    def hold_count(cls, _db):
+        return _db.query(Hold).count()
+
+    @classmethod
+    def calculate(cls, _db):
+        """Calculate all of the dashboard statistics from scratch."""
+        now = datetime.datetime.now()
+        patron_count = _db.query(Patron).count()
+
+        active_loans_patron_count = _db.query(
+            distinct(Patron.id)
+        ).join(
+            Patron.loans
+        ).filter(
+            Loan.end >= now,
+        ).count()
+
+        active_patrons = select(
+            [Patron.id]
+        ).select_from(
+            join(
+                Loan,
+                Patron,
+                and_(
+                    Patron.id == Loan.patron_id,
+                    Loan.id != None,
+                    Loan.end >= now
+                )
+            )
+        ).union(
+            select(
+                [Patron.id]
+            ).select_from(
+                join(
+                    Hold,
+                    Patron,
+                    Patron.id == Hold.patron_id
+                )
+            )
+        ).alias()
+
+        active_loans_or_holds_patron_count_query = select(
+            [func.count(distinct(active_patrons.c.id))]
+        ).select_from(
+            active_patrons
+        )
+
+        result = _db.execute(active_loans_or_holds_patron_count_query)
+        active_loans_or_holds_patron_count = [r[0] for r in result][0]
+
+        loan_count = cls.loan_count(_db, now)
+        hold_count = cls.hold_count(_db)
+
+        vendor_counts = dict()
+
+        for key, data_source in cls.VENDORS.iteritems():
+            data_source_count = _db.query(
+                LicensePool
+            ).join(
+                DataSource
+            ).filter(
+                LicensePool.licenses_owned > 0
+            ).filter(
+                DataSource.name == data_source
+            ).count()
+
+            if data_source_count > 0:
+                vendor_counts[key] = data_source_count
+
+        open_access_count = _db.query(
+            LicensePool
+         ).filter(
+            LicensePool.open_access == True
+         ).count()
+
+        if open_access_count > 0:
+            vendor_counts['open_access'] = open_access_count
+
+        title_count = _db.query(LicensePool).count()
+
+        # The sum queries return None instead of 0 if there are
+        # no license pools in the db.
+
+        license_count = _db.query(
+            func.sum(LicensePool.licenses_owned)
+        ).filter(
+            LicensePool.open_access == False,
+        ).all()[0][0] or 0
+
+        available_license_count = _db.query(
+            func.sum(LicensePool.licenses_available)
+        ).filter(
+            LicensePool.open_access == False,
+        ).all()[0][0] or 0
+
+        return dict(
+            patrons=dict(
+                total=patron_count,
+                with_active_loans=active_loans_patron_count,
+                with_active_loans_or_holds=active_loans_or_holds_patron_count,
+                loans=loan_count,
+                holds=hold_count,
+            ),
+            inventory=dict(
+                titles=title_count,
+                licenses=license_count,
+                available_licenses=available_license_count,
+            ),
+            vendors=vendor_counts,
+        )
@@ -1,3 +1,4 @@
+import datetime
 import json
 import logging
 import urllib
@@ -19,6 +20,7 @@ from core.metadata_layer import (
     SubjectData,
 )
 from core.model import (
+    ConfigurationSetting,
     DataSource,
     ExternalIntegration,
     Hyperlink,
@@ -28,15 +30,18 @@ from core.model import (
     Session,
     Subject,
     get_one,
+    get_one_or_create,
     Equivalency,
     LicensePool,
     Collection,
     Edition,
     Contributor,
     Contribution,
+    Work,
 )
 from core.util import TitleProcessor
 from sqlalchemy.sql import (
+    func,
     select,
     join,
     and_,
@@ -80,9 +85,34 @@ class NoveListAPI(object):
         "ISBN=%(ISBN)s&ClientIdentifier=%(ClientIdentifier)s&version=%(version)s"
     )
     COLLECTION_DATA_API = "http://www.noveListcollectiondata.com/api/collections"
+
+    # Collections are sent to the Collections API in batches this big.
+    UPLOAD_BATCH_SIZE = 1000
+
+    # A batch that fails is tried this many times in all.
+    UPLOAD_ATTEMPTS = 3
+
+    # The library setting that records when the last successful
+    # upload started.
+    LAST_UPLOAD_KEY = u"novelist_last_collection_upload"
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
     AUTH_PARAMS = "&profile=%(profile)s&password=%(password)s"
     MAX_REPRESENTATION_AGE = 7*24*60*60      # one week
 
+    # A book's recommendations, already filtered down to the books
+    # this circulation manager knows about, are kept in a
+    # Representation with a URL like this, so every process can
+    # share them.
+    RECOMMENDATIONS_URL = u"urn:librarysimplified.org/novelist/recommendations/%(library)s/%(identifier)s"
+    RECOMMENDATIONS_MAX_AGE = MAX_REPRESENTATION_AGE
+
+    # When NoveList has no recommendations for a book, we don't ask
+    # again for a day.
+    NO_RECOMMENDATIONS_MAX_AGE = 24*60*60
+
+    # How many works `prefetch_recommendations` looks at by default.
+    PREFETCH_LIMIT = 1000
+
     currentQueryIdentifier = None
 
     medium_to_book_format_type_values = {
@@ -254,6 +284,127 @@ class NoveListAPI(object):
 
         return self.lookup_info_to_metadata(representation)
 
+    def recommendations(self, library, identifier):
+        """Find the books NoveList recommends to a library's patrons who
+        liked a given book.
+
+        The answer comes from the recommendations cache if it's there,
+        and NoveList is only asked if it isn't.
+
+        :return: A list of Identifiers.
+        """
+        recommendations = self.cached_recommendations(library, identifier)
+        if recommendations is None:
+            recommendations = self.fetch_recommendations(identifier)
+            self.cache_recommendations(library, identifier, recommendations)
+        return recommendations
+
+    def fetch_recommendations(self, identifier):
+        """Ask NoveList for a book's recommendations, and keep the ones
+        for books we know about.
+
+        :return: A list of Identifiers.
+        """
+        metadata = self.lookup(identifier)
+        if not metadata:
+            return []
+        metadata.filter_recommendations(self._db)
+        return metadata.recommendations
+
+    def recommendations_representation(self, library, identifier,
+                                       autocreate=False):
+        url = self.RECOMMENDATIONS_URL % dict(
+            library=library.id, identifier=identifier.id
+        )
+        if autocreate:
+            representation, ignore = get_one_or_create(
+                self._db, Representation, url=url
+            )
+            return representation
+        return get_one(self._db, Representation, 'interchangeable', url=url)
+
+    def cached_recommendations(self, library, identifier):
+        """Find a book's recommendations in the cache.
+
+        :return: A list of Identifiers, or None if the recommendations
+          aren't cached or are too old.
+        """
+        representation = self.recommendations_representation(
+            library, identifier
+        )
+        if not representation or not representation.content:
+            return None
+        identifier_ids = json.loads(representation.content)
+        if identifier_ids:
+            max_age = self.RECOMMENDATIONS_MAX_AGE
+        else:
+            max_age = self.NO_RECOMMENDATIONS_MAX_AGE
+        age = datetime.datetime.utcnow() - representation.fetched_at
+        if age > datetime.timedelta(seconds=max_age):
+            return None
+
+        if not identifier_ids:
+            return []
+        identifiers = self._db.query(Identifier).filter(
+            Identifier.id.in_(identifier_ids)
+        )
+        by_id = dict((i.id, i) for i in identifiers)
+        return [by_id[i] for i in identifier_ids if i in by_id]
+
+    def cache_recommendations(self, library, identifier, recommendations):
+        """Store a book's recommendations in the cache. An empty list is
+        stored too, so that we don't keep asking NoveList about books
+        it has nothing to say about.
+        """
+        representation = self.recommendations_representation(
+            library, identifier, autocreate=True
+        )
+        representation.media_type = u"application/json"
+        representation.content = json.dumps(
+            [recommendation.id for recommendation in recommendations]
+        )
+        representation.fetched_at = datetime.datetime.utcnow()
+
+    def prefetch_recommendations(self, library, limit=None):
+        """Make sure the recommendations for a library's most popular
+        books are in the cache, so that patrons looking at those books
+        don't have to wait for NoveList.
+
+        A book's popularity is the number of its licenses on loan plus
+        the number of patrons waiting for it.
+
+        :return: The number of books whose recommendations were fetched.
+        """
+        limit = limit or self.PREFETCH_LIMIT
+        collection_ids = [c.id for c in library.collections]
+        if not collection_ids:
+            return 0
+
+        demand = func.sum(
+            LicensePool.licenses_owned - LicensePool.licenses_available
+            + LicensePool.patrons_in_hold_queue
+        )
+        identifiers = self._db.query(Identifier).join(
+            Edition, Edition.primary_identifier_id==Identifier.id
+        ).join(
+            Work, Work.presentation_edition_id==Edition.id
+        ).join(
+            LicensePool, LicensePool.work_id==Work.id
+        ).filter(
+            LicensePool.collection_id.in_(collection_ids)
+        ).group_by(Identifier.id).order_by(
+            demand.desc(), Identifier.id
+        ).limit(limit)
+
+        fetched = 0
+        for identifier in identifiers:
+            if self.cached_recommendations(library, identifier) is not None:
+                continue
+            recommendations = self.fetch_recommendations(identifier)
+            self.cache_recommendations(library, identifier, recommendations)
+            fetched += 1
+        return fetched
+
     @classmethod
     def review_response(cls, response):
         """Performs NoveList-specific error review of the request response"""
@@ -461,13 +612,21 @@ class NoveListAPI(object):
                 metadata.recommendations += self._extract_isbns(book_info)
         return metadata
 
-    def get_items_from_query(self, library):
+    def get_items_from_query(self, library, since=None):
         """Gets identifiers and its related title, medium, and authors from the
         database.
-        Keeps track of the current 'ISBN' identifier and current item object that
-        is being processed. If the next ISBN being processed is new, the existing one
-        gets added to the list of items. If the ISBN is the same, then we append
-        the Author property since there are multiple contributors.
+
+        :param since: Only include items whose works or license pools
+          have changed since this time.
+
+        :return: A list of items, as created by `items_from_query`.
+        """
+        return list(self.items_from_query(library, since))
+
+    def query_for_items(self, library, since=None):
+        """Build the query behind `items_from_query`. It finds one row
+        for every ISBN and contributor in the library's collections,
+        ordered by ISBN.
         """
         collectionList = []
         for c in library.collections:
@@ -479,13 +638,13 @@ class NoveListAPI(object):
         roles = list(Contributor.AUTHOR_ROLES)
         roles.append(Contributor.NARRATOR_ROLE)
 
-        isbnQuery = select(
-            [i1.identifier, i1.type, i2.identifier,
-            Edition.title, Edition.medium,
-            Contribution.role, Contributor.sort_name],
-        ).select_from(
-            join(LicensePool, i1, i1.id==LicensePool.identifier_id)
-            .join(Equivalency, i1.id==Equivalency.input_id, LEFT_OUTER_JOIN)
+        source = join(LicensePool, i1, i1.id==LicensePool.identifier_id)
+        if since:
+            source = source.join(
+                Work, Work.id==LicensePool.work_id, LEFT_OUTER_JOIN
+            )
+        source = (
+            source.join(Equivalency, i1.id==Equivalency.input_id, LEFT_OUTER_JOIN)
             .join(i2, Equivalency.output_id==i2.id, LEFT_OUTER_JOIN)
             .join(
                 Edition,
@@ -493,38 +652,61 @@ class NoveListAPI(object):
             )
             .join(Contribution, Edition.id==Contribution.edition_id)
             .join(Contributor, Contribution.contributor_id==Contributor.id)
-        ).where(
-            and_(
-                LicensePool.collection_id.in_(collectionList),
-                or_(i1.type=="ISBN", i2.type=="ISBN"),
-                or_(Contribution.role.in_(roles))
+        )
+
+        clauses = [
+            LicensePool.collection_id.in_(collectionList),
+            or_(i1.type=="ISBN", i2.type=="ISBN"),
+            or_(Contribution.role.in_(roles))
+        ]
+        if since:
+            clauses.append(
+                or_(
+                    LicensePool.availability_time > since,
+                    Work.last_update_time > since,
+                )
             )
+
+        return select(
+            [i1.identifier, i1.type, i2.identifier,
+            Edition.title, Edition.medium,
+            Contribution.role, Contributor.sort_name],
+        ).select_from(source).where(
+            and_(*clauses)
         ).order_by(i1.identifier, i2.identifier)
 
-        result = self._db.execute(isbnQuery)
+    def items_from_query(self, library, since=None):
+        """Yield the items to send to NoveList for a library, one at
+        a time.
+
+        The rows are read through a server-side cursor, and each item
+        is put together from the rows for its ISBN as they arrive, so
+        the whole collection is never in memory at once.
+        """
+        isbnQuery = self.query_for_items(library, since)
+        result = self._db.execute(
+            isbnQuery.execution_options(stream_results=True)
+        )
 
-        items = []
-        newItem = None
-        existingItem = None
+        # Keep track of the current ISBN and the item being built for
+        # it. When the next row has a new ISBN, the current item is
+        # done.
         currentIdentifier = None
-        for item in result:
-            if newItem:
-                existingItem = newItem
+        currentItem = None
+        for row in result:
             (currentIdentifier, existingItem, newItem, addItem) = (
-                self.create_item_object(item, currentIdentifier, existingItem)
+                self.create_item_object(row, currentIdentifier, currentItem)
             )
+            if addItem:
+                if currentItem:
+                    # The Role property isn't needed in the actual request.
+                    del currentItem['Role']
+                    yield currentItem
+                currentItem = newItem
 
-            if addItem and existingItem:
-                # The Role property isn't needed in the actual request.
-                del existingItem['Role']
-                items.append(existingItem)
-
-        # For the case when there's only one item in `result`
-        if newItem:
-            del newItem['Role']
-            items.append(newItem)
-
-        return items
+        if currentItem:
+            del currentItem['Role']
+            yield currentItem
 
     def create_item_object(self, object, currentIdentifier, existingItem):
         """Returns a new item if the current identifier that was processed
@@ -567,25 +749,105 @@ class NoveListAPI(object):
             )
             return (isbn, existingItem, newItem, True)
 
-    def put_items_novelist(self, library):
-        items = self.get_items_from_query(library)
+    def put_items_novelist(self, library, incremental=False,
+                           batch_size=None):
+        """Send a library's collection to NoveList.
 
-        content = None
-        if items:
-            response = self.put(
-                self.COLLECTION_DATA_API,
-                {
-                    "AuthorizedIdentifier": self.AUTHORIZED_IDENTIFIER,
-                    "Content-Type": "application/json; charset=utf-8"
-                },
-                data=json.dumps(self.make_novelist_data_object(items))
-            )
+        The items are uploaded in batches of `batch_size`, and a batch
+        that fails is retried a few times before giving up.
 
-            if (response.status_code == 200):
-                content = json.loads(response.content)
+        :param incremental: Only send items that have changed since
+          the last successful upload.
+
+        :return: NoveList's response to the upload, with the record
+          counts added up across all the batches, or None if nothing
+          was uploaded.
+        """
+        batch_size = batch_size or self.UPLOAD_BATCH_SIZE
+        last_upload = self.last_upload_setting(library)
+        since = None
+        if incremental and last_upload is not None:
+            since = last_upload.value
+            if since:
+                since = datetime.datetime.strptime(since, self.TIME_FORMAT)
+        upload_started = datetime.datetime.utcnow()
 
+        content = None
+        batch = []
+        for item in self.items_from_query(library, since):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                content = self.put_batch(batch, content)
+                if content is None:
+                    return None
+                batch = []
+        if batch:
+            content = self.put_batch(batch, content)
+            if content is None:
+                return None
+
+        if last_upload is not None:
+            last_upload.value = upload_started.strftime(self.TIME_FORMAT)
         return content
 
+    def last_upload_setting(self, library):
+        """The setting that records when the library's collection was
+        last sent to NoveList.
+        """
+        _db = Session.object_session(library)
+        integration = ExternalIntegration.lookup(
+            _db, ExternalIntegration.NOVELIST,
+            ExternalIntegration.METADATA_GOAL, library=library
+        )
+        if not integration:
+            return None
+        return ConfigurationSetting.for_library_and_externalintegration(
+            _db, self.LAST_UPLOAD_KEY, library, integration
+        )
+
+    def put_batch(self, items, content=None):
+        """Upload one batch of items, retrying if it fails.
+
+        :param content: NoveList's response to the earlier batches.
+
+        :return: `content` with this batch's record counts added,
+          or None if the batch couldn't be uploaded.
+        """
+        data = json.dumps(self.make_novelist_data_object(items))
+        for attempt in range(self.UPLOAD_ATTEMPTS):
+            try:
+                response = self.put(
+                    self.COLLECTION_DATA_API,
+                    {
+                        "AuthorizedIdentifier": self.AUTHORIZED_IDENTIFIER,
+                        "Content-Type": "application/json; charset=utf-8"
+                    },
+                    data=data
+                )
+            except Exception, e:
+                self.log.error(
+                    "Error uploading %d items to NoveList (attempt %d)",
+                    len(items), attempt+1, exc_info=e
+                )
+                continue
+
+            if (response.status_code == 200):
+                batch_content = json.loads(response.content)
+                if content is None:
+                    return batch_content
+                for key in ("RecordsReceived", "InvalidRecords"):
+                    if key in batch_content:
+                        content[key] = (
+                            content.get(key, 0) + batch_content[key]
+                        )
+                return content
+
+            self.log.error(
+                "NoveList rejected an upload of %d items (attempt %d): %s",
+                len(items), attempt+1, response.status_code
+            )
+        return None
+
     def make_novelist_data_object(self, items):
         return {
             "Customer": "%s:%s" % (self.profile, self.password),
@@ -615,6 +877,10 @@ class MockNoveListAPI(NoveListAPI):
         self.responses = self.responses[1:]
         return response
 
+    def recommendations(self, library, identifier):
+        # Every call uses the next queued response.
+        return self.fetch_recommendations(identifier)
+
 
 class NoveListCoverageProvider(IdentifierCoverageProvider):
 
@@ -2,6 +2,7 @@ from nose.tools import set_trace
 
 import base64
 import json
+import sys
 import uuid
 import datetime
 from flask_babel import lazy_gettext as _
@@ -12,7 +13,12 @@ from flask import Response
 import feedparser
 from lxml import etree
 from StringIO import StringIO
+from threading import Thread
 
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+)
 from sqlalchemy.sql.expression import or_
 
 from core.opds_import import (
@@ -66,6 +72,196 @@ from core.testing import (
 from circulation_exceptions import *
 from shared_collection import BaseSharedCollectionAPI
 
+class HoldQueue(object):
+    """A LicensePool's current loans and holds, loaded from the database
+    all at once, so that the position and end date of every hold in
+    the queue can be worked out without any more queries.
+    """
+
+    def __init__(self, licensepool, now=None, loans=None, holds=None):
+        """Constructor.
+
+        :param loans: The pool's current loans, if they've already
+          been loaded by `for_pools`.
+
+        :param holds: The pool's current holds, in the order they
+          were placed, if they've already been loaded by `for_pools`.
+        """
+        _db = Session.object_session(licensepool)
+        self.licensepool = licensepool
+        self.now = now or datetime.datetime.utcnow()
+
+        if loans is None:
+            loans = self.loans_query(
+                _db, [licensepool.id], self.now
+            ).all()
+        self.loans = loans
+
+        if holds is None:
+            holds = self.holds_query(
+                _db, [licensepool.id], self.now
+            ).all()
+        self.holds = holds
+
+    @classmethod
+    def loans_query(cls, _db, licensepool_ids, now):
+        """Find loans for the given pools that haven't ended yet."""
+        return _db.query(Loan).filter(
+            Loan.license_pool_id.in_(licensepool_ids)
+        ).filter(
+            or_(
+                Loan.end==None,
+                Loan.end>now
+            )
+        ).order_by(Loan.start)
+
+    @classmethod
+    def holds_query(cls, _db, licensepool_ids, now):
+        """Find holds for the given pools that are still in the queue
+        or whose reservations haven't expired yet, in the order they
+        were placed.
+        """
+        return _db.query(Hold).filter(
+            Hold.license_pool_id.in_(licensepool_ids)
+        ).filter(
+            or_(
+                Hold.end==None,
+                Hold.end>now,
+                Hold.position>0,
+            )
+        ).options(
+            # We'll need to know which library each patron belongs to.
+            joinedload(Hold.patron)
+        ).order_by(Hold.start)
+
+    @classmethod
+    def for_pools(cls, _db, licensepools, now=None):
+        """Load the queues for a number of LicensePools at once.
+
+        :return: A dictionary mapping LicensePool IDs to HoldQueues.
+        """
+        now = now or datetime.datetime.utcnow()
+        ids = [pool.id for pool in licensepools]
+        if not ids:
+            return {}
+        loans = defaultdict(list)
+        for loan in cls.loans_query(_db, ids, now):
+            loans[loan.license_pool_id].append(loan)
+        holds = defaultdict(list)
+        for hold in cls.holds_query(_db, ids, now):
+            holds[hold.license_pool_id].append(hold)
+        return dict(
+            (pool.id, cls(pool, now, loans[pool.id], holds[pool.id]))
+            for pool in licensepools
+        )
+
+    @property
+    def remaining_licenses(self):
+        """The number of licenses that aren't on loan."""
+        return self.licensepool.licenses_owned - len(self.loans)
+
+    def holds_before(self, hold):
+        """Count the holds in the queue that were placed before
+        the given hold.
+        """
+        count = 0
+        for other in self.holds:
+            if other.start >= hold.start:
+                break
+            count += 1
+        return count
+
+    def position(self, hold, holds_before=None):
+        """Find the position the given hold should have.
+
+        :return: 0 if a license is reserved for the hold, otherwise
+          the hold's place in line.
+        """
+        if holds_before is None:
+            holds_before = self.holds_before(hold)
+        if self.remaining_licenses > holds_before:
+            # The hold is ready to check out.
+            return 0
+        # Add 1 since position 0 indicates the hold is ready.
+        return holds_before + 1
+
+    def update(self, hold, default_loan_period, default_reservation_period,
+               holds_before=None):
+        """Update a hold's position and end date.
+
+        :param default_loan_period: The number of days a patron can keep
+          a book, for the library or integration client that placed
+          the hold.
+
+        :param default_reservation_period: The number of days a patron
+          has to check out a book once it's reserved for them.
+        """
+        original_position = hold.position
+        position = self.position(hold, holds_before)
+        if hold.position != position:
+            hold.position = position
+
+        # If the hold was already to check out and already has an end date,
+        # it doesn't need an update.
+        if position == 0 and original_position == 0 and hold.end:
+            return
+
+        # If the patron is in the queue, we need to estimate when the book
+        # will be available for check out. We can do slightly better than the
+        # default calculation since we know when all current loans will expire,
+        # but we're still calculating the worst case.
+        elif position > 0:
+            end = self.estimated_end(
+                position, default_loan_period, default_reservation_period
+            )
+            if end and hold.end != end:
+                hold.end = end
+
+        # If the end date isn't set yet or the position just became 0, the
+        # hold just became available. The patron's reservation period starts now.
+        else:
+            hold.end = self.now + datetime.timedelta(days=default_reservation_period)
+
+    def estimated_end(self, position, default_loan_period,
+                      default_reservation_period):
+        """Estimate when a hold at the given position will get a
+        license, in the worst case.
+
+        :return: A datetime, or None if there's no way to tell.
+        """
+        pool = self.licensepool
+        if pool.licenses_owned < 1:
+            return None
+        licenses_reserved = min(self.remaining_licenses, len(self.holds))
+        current_reservations = self.holds[:licenses_reserved]
+
+        # The licenses will have to go through some number of cycles
+        # before one of them gets to this hold. This leavs out the first cycle -
+        # it's already started so we'll handle it separately.
+        cycles = (position - licenses_reserved - 1) / pool.licenses_owned
+
+        # Each of the owned licenses is currently either on loan or reserved.
+        # Figure out which license this hold will eventually get if every
+        # patron keeps their loans and holds for the maximum time.
+        copy_index = (position - licenses_reserved - 1)  % pool.licenses_owned
+
+        # In the worse case, the first cycle ends when a current loan expires, or
+        # after a current reservation is checked out and then expires.
+        if len(self.loans) > copy_index:
+            next_cycle_start = self.loans[copy_index].end
+        else:
+            reservation = current_reservations[copy_index - len(self.loans)]
+            if not reservation.end:
+                return None
+            next_cycle_start = reservation.end + datetime.timedelta(days=default_loan_period)
+        if not next_cycle_start:
+            return None
+
+        # Assume all cycles after the first cycle take the maximum time.
+        cycle_period = default_loan_period + default_reservation_period
+        return next_cycle_start + datetime.timedelta(days=(cycle_period * cycles))
+
+
 class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
     """ODL (Open Distribution to Libraries) is a specification that allows
     libraries to manage their own loans and holds. It offers a deeper level
@@ -440,139 +636,49 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
     def _count_holds_before(self, hold):
         # Count holds on the license pool that started before this hold and
         # aren't expired.
-        _db = Session.object_session(hold)
-        return _db.query(Hold).filter(
-            Hold.license_pool_id==hold.license_pool_id
-        ).filter(
-            Hold.start<hold.start
-        ).filter(
-            or_(
-                Hold.end==None,
-                Hold.end>datetime.datetime.utcnow(),
-                Hold.position>0,
-            )
-        ).count()
+        return HoldQueue(hold.license_pool).holds_before(hold)
 
-    def _update_hold_end_date(self, hold):
+    def _update_hold_end_date(self, hold, queue=None):
         _db = Session.object_session(hold)
-        pool = hold.license_pool
-
-        # First make sure the hold position is up-to-date, since we'll
-        # need it to calculate the end date.
-        original_position = hold.position
-        self._update_hold_position(hold)
-
-        default_loan_period = self.collection(_db).default_loan_period(
-            hold.library or hold.integration_client
+        queue = queue or HoldQueue(hold.license_pool)
+        collection = self.collection(_db)
+        queue.update(
+            hold,
+            collection.default_loan_period(
+                hold.library or hold.integration_client
+            ),
+            collection.default_reservation_period
         )
-        default_reservation_period = self.collection(_db).default_reservation_period
-
-        # If the hold was already to check out and already has an end date,
-        # it doesn't need an update.
-        if hold.position == 0 and original_position == 0 and hold.end:
-            return
-
-        # If the patron is in the queue, we need to estimate when the book
-        # will be available for check out. We can do slightly better than the
-        # default calculation since we know when all current loans will expire,
-        # but we're still calculating the worst case.
-        elif hold.position > 0:
-            # Find the current loans and reserved holds for the licenses.
-            current_loans = _db.query(Loan).filter(
-                Loan.license_pool_id==pool.id
-            ).filter(
-                or_(
-                    Loan.end==None,
-                    Loan.end>datetime.datetime.utcnow()
-                )
-            ).order_by(Loan.start).all()
-            current_holds = _db.query(Hold).filter(
-                Hold.license_pool_id==pool.id
-            ).filter(
-                or_(
-                    Hold.end==None,
-                    Hold.end>datetime.datetime.utcnow(),
-                    Hold.position>0,
-                )
-            ).order_by(Hold.start).all()
-            licenses_reserved = min(pool.licenses_owned - len(current_loans), len(current_holds))
-            current_reservations = current_holds[:licenses_reserved]
-
-            # The licenses will have to go through some number of cycles
-            # before one of them gets to this hold. This leavs out the first cycle -
-            # it's already started so we'll handle it separately.
-            cycles = (hold.position - licenses_reserved - 1) / pool.licenses_owned
-
-            # Each of the owned licenses is currently either on loan or reserved.
-            # Figure out which license this hold will eventually get if every
-            # patron keeps their loans and holds for the maximum time.
-            copy_index = (hold.position - licenses_reserved - 1)  % pool.licenses_owned
-
-            # In the worse case, the first cycle ends when a current loan expires, or
-            # after a current reservation is checked out and then expires.
-            if len(current_loans) > copy_index:
-                next_cycle_start = current_loans[copy_index].end
-            else:
-                reservation = current_reservations[copy_index - len(current_loans)]
-                next_cycle_start = reservation.end + datetime.timedelta(days=default_loan_period)
-
-            # Assume all cycles after the first cycle take the maximum time.
-            cycle_period = default_loan_period + default_reservation_period
-            hold.end = next_cycle_start + datetime.timedelta(days=(cycle_period * cycles))
-
-        # If the end date isn't set yet or the position just became 0, the
-        # hold just became available. The patron's reservation period starts now.
-        else:
-            hold.end = datetime.datetime.utcnow() + datetime.timedelta(days=default_reservation_period)
-
-    def _update_hold_position(self, hold):
-        _db = Session.object_session(hold)
-        pool = hold.license_pool
-        loans_count = _db.query(Loan).filter(
-            Loan.license_pool_id==pool.id,
-        ).filter(
-            or_(
-                Loan.end==None,
-                Loan.end > datetime.datetime.utcnow()
-            )
-        ).count()
-        holds_count = self._count_holds_before(hold)
-
-        remaining_licenses = pool.licenses_owned - loans_count
-
-        if remaining_licenses > holds_count:
-            # The hold is ready to check out.
-            hold.position = 0
-
-        else:
-            # Add 1 since position 0 indicates the hold is ready.
-            hold.position = holds_count + 1
 
-    def update_hold_queue(self, licensepool):
-        # Update the pool and the next holds in the queue when a license is reserved.
+    def _update_hold_position(self, hold, queue=None):
+        queue = queue or HoldQueue(hold.license_pool)
+        position = queue.position(hold)
+        if hold.position != position:
+            hold.position = position
+
+    def update_hold_queue(self, licensepool, queue=None, licenses_owned=None):
+        # Update the pool and every hold in the queue when a license is
+        # reserved. The pool's loans and holds are loaded once, and
+        # everything else is worked out from them.
+        #
+        # `queue` is the pool's HoldQueue, if it's already been loaded.
+        # `licenses_owned` is a new number of licenses for the pool.
         _db = Session.object_session(licensepool)
-
-        loans_count = _db.query(Loan).filter(
-            Loan.license_pool_id==licensepool.id
-        ).filter(
-            or_(
-                Loan.end==None,
-                Loan.end>datetime.datetime.utcnow()
-            )
-        ).count()
-        remaining_licenses = licensepool.licenses_owned - loans_count
-
-        holds = _db.query(Hold).filter(
-            Hold.license_pool_id==licensepool.id
-        ).filter(
-            or_(
-                Hold.end==None,
-                Hold.end>datetime.datetime.utcnow(),
-                Hold.position>0,
+        if (licenses_owned is not None
+            and licenses_owned != licensepool.licenses_owned):
+            # Record the new number of licenses first, the way
+            # CirculationData would; availability is worked out below.
+            licensepool.update_availability(
+                licenses_owned,
+                licensepool.licenses_available,
+                licensepool.licenses_reserved,
+                licensepool.patrons_in_hold_queue,
+                analytics=self.analytics,
+                as_of=datetime.datetime.utcnow(),
             )
-        ).order_by(
-            Hold.start
-        ).all()
+        queue = queue or HoldQueue(licensepool)
+        remaining_licenses = queue.remaining_licenses
+        holds = queue.holds
 
         if len(holds) > remaining_licenses:
             new_licenses_available = 0
@@ -590,11 +696,28 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
             analytics=self.analytics,
             as_of=datetime.datetime.utcnow(),
         )
+        if not holds:
+            return
 
-        for hold in holds[:licensepool.licenses_reserved]:
-            if hold.position != 0:
-                # This hold just got a reserved license.
-                self._update_hold_end_date(hold)
+        collection = self.collection(_db)
+        default_reservation_period = collection.default_reservation_period
+        loan_periods = {}
+
+        # The holds are in the order they were placed, so each hold's
+        # place in line is the number of holds placed before it.
+        holds_before = 0
+        for i, hold in enumerate(holds):
+            if i > 0 and holds[i-1].start < hold.start:
+                holds_before = i
+            borrower = hold.library or hold.integration_client
+            if borrower not in loan_periods:
+                loan_periods[borrower] = collection.default_loan_period(
+                    borrower
+                )
+            queue.update(
+                hold, loan_periods[borrower], default_reservation_period,
+                holds_before=holds_before
+            )
 
     def place_hold(self, patron, pin, licensepool, notification_email_address):
         """Create a new hold."""
@@ -727,6 +850,53 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
         # Update licenses available and reserved based on existing loans and holds.
         self.update_hold_queue(pool)
 
+    def update_consolidated_copies(self, _db, copies, analytics=None):
+        """Process a page of copies from the consolidated copies feed
+        at once.
+
+        The LicensePools for every copy on the page are found with a
+        single query, and their loans and holds with one more query
+        each. Copies that don't have a LicensePool yet go through
+        `update_consolidated_copy`, which creates one.
+        """
+        licenses_by_identifier = dict()
+        for copy_info in copies:
+            identifier = copy_info.get("identifier")
+            if identifier:
+                licenses_by_identifier[identifier] = copy_info.get("licenses")
+        if not licenses_by_identifier:
+            return
+
+        data_source = DataSource.lookup(_db, self.data_source_name)
+        pools = _db.query(LicensePool).join(
+            LicensePool.identifier
+        ).filter(
+            LicensePool.collection_id==self.collection_id
+        ).filter(
+            LicensePool.data_source==data_source
+        ).filter(
+            Identifier.type==Identifier.URI
+        ).filter(
+            Identifier.identifier.in_(licenses_by_identifier.keys())
+        ).options(
+            contains_eager(LicensePool.identifier)
+        ).all()
+
+        queues = HoldQueue.for_pools(_db, pools)
+        for pool in pools:
+            identifier = pool.identifier.identifier
+            licenses = licenses_by_identifier.pop(identifier)
+            self.update_hold_queue(
+                pool, queue=queues[pool.id], licenses_owned=licenses
+            )
+
+        # Whatever is left doesn't have a LicensePool yet.
+        for identifier, licenses in licenses_by_identifier.items():
+            self.update_consolidated_copy(
+                _db, dict(identifier=identifier, licenses=licenses),
+                analytics
+            )
+
     def update_loan(self, loan, status_doc=None):
         """Check a loan's status, and if it is no longer active, delete the loan
         and update its pool's availability.
@@ -840,6 +1010,10 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
 
     OVERLAP = datetime.timedelta(minutes=5)
 
+    # The integration setting that holds the next page of the feed
+    # if the last run was interrupted.
+    CHECKPOINT_KEY = "consolidated_copies_checkpoint"
+
     def __init__(self, _db, collection=None, api=None, **kwargs):
         super(ODLConsolidatedCopiesMonitor, self).__init__(_db, collection, **kwargs)
 
@@ -856,33 +1030,90 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
 
             url += "?since=%s" % (start.isoformat() + 'Z')
 
+        # If an earlier run was interrupted partway through the feed,
+        # pick up where it left off.
+        checkpoint = self.checkpoint
+        if checkpoint.value:
+            url = checkpoint.value
+
         # Go through the consolidated copies feed until we get to a page
-        # with no next link.
-        while url:
-            response = self.api._get(url)
-            next_url = self.process_one_page(response)
+        # with no next link. While one page is being processed, the
+        # next one is fetched in the background.
+        page = PrefetchedPage(self.api, url)
+        while page:
+            content = json.loads(page.response().content)
+            next_url = self.next_url(content)
             if next_url:
                 # Make sure the next url is an absolute url.
-                url = urlparse.urljoin(url, next_url)
+                next_url = urlparse.urljoin(page.url, next_url)
+                next_page = PrefetchedPage(self.api, next_url)
             else:
-                url = None
+                next_page = None
 
-    def process_one_page(self, response):
-        content = json.loads(response.content)
+            self.process_copies(content)
 
-        # Process each copy in the response and return the next link
-        # if there is one.
+            # Save our progress, so an interrupted run doesn't have
+            # to start over.
+            checkpoint.value = next_url
+            self._db.commit()
+            page = next_page
+
+    @property
+    def checkpoint(self):
+        """The setting that keeps track of the next page of the feed
+        to process, if a run didn't make it to the end.
+        """
+        return ConfigurationSetting.for_externalintegration(
+            self.CHECKPOINT_KEY, self.collection.external_integration
+        )
+
+    def next_url(self, content):
         next_url = None
         links = content.get("links") or []
         for link in links:
             if link.get("rel") == "next":
                 next_url = link.get("href")
+        return next_url
 
+    def process_copies(self, content):
         copies = content.get("copies") or []
-        for copy in copies:
-            self.api.update_consolidated_copy(self._db, copy, self.analytics)
+        self.api.update_consolidated_copies(self._db, copies, self.analytics)
 
-        return next_url
+    def process_one_page(self, response):
+        content = json.loads(response.content)
+
+        # Process each copy in the response and return the next link
+        # if there is one.
+        self.process_copies(content)
+        return self.next_url(content)
+
+class PrefetchedPage(object):
+    """A page of a feed that's being fetched in the background."""
+
+    def __init__(self, api, url):
+        self.url = url
+        self._response = None
+        self._exc_info = None
+        self.thread = Thread(target=self._fetch, args=(api,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fetch(self, api):
+        try:
+            self._response = api._get(self.url)
+        except Exception, e:
+            self._exc_info = sys.exc_info()
+
+    def response(self):
+        """Wait for the page to arrive.
+
+        :return: The response, or raise whatever exception the request
+          raised.
+        """
+        self.thread.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._response
 
 class ODLHoldReaper(CollectionMonitor):
     """Check for holds that have expired and delete them, and update
@@ -908,10 +1139,13 @@ class ODLHoldReaper(CollectionMonitor):
         )
 
         changed_pools = set()
-        for hold in expired_holds:
+        for hold in expired_holds.options(contains_eager(Hold.license_pool)):
             changed_pools.add(hold.license_pool)
             self._db.delete(hold)
+        self._db.flush()
 
+        # Each pool's queue is worked out once, no matter how many of
+        # its holds expired.
         for pool in changed_pools:
             self.api.update_hold_queue(pool)
 
@@ -2,12 +2,20 @@ import urllib
 import copy
 import logging
 from nose.tools import set_trace
-from flask import url_for
+from flask import (
+    has_request_context,
+    request,
+    url_for,
+)
 from lxml import etree
 from collections import defaultdict
 import uuid
 
-from sqlalchemy.orm import lazyload
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    subqueryload,
+)
 
 from core.cdn import cdnify
 from core.classifier import Classifier
@@ -24,9 +32,11 @@ from core.model import (
     Credential,
     DataSource,
     DeliveryMechanism,
+    Hold,
     Identifier,
     LicensePool,
     LicensePoolDeliveryMechanism,
+    Loan,
     Patron,
     Session,
     BaseMaterializedWork,
@@ -50,12 +60,68 @@ from circulation import BaseCirculationAPI
 from config import Configuration
 from novelist import NoveListAPI
 
+class AcquisitionLinkCache(object):
+    """A cache of the acquisition links generated for LicensePools,
+    for use when a patron has no loan, hold or fulfillment for the
+    book in question.
+
+    In that case the links depend only on the library and the state
+    of the LicensePool, so there's no need to generate them again
+    for every feed that mentions the book. A cache entry is thrown
+    away as soon as the LicensePool's availability changes.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.links = {}
+
+    @classmethod
+    def availability_version(cls, license_pool):
+        """Summarize everything about a LicensePool that can change
+        its acquisition links.
+        """
+        mechanisms = tuple(
+            (lpdm.delivery_mechanism_id, lpdm.resource_id,
+             lpdm.rights_status_id)
+            for lpdm in license_pool.delivery_mechanisms
+        )
+        return (
+            license_pool.open_access, license_pool.licenses_owned,
+            license_pool.licenses_available, license_pool.licenses_reserved,
+            license_pool.patrons_in_hold_queue, mechanisms
+        )
+
+    def get(self, key, license_pool):
+        """Find cached copies of the links for a LicensePool.
+
+        :return: A list of <link> tags, or None if nothing up-to-date
+        was cached.
+        """
+        cached = self.links.get(key)
+        if not cached:
+            return None
+        version, links = cached
+        if version != self.availability_version(license_pool):
+            return None
+        return [copy.deepcopy(x) for x in links]
+
+    def set(self, key, license_pool, links):
+        """Cache copies of the links for a LicensePool."""
+        if len(self.links) >= self.max_size and key not in self.links:
+            self.links = {}
+        self.links[key] = (
+            self.availability_version(license_pool),
+            [copy.deepcopy(x) for x in links]
+        )
+
+
 class CirculationManagerAnnotator(Annotator):
 
     def __init__(self, lane,
                  active_loans_by_work={}, active_holds_by_work={},
                  active_fulfillments_by_work={},
-                 test_mode=False):
+                 test_mode=False, acquisition_link_cache=None,
+                 url_builder=None, cdn_url_builder=None):
         if lane:
             logger_name = "Circulation Manager Annotator for %s" % lane.display_name
         else:
@@ -66,6 +132,9 @@ class CirculationManagerAnnotator(Annotator):
         self.active_holds_by_work = active_holds_by_work
         self.active_fulfillments_by_work = active_fulfillments_by_work
         self.test_mode = test_mode
+        self.acquisition_link_cache = acquisition_link_cache
+        self.url_builder = url_builder
+        self.cdn_url_builder = cdn_url_builder
 
     def _lane_identifier(self, lane):
         if isinstance(lane, Lane):
@@ -88,15 +157,29 @@ class CirculationManagerAnnotator(Annotator):
                 if not k.startswith('_'):
                     new_kwargs[k] = v
             return self.test_url_for(False, *args, **new_kwargs)
+        elif self.url_builder:
+            return self.url_builder.url_for(
+                url_root=self._url_root(), *args, **kwargs
+            )
         else:
             return url_for(*args, **kwargs)
 
     def cdn_url_for(self, *args, **kwargs):
         if self.test_mode:
             return self.test_url_for(True, *args, **kwargs)
+        elif self.cdn_url_builder:
+            return self.cdn_url_builder.url_for(
+                url_root=self._url_root(), *args, **kwargs
+            )
         else:
             return cdn_url_for(*args, **kwargs)
 
+    def _url_root(self):
+        """The root URL of the current request, if any."""
+        if has_request_context():
+            return request.url_root
+        return None
+
     def test_url_for(self, cdn=False, *args, **kwargs):
         # Generate a plausible-looking URL that doesn't depend on Flask
         # being set up.
@@ -156,14 +239,43 @@ class CirculationManagerAnnotator(Annotator):
         active_fulfillment = self.active_fulfillments_by_work.get(work)
 
         # Now we need to generate a <link> tag for every delivery mechanism
-        # that has well-defined media types.
+        # that has well-defined media types. If the patron has no
+        # relationship with this book, the links may have been
+        # generated already for some other feed.
+        cache_key = None
+        if (self.acquisition_link_cache is not None and active_license_pool
+            and not (active_loan or active_hold or active_fulfillment)):
+            cache_key = self.acquisition_link_cache_key(active_license_pool)
+            link_tags = self.acquisition_link_cache.get(
+                cache_key, active_license_pool
+            )
+            if link_tags is not None:
+                entry.extend(link_tags)
+                return
+
         link_tags = self.acquisition_links(
             active_license_pool, active_loan, active_hold, active_fulfillment,
             feed, identifier
         )
+        if cache_key is not None:
+            self.acquisition_link_cache.set(
+                cache_key, active_license_pool, link_tags
+            )
         for tag in link_tags:
             entry.append(tag)
 
+    def acquisition_link_cache_key(self, license_pool):
+        """The key under which to cache the acquisition links for
+        a LicensePool, when the patron has no loan or hold on it.
+        """
+        # The links are absolute URLs, so they depend on the hostname
+        # used to make the request.
+        if self.test_mode:
+            url_root = None
+        else:
+            url_root = self._url_root()
+        return (license_pool.id, self.test_mode, url_root)
+
     def acquisition_links(
             self, active_license_pool, active_loan, active_hold,
             active_fulfillment, feed, identifier, can_hold=True,
@@ -397,7 +509,10 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                  facet_view='feed',
                  test_mode=False,
                  top_level_title="All Books",
-                 library_identifies_patrons = True
+                 library_identifies_patrons = True,
+                 acquisition_link_cache=None,
+                 url_builder=None, cdn_url_builder=None,
+                 authdata_utilities=None
     ):
         """Constructor.
 
@@ -412,11 +527,26 @@ class LibraryAnnotator(CirculationManagerAnnotator):
           on the configured collections, some extra links may be
           added, for direct acquisition of titles that would normally
           require a loan.
+
+        :param acquisition_link_cache: An AcquisitionLinkCache to use
+          for acquisition links that don't depend on the patron.
+
+        :param url_builder: A URLTemplateBuilder to use instead of
+          url_for.
+
+        :param cdn_url_builder: A URLTemplateBuilder to use instead of
+          cdn_url_for.
+
+        :param authdata_utilities: A dictionary mapping library IDs to
+          preloaded AuthdataUtility objects.
         """
         super(LibraryAnnotator, self).__init__(lane, active_loans_by_work=active_loans_by_work,
                                                active_holds_by_work=active_holds_by_work,
                                                active_fulfillments_by_work=active_fulfillments_by_work,
-                                               test_mode=test_mode)
+                                               test_mode=test_mode,
+                                               acquisition_link_cache=acquisition_link_cache,
+                                               url_builder=url_builder,
+                                               cdn_url_builder=cdn_url_builder)
         self.circulation = circulation
         self.library = library
         self.patron = patron
@@ -425,10 +555,17 @@ class LibraryAnnotator(CirculationManagerAnnotator):
         self._adobe_id_tags = {}
         self._top_level_title = top_level_title
         self.identifies_patrons = library_identifies_patrons
+        self.authdata_utilities = authdata_utilities
 
     def top_level_title(self):
         return self._top_level_title
 
+    def acquisition_link_cache_key(self, license_pool):
+        key = super(LibraryAnnotator, self).acquisition_link_cache_key(
+            license_pool
+        )
+        return (self.library.id, self.identifies_patrons) + key
+
     def permalink_for(self, work, license_pool, identifier):
         url = self.url_for(
             'permalink',
@@ -983,7 +1120,9 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                     patron_identifier
                 )
             cached = []
-            authdata = AuthdataUtility.from_config(self.library)
+            authdata = AuthdataUtility.for_library(
+                self.library, self.authdata_utilities
+            )
             if authdata:
                 # TODO: We would like to call encode() here, and have
                 # the client use a JWT as authdata, but we can't,
@@ -1215,38 +1354,82 @@ class SharedCollectionAnnotator(CirculationManagerAnnotator):
 class LibraryLoanAndHoldAnnotator(LibraryAnnotator):
 
     @classmethod
-    def active_loans_for(cls, circulation, patron, test_mode=False):
+    def active_loans_for(cls, circulation, patron, test_mode=False,
+                         authdata_utilities=None):
         db = Session.object_session(patron)
+        loans, holds = cls.preload_loans_and_holds(patron)
+        works = []
         active_loans_by_work = {}
-        for loan in patron.loans:
+        for loan in loans:
             work = loan.work
             if work:
                 active_loans_by_work[work] = loan
+                works.append(work)
         active_holds_by_work = {}
-        for hold in patron.holds:
+        for hold in holds:
             work = hold.work
             if work:
                 active_holds_by_work[work] = hold
+                works.append(work)
 
         annotator = cls(
             circulation, None, patron.library, patron, active_loans_by_work, active_holds_by_work,
-            test_mode=test_mode
+            test_mode=test_mode, authdata_utilities=authdata_utilities
         )
         url = annotator.url_for('active_loans', library_short_name=patron.library.short_name, _external=True)
-        works = patron.works_on_loan_or_on_hold()
+        works = set(works)
 
         feed_obj = AcquisitionFeed(db, "Active loans and holds", url, works, annotator)
         annotator.annotate_feed(feed_obj, None)
         return feed_obj
 
     @classmethod
-    def single_loan_feed(cls, circulation, loan, test_mode=False):
+    def preload_loans_and_holds(cls, patron):
+        """Load a patron's loans and holds, along with everything
+        needed to build their OPDS entries, in a fixed number of
+        queries.
+
+        :return: A 2-tuple (loans, holds).
+        """
+        db = Session.object_session(patron)
+
+        def options():
+            def pool():
+                return joinedload("license_pool")
+            def mechanisms():
+                return pool().subqueryload(LicensePool.delivery_mechanisms)
+            return [
+                pool().joinedload(LicensePool.identifier),
+                pool().joinedload(LicensePool.presentation_edition),
+                pool().joinedload(LicensePool.work).joinedload(
+                    Work.presentation_edition
+                ),
+                mechanisms().joinedload(
+                    LicensePoolDeliveryMechanism.delivery_mechanism
+                ),
+                mechanisms().joinedload(
+                    LicensePoolDeliveryMechanism.resource
+                ),
+            ]
+
+        loans = db.query(Loan).filter(Loan.patron==patron).options(
+            joinedload(Loan.fulfillment), *options()
+        ).all()
+        holds = db.query(Hold).filter(Hold.patron==patron).options(
+            *options()
+        ).all()
+        return loans, holds
+
+    @classmethod
+    def single_loan_feed(cls, circulation, loan, test_mode=False,
+                         authdata_utilities=None):
         db = Session.object_session(loan)
         work = loan.license_pool.work or loan.license_pool.presentation_edition.work
         annotator = cls(circulation, None, loan.library,
                         active_loans_by_work={work:loan},
                         active_holds_by_work={},
-                        test_mode=test_mode)
+                        test_mode=test_mode,
+                        authdata_utilities=authdata_utilities)
         identifier = loan.license_pool.identifier
         url = annotator.url_for(
             'loan_or_hold_detail',
@@ -1271,14 +1454,16 @@ class LibraryLoanAndHoldAnnotator(LibraryAnnotator):
         return AcquisitionFeed.single_entry(db, work, annotator)
 
     @classmethod
-    def single_fulfillment_feed(cls, circulation, loan, fulfillment, test_mode=False):
+    def single_fulfillment_feed(cls, circulation, loan, fulfillment, test_mode=False,
+                                authdata_utilities=None):
         db = Session.object_session(loan)
         work = loan.license_pool.work or loan.license_pool.presentation_edition.work
         annotator = cls(circulation, None, loan.library,
                         active_loans_by_work={},
                         active_holds_by_work={},
                         active_fulfillments_by_work={work:fulfillment},
-                        test_mode=test_mode)
+                        test_mode=test_mode,
+                        authdata_utilities=authdata_utilities)
         identifier = loan.license_pool.identifier
         url = annotator.url_for(
             'loan_or_hold_detail',
@@ -5,7 +5,10 @@ from api.authenticator import (
     BasicAuthenticationProvider,
     PatronData,
 )
-from api.sip.client import SIPClient
+from api.sip.client import (
+    SIPClient,
+    SIPClientPool,
+)
 from core.util.http import RemoteIntegrationException
 from core.util import MoneyUtility
 from core.model import ExternalIntegration
@@ -20,7 +23,8 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
     PORT = "port"
     LOCATION_CODE = "location code"
     FIELD_SEPARATOR = "field separator"
-    
+    CONNECTION_POOL_SIZE = "connection pool size"
+
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("Server") },
         { "key": PORT, "label": _("Port") },
@@ -30,6 +34,11 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         { "key": FIELD_SEPARATOR, "label": _("Field Separator"),
           "default": "|",
         },
+        { "key": CONNECTION_POOL_SIZE,
+          "label": _("Maximum number of simultaneous connections to the SIP server"),
+          "type": "number",
+          "default": 1,
+        },
     ] + BasicAuthenticationProvider.SETTINGS
     
     # Map the reasons why SIP2 might report a patron is blocked to the
@@ -74,12 +83,17 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         "Variable-length fields" in the SIP2 spec). If no value is
         specified, the default (the pipe character) will be used.
 
-        :param client: A drop-in replacement for the SIPClient
+        :param connection_pool_size: The maximum number of SIP
+        connections to keep open. Each patron authentication uses one
+        connection for the duration of the request, so this is also
+        the number of authentications that can happen at once.
+
+        :param client: A drop-in replacement for the SIPClientPool
         object. Only intended for use during testing.
 
-        :param connect: If this is false, the generated SIPClient will
-        not attempt to connect to the server. Only intended for use
-        during testing.
+        :param connect: If this is false, the generated SIPClientPool
+        will not attempt to connect to the server. Only intended for
+        use during testing.
         """
         super(SIP2AuthenticationProvider, self).__init__(
             library, integration, analytics
@@ -97,7 +111,10 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
                 location_code = integration.setting(self.LOCATION_CODE).value
                 field_separator = integration.setting(
                     self.FIELD_SEPARATOR).value or '|'
-                client = SIPClient(
+                pool_size = integration.setting(
+                    self.CONNECTION_POOL_SIZE).int_value or 1
+                client = SIPClientPool(
+                    size=pool_size,
                     target_server=server, target_port=port,
                     login_user_id=login_user_id, login_password=login_password,
                     location_code=location_code, separator=field_separator,
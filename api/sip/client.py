@@ -77,6 +77,18 @@ fixed._add('recall_items_count', 4)
 fixed._add('unavailable_holds_count', 4)
 fixed._add('login_ok', 1)
 
+# Fixed-width fields found in the ACS status response.
+fixed._add('online_status', 1)
+fixed._add('checkin_ok', 1)
+fixed._add('checkout_ok', 1)
+fixed._add('acs_renewal_policy', 1)
+fixed._add('status_update_ok', 1)
+fixed._add('offline_ok', 1)
+fixed._add('timeout_period', 3)
+fixed._add('retries_allowed', 3)
+fixed._add('date_time_sync', 18)
+fixed._add('protocol_version', 4)
+
 class named(object):
     """A variable-length field in a SIP2 response."""
     def __init__(self, internal_name, sip_code, required=False,
@@ -153,6 +165,9 @@ named._add("sequence_number", "AY")
 # but I have seen it happen.
 named._add("screen_message", "AF", allow_multiple=True)
 named._add("print_line", "AG")
+named._add("library_name", "AM")
+named._add("supported_messages", "BX")
+named._add("terminal_location", "AN")
 
 # SIP extensions defined by Georgia Public Library Service's SIP
 # server, used by Evergreen and Koha.
@@ -292,6 +307,17 @@ class SIPClient(Constants):
             *args, **kwargs
         )
             
+    def sc_status(self, *args, **kwargs):
+        """Ask the SIP server for its status.
+
+        This is a cheap request, useful for checking that a
+        connection is still usable.
+        """
+        return self.make_request(
+            self.sc_status_message, self.acs_status_parser,
+            *args, **kwargs
+        )
+
     def connect(self):
         """Create a socket connection to a SIP server."""
         with self.socket_lock:
@@ -312,6 +338,18 @@ class SIPClient(Constants):
             self.socket = sock
         return sock
 
+    def disconnect(self):
+        """Close the socket connection to the SIP server, if any."""
+        with self.socket_lock:
+            sock = getattr(self, 'socket', None)
+            if sock:
+                try:
+                    sock.close()
+                except socket.error, e:
+                    pass
+            self.socket = None
+            self.reset_connection_state()
+
     def reset_connection_state(self):
         """Reset connection-specific state.
 
@@ -405,6 +443,41 @@ class SIPClient(Constants):
             fixed.login_ok
         )
 
+    def sc_status_message(self, status_code="0", max_print_width="000",
+                          protocol_version="2.00"):
+        """Generate a message asking for the status of the SIP server.
+
+        Format of message to send to ILS:
+        99<status code><max print width><protocol version>
+        status code: 1-char, 0 means the SC is OK, required
+        max print width: 3-char, required
+        protocol version: 4-char, x.xx, required
+        """
+        return "99" + status_code + max_print_width + protocol_version
+
+    def acs_status_parser(self, message):
+        """Parse the response from an SC status message."""
+        return self.parse_response(
+            message,
+            98,
+            fixed.online_status,
+            fixed.checkin_ok,
+            fixed.checkout_ok,
+            fixed.acs_renewal_policy,
+            fixed.status_update_ok,
+            fixed.offline_ok,
+            fixed.timeout_period,
+            fixed.retries_allowed,
+            fixed.date_time_sync,
+            fixed.protocol_version,
+            named.institution_id.required,
+            named.library_name,
+            named.supported_messages.required,
+            named.terminal_location,
+            named.screen_message,
+            named.print_line,
+        )
+
     def patron_information_request(
             self, patron_identifier, patron_password="", institution_id="",
             terminal_password="",
@@ -760,6 +833,191 @@ class SIPClient(Constants):
         return text      
 
 
+class SIPClientPool(object):
+    """A bounded pool of SIPClient objects.
+
+    Each SIPClient in the pool has its own socket connection, and so
+    its own login state and sequence number. Up to `size` requests can
+    be in progress at once; any others wait for a connection to be
+    returned to the pool.
+    """
+
+    log = logging.getLogger("SIPClientPool")
+
+    # A connection that hasn't been used in this many seconds is
+    # closed rather than reused.
+    DEFAULT_MAX_IDLE_TIME = 300
+
+    # A connection that hasn't been used in this many seconds is
+    # checked with an SC status request before it's reused.
+    DEFAULT_HEALTH_CHECK_INTERVAL = 60
+
+    # Give up if no connection becomes available within this many
+    # seconds.
+    DEFAULT_CHECKOUT_TIMEOUT = 30
+
+    def __init__(self, size=1, max_idle_time=None,
+                 health_check_interval=None, checkout_timeout=None,
+                 client_class=SIPClient, **client_kwargs):
+        """Constructor.
+
+        :param size: The maximum number of simultaneous connections to
+        the SIP server.
+
+        :param client_class: The class used to create new
+        connections. Only intended to be changed during testing.
+
+        :param client_kwargs: Keyword arguments passed into the
+        `client_class` constructor every time a new connection is
+        created.
+        """
+        self.size = max(int(size or 1), 1)
+        if max_idle_time is None:
+            max_idle_time = self.DEFAULT_MAX_IDLE_TIME
+        self.max_idle_time = max_idle_time
+        if health_check_interval is None:
+            health_check_interval = self.DEFAULT_HEALTH_CHECK_INTERVAL
+        self.health_check_interval = health_check_interval
+        if checkout_timeout is None:
+            checkout_timeout = self.DEFAULT_CHECKOUT_TIMEOUT
+        self.checkout_timeout = checkout_timeout
+        self.client_class = client_class
+        self.client_kwargs = client_kwargs
+
+        # `condition` controls access to `idle` and `in_use`.
+        self.condition = threading.Condition()
+
+        # A list of (SIPClient, time last used) 2-tuples, most
+        # recently used last.
+        self.idle = []
+        self.in_use = 0
+
+        # Create the first connection immediately. This surfaces
+        # connection problems as soon as possible, and gives us a
+        # place to get configuration information from.
+        client = self.create_client()
+        for attr in ('target_server', 'target_port', 'login_user_id',
+                     'login_password', 'location_code', 'separator'):
+            setattr(self, attr, getattr(client, attr, None))
+        self.idle.append((client, time.time()))
+
+    def create_client(self):
+        """Create a new SIPClient, connecting to the server unless
+        the pool was configured not to.
+        """
+        return self.client_class(**self.client_kwargs)
+
+    def login(self, *args, **kwargs):
+        return self.make_request('login', *args, **kwargs)
+
+    def patron_information(self, *args, **kwargs):
+        return self.make_request('patron_information', *args, **kwargs)
+
+    def make_request(self, method_name, *args, **kwargs):
+        """Check out a connection, call one of its request methods,
+        and return the connection to the pool.
+
+        The SIPClient handles reconnect-and-retry on network errors. If
+        the request fails even so, the connection is discarded instead
+        of being returned to the pool.
+        """
+        client = self.checkout()
+        healthy = False
+        try:
+            response = getattr(client, method_name)(*args, **kwargs)
+            healthy = True
+        finally:
+            self.checkin(client, healthy)
+        return response
+
+    def checkout(self):
+        """Take a SIPClient out of the pool, creating a new one if
+        necessary.
+
+        :raise IOError: If no connection becomes available within
+        `checkout_timeout` seconds, or a new connection can't be made.
+        """
+        deadline = time.time() + self.checkout_timeout
+        with self.condition:
+            while not self.idle and self.in_use >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError(
+                        "Timed out waiting for a connection to %s" % (
+                            self.target_server
+                        )
+                    )
+                self.condition.wait(remaining)
+            self.in_use += 1
+            if self.idle:
+                client, last_used = self.idle.pop()
+            else:
+                client, last_used = None, None
+
+        try:
+            if client:
+                client = self._reusable(client, last_used)
+            if not client:
+                client = self.create_client()
+        except Exception, e:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        return client
+
+    def checkin(self, client, healthy=True):
+        """Return a SIPClient to the pool.
+
+        :param healthy: If this is False, the connection is closed
+        instead of being made available for reuse.
+        """
+        now = time.time()
+        with self.condition:
+            self.in_use -= 1
+            if healthy:
+                self.idle.append((client, now))
+            expired = [x for x, last_used in self.idle
+                       if now - last_used > self.max_idle_time]
+            self.idle = [(x, last_used) for x, last_used in self.idle
+                         if x not in expired]
+            self.condition.notify()
+
+        if not healthy:
+            expired.append(client)
+        for x in expired:
+            x.disconnect()
+
+    def _reusable(self, client, last_used):
+        """Decide whether an idle SIPClient can be reused.
+
+        :return: The SIPClient, or None if it was closed.
+        """
+        idle_for = time.time() - last_used
+        if idle_for > self.max_idle_time:
+            client.disconnect()
+            return None
+        if idle_for > self.health_check_interval:
+            try:
+                client.sc_status(fail_on_network_error=True)
+            except (IOError, socket.error), e:
+                self.log.info(
+                    "Discarding connection to %s after failed health check: %s",
+                    self.target_server, e
+                )
+                client.disconnect()
+                return None
+        return client
+
+    def close(self):
+        """Close every idle connection in the pool."""
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+        for client, last_used in idle:
+            client.disconnect()
+
+
 class MockSIPClient(SIPClient):
     """A SIP client that relies on canned responses rather than a socket
     connection.
@@ -782,6 +1040,10 @@ class MockSIPClient(SIPClient):
         # connection-specific variables.
         self.status.append("Creating new socket connection.")
         self.reset_connection_state()
+
+    def disconnect(self):
+        self.status.append("Closing socket connection.")
+        self.reset_connection_state()
         
     def do_send(self, data):
         self.requests.append(data)
@@ -195,7 +195,7 @@ class MockCirculationAPI(CirculationAPI):
     def add_remote_hold(self, *args, **kwargs):
         self.remote_holds.append(HoldInfo(*args, **kwargs))
 
-    def patron_activity(self, patron, pin):
+    def patron_activity(self, patron, pin, collection_ids=None):
         """Return a 3-tuple (loans, holds, completeness)."""
         return self.remote_loans, self.remote_holds, True
 
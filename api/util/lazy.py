@@ -0,0 +1,82 @@
+from threading import Lock
+
+
+class LazyDict(object):
+    """A dictionary whose keys are known ahead of time, but whose
+    values aren't created until someone asks for them.
+
+    This is used to keep per-library objects that are expensive to
+    create, so that a site with many libraries doesn't have to set up
+    every library before it can serve a request.
+    """
+
+    def __init__(self, factory, keys, values=None):
+        """Constructor.
+
+        :param factory: A function that takes a key and creates the
+          value for that key.
+
+        :param keys: The keys that can be looked up.
+
+        :param values: A dictionary of values that have already been
+          created, e.g. by an earlier LazyDict that's being replaced.
+        """
+        self.factory = factory
+        self._keys = set(keys)
+        self._values = dict(values or {})
+        self.lock = Lock()
+
+    @classmethod
+    def created_values(cls, previous, keys):
+        """Find the values that were created for some keys in a
+        LazyDict (or a normal dictionary) without creating any new
+        ones.
+
+        :return: A dictionary.
+        """
+        if isinstance(previous, LazyDict):
+            previous = previous._values
+        if not isinstance(previous, dict):
+            return {}
+        return dict((k, previous[k]) for k in keys if k in previous)
+
+    def is_created(self, key):
+        return key in self._values
+
+    def __contains__(self, key):
+        return key in self._keys or key in self._values
+
+    def __len__(self):
+        return len(self._keys | set(self._values))
+
+    def __iter__(self):
+        return iter(self._keys | set(self._values))
+
+    def keys(self):
+        return list(self)
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        with self.lock:
+            # Another thread may have created the value while we were
+            # waiting for the lock.
+            if key not in self._values:
+                self._values[key] = self.factory(key)
+        return self._values[key]
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._keys.discard(key)
+        self._values.pop(key, None)
@@ -36,6 +36,25 @@ class PatronUtility(object):
             return True
         return False
 
+    @classmethod
+    def needs_bookshelf_sync(cls, last_synced, minimum_interval):
+        """Could a patron's loans and holds in some collection stand to
+        be synced with the vendor?
+
+        :param last_synced: The last time the patron's loans and holds
+        were synced with the vendor, or None if they never have been.
+
+        :param minimum_interval: The number of seconds to wait between
+        syncs. If this is zero or None, a sync is always needed.
+        """
+        if not last_synced or not minimum_interval:
+            return True
+        now = datetime.datetime.utcnow()
+        expired_at = last_synced + datetime.timedelta(seconds=minimum_interval)
+        if now > expired_at:
+            return True
+        return False
+
     @classmethod
     def has_borrowing_privileges(cls, patron):
         """Is the given patron allowed to check out books?
@@ -49,10 +68,14 @@ class PatronUtility(object):
             return False
 
     @classmethod
-    def assert_borrowing_privileges(cls, patron):
+    def assert_borrowing_privileges(cls, patron, configuration=None):
         """Raise an exception unless the patron currently has borrowing
         privileges.
 
+        :param configuration: A ConfigurationSnapshot to use when
+        looking up the library's settings. By default, they're read
+        from the database.
+
         :raise AuthorizationExpired: If the patron's authorization has 
         expired.
 
@@ -65,7 +88,9 @@ class PatronUtility(object):
             raise AuthorizationExpired()
 
         if patron.fines:
-            max_fines = Configuration.max_outstanding_fines(patron.library)
+            max_fines = (configuration or Configuration).max_outstanding_fines(
+                patron.library
+            )
             if patron.fines >= max_fines.amount:
                 raise OutstandingFines()
 
@@ -0,0 +1,160 @@
+import re
+
+
+class URLTemplateBuilder(object):
+    """Generate URLs for routes by filling in precompiled templates,
+    rather than going through the Flask routing map every time.
+
+    The first time a route is requested with a given set of
+    arguments, the URL is generated normally, using placeholder
+    values for the arguments. The result becomes a template for every
+    later URL for that route, that library and that set of arguments.
+
+    Templates are only used for argument values that would not be
+    changed by URL quoting. Anything else--including a route that
+    can't be built--falls back to calling the URL function.
+    """
+
+    PLACEHOLDER = "URLTEMPLATEARG%dX"
+    PLACEHOLDER_RE = re.compile("URLTEMPLATEARG([0-9]+)X")
+
+    # Values made up of these characters come out of URL quoting
+    # unchanged. Slashes and colons are left alone in the path, but
+    # not in the query string.
+    SAFE_PATH_VALUE = re.compile("^[A-Za-z0-9_.\-/:]*\Z")
+    SAFE_QUERY_VALUE = re.compile("^[A-Za-z0-9_.\-]*\Z")
+
+    # Arguments that are the same for every URL in a feed, and so
+    # can be baked into the template.
+    FIXED_ARGUMENTS = set(['library_short_name'])
+
+    NOT_COMPILED = object()
+
+    def __init__(self, url_function, max_size=1000):
+        """Constructor.
+
+        :param url_function: A function with the signature of Flask's
+          url_for, such as url_for itself or cdn_url_for.
+        """
+        self.url_function = url_function
+        self.max_size = max_size
+        self.templates = {}
+
+    def url_for(self, route, url_root=None, **kwargs):
+        """Generate a URL for the given route.
+
+        :param url_root: The root URL of the current request. The
+          same route can have different templates under different
+          hostnames.
+        """
+        fixed = []
+        names = []
+        values = []
+        for k in sorted(kwargs):
+            v = kwargs[k]
+            if v is None:
+                # url_for ignores arguments with no value.
+                continue
+            if k[0] == '_' or k in self.FIXED_ARGUMENTS:
+                fixed.append((k, v))
+            else:
+                names.append(k)
+                values.append(v)
+        key = (route, url_root, tuple(fixed), tuple(names))
+
+        template = self.templates.get(key, self.NOT_COMPILED)
+        if template is self.NOT_COMPILED:
+            if len(self.templates) >= self.max_size:
+                self.templates = {}
+            template = self.compile(route, dict(fixed), names)
+            self.templates[key] = template
+        if template:
+            url = self.fill(template, values)
+            if url is not None:
+                return url
+        return self.url_function(route, **kwargs)
+
+    def compile(self, route, fixed, names):
+        """Create a template for a route.
+
+        :return: A 2-tuple (literal strings, placeholders), where each
+          placeholder is an argument index and the regular expression
+          its values must match. None if no usable template could be
+          made.
+        """
+        kwargs = dict(fixed)
+        for i, name in enumerate(names):
+            kwargs[name] = self.PLACEHOLDER % i
+        try:
+            url = self.url_function(route, **kwargs)
+        except Exception, e:
+            # This route can't be built by substitution, or can't be
+            # built at all. Let the URL function deal with it every
+            # time.
+            return None
+
+        # Split the URL into literal strings and placeholders.
+        # Keep track of whether each placeholder shows up in the
+        # query string.
+        parts = self.PLACEHOLDER_RE.split(url)
+        query_start = url.find('?')
+        in_query = []
+        position = 0
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                position += len(part)
+            else:
+                in_query.append(query_start != -1 and position > query_start)
+                position += len(self.PLACEHOLDER % int(part))
+        placeholders = [int(x) for x in parts[1::2]]
+        if sorted(placeholders) != range(len(names)):
+            # Some argument was dropped, duplicated or transformed
+            # on its way into the URL.
+            return None
+
+        # Make sure the template gives the same result as the URL
+        # function. First try values containing slashes and colons;
+        # if those get quoted, only use the template for simpler
+        # values.
+        for strict in (False, True):
+            slots = []
+            for i, query in zip(placeholders, in_query):
+                if strict or query:
+                    slots.append((i, self.SAFE_QUERY_VALUE))
+                else:
+                    slots.append((i, self.SAFE_PATH_VALUE))
+            template = (parts[0::2], slots)
+            probe = []
+            for i in range(len(names)):
+                probe.append(u"a%d" % i)
+            if not strict:
+                for i, query in zip(placeholders, in_query):
+                    if not query:
+                        probe[i] = u"a/b:%d" % i
+            kwargs = dict(fixed)
+            kwargs.update(zip(names, probe))
+            try:
+                expect = self.url_function(route, **kwargs)
+            except Exception, e:
+                continue
+            if self.fill(template, probe) == expect:
+                return template
+        return None
+
+    def fill(self, template, values):
+        """Fill in a template with argument values.
+
+        :return: A URL, or None if some value can't be put into the
+          template without quoting.
+        """
+        literals, slots = template
+        url = [literals[0]]
+        for (i, safe), literal in zip(slots, literals[1:]):
+            value = values[i]
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            if not safe.match(value):
+                return None
+            url.append(value)
+            url.append(literal)
+        return "".join(url)
@@ -0,0 +1,109 @@
+# encoding: utf-8
+"""Measure how long the Axis 360 circulation monitor takes to process
+a large availability document.
+
+This builds a canned 50,000-title availability response, runs the
+monitor over it once to create every book, and then runs it again to
+update books that already exist. Everything happens in the test
+database and is rolled back afterwards.
+
+Run it from the top-level directory:
+
+    python integration_tests/benchmark_axis_circulation_monitor.py
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+))
+from core.testing import (
+    DatabaseTest,
+    package_setup,
+)
+from api.axis import (
+    Axis360CirculationMonitor,
+    MockAxis360API,
+)
+
+title_count = 50000
+
+TITLE = u"""<title>
+<titleId>%(id)010d</titleId>
+<productTitle>Benchmark Title %(id)d</productTitle>
+<contributors>Author %(author)d, Some</contributors>
+<subject>FICTION / General</subject>
+<isbn>978%(id)010d</isbn>
+<language>ENGLISH</language>
+<publicationDate>04/01/1999</publicationDate>
+<series />
+<publisher>Benchmark House</publisher>
+<imprint>Benchmark House</imprint>
+<annotation>A book for benchmarking.</annotation>
+<audience>General Adult</audience>
+<availability>
+<isInHoldQueue>false</isInHoldQueue>
+<isCheckedout>false</isCheckedout>
+<isReserved>false</isReserved>
+<totalCopies>%(copies)d</totalCopies>
+<availableCopies>%(copies)d</availableCopies>
+<holdsQueueSize>0</holdsQueueSize>
+<updateDate>05/20/2015 02:09:08 AM</updateDate>
+</availability>
+<status>ACTIVE</status>
+<availableFormats><formatName>ePub</formatName></availableFormats>
+<runtime>0</runtime>
+<narrator />
+</title>
+"""
+
+def availability_document(copies):
+    titles = [
+        TITLE % dict(id=i, author=i % 1000, copies=copies)
+        for i in range(title_count)
+    ]
+    return (
+        u'<availabilityResponse xmlns="http://axis360api.baker-taylor.com/vendorAPI">'
+        u'<titles>%s</titles>'
+        u'<status><code>0000</code><message>Operation completed successfully.</message></status>'
+        u'</availabilityResponse>'
+    ) % u"".join(titles)
+
+def timed(message, function, *args):
+    a = time.time()
+    result = function(*args)
+    elapsed = time.time() - a
+    print "%-45s %.1fs (%.0f titles per second)" % (
+        message, elapsed, title_count / elapsed
+    )
+    return result
+
+class AxisCirculationMonitorBenchmark(DatabaseTest):
+
+    def run(self):
+        collection = MockAxis360API.mock_collection(self._db)
+        api = MockAxis360API(self._db, collection)
+        monitor = Axis360CirculationMonitor(
+            self._db, collection, api_class=api
+        )
+        start = datetime.datetime(1970, 1, 1)
+
+        api.queue_response(200, content=availability_document(1))
+        timed("Create %d titles" % title_count,
+              monitor.run_once, start, None)
+
+        api.queue_response(200, content=availability_document(2))
+        timed("Update %d titles" % title_count,
+              monitor.run_once, start, None)
+
+package_setup()
+AxisCirculationMonitorBenchmark.setup_class()
+benchmark = AxisCirculationMonitorBenchmark()
+benchmark.setup()
+try:
+    benchmark.run()
+finally:
+    benchmark.teardown()
+    AxisCirculationMonitorBenchmark.teardown_class()
@@ -0,0 +1,109 @@
+# encoding: utf-8
+"""Measure how long it takes to generate the URLs for a 500-entry
+feed, using Flask's url_for and using URLTemplateBuilder.
+
+The routes are registered the way api/routes.py registers them, with
+a prefix route, a subdomain route and a default route for every
+library route, so the routing map is about the same size as the real
+one.
+"""
+import os
+import sys
+import time
+
+import flask
+from flask import Flask
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+))
+from api.util.url import URLTemplateBuilder
+
+entries = 500
+repeat = 5
+
+app = Flask(__name__)
+app.config['SERVER_NAME'] = 'circulation.example.com'
+
+def view(**kwargs):
+    return ""
+
+def library_route(endpoint, path):
+    app.add_url_rule("/<library_short_name>" + path, endpoint, view)
+    app.add_url_rule(path, endpoint, view, subdomain="<library_short_name>")
+    app.add_url_rule(path, endpoint, view)
+
+def library_dir_route(endpoint, path):
+    for p in (path, path + "/"):
+        library_route(endpoint, p)
+
+library_route('acquisition_groups', '/groups/<lane_identifier>')
+library_route('feed', '/feed/<lane_identifier>')
+library_route('lane_search', '/search/<lane_identifier>')
+library_route('annotations', '/annotations/')
+library_route('annotations_for_work', '/annotations/<identifier_type>/<path:identifier>/')
+library_route('borrow', '/works/<identifier_type>/<path:identifier>/borrow')
+library_route('borrow', '/works/<identifier_type>/<path:identifier>/borrow/<mechanism_id>')
+library_route('fulfill', '/works/<license_pool_id>/fulfill')
+library_route('fulfill', '/works/<license_pool_id>/fulfill/<mechanism_id>')
+library_route('revoke_loan_or_hold', '/loans/<license_pool_id>/revoke')
+library_dir_route('contributor', '/works/contributor/<contributor_name>')
+library_route('contributor', '/works/contributor/<contributor_name>/<languages>/<audiences>')
+library_dir_route('series', '/works/series/<series_name>')
+library_route('series', '/works/series/<series_name>/<languages>/<audiences>')
+library_route('permalink', '/works/<identifier_type>/<path:identifier>')
+library_route('recommendations', '/works/<identifier_type>/<path:identifier>/recommendations')
+library_route('related_books', '/works/<identifier_type>/<path:identifier>/related_books')
+library_route('report', '/works/<identifier_type>/<path:identifier>/report')
+
+def entry_urls(url_for, i):
+    """Generate the URLs LibraryAnnotator puts into a typical entry."""
+    identifier = dict(
+        identifier_type="ISBN", identifier="97812345%05d" % i,
+        library_short_name="LIBRARY", _external=True
+    )
+    url_for("permalink", **identifier)
+    url_for("borrow", mechanism_id=None, **identifier)
+    url_for("fulfill", license_pool_id=i, mechanism_id=i % 3,
+            library_short_name="LIBRARY", _external=True)
+    url_for("related_books", **identifier)
+    url_for("recommendations", **identifier)
+    url_for("annotations_for_work", **identifier)
+    url_for("report", **identifier)
+    url_for("contributor", contributor_name="Author%d" % i,
+            languages="eng", audiences="Adult",
+            library_short_name="LIBRARY", _external=True)
+    url_for("series", series_name="Series%d" % (i % 50),
+            languages="eng", audiences="Adult",
+            library_short_name="LIBRARY", _external=True)
+
+def benchmark(url_for):
+    best = None
+    for i in range(repeat):
+        a = time.time()
+        for j in range(entries):
+            entry_urls(url_for, j)
+        elapsed = time.time() - a
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+with app.test_request_context("/", base_url="http://circulation.example.com/"):
+    builder = URLTemplateBuilder(flask.url_for)
+    for j in range(entries):
+        entry_urls(builder.url_for, j)
+        args = dict(
+            identifier_type="ISBN", identifier="97812345%05d" % j,
+            library_short_name="LIBRARY", _external=True
+        )
+        assert (builder.url_for("borrow", **args) ==
+                flask.url_for("borrow", **args))
+
+    print "URLs for a %d-entry feed, best of %d runs" % (entries, repeat)
+    print "------------------"
+    for name, function in (("url_for", flask.url_for),
+                           ("URLTemplateBuilder", builder.url_for)):
+        elapsed = benchmark(function)
+        print "%-20s %.3fs (%.1f microseconds per URL)" % (
+            name, elapsed, elapsed / (entries * 9) * 1000000
+        )
@@ -0,0 +1,115 @@
+# encoding: utf-8
+"""Measure how long it takes a CirculationManager to start up and to
+reload its settings on a site with many libraries.
+
+This creates 500 synthetic libraries, each with its own patron
+authentication integration, collection and lanes, in the test
+database. Everything is rolled back afterwards.
+
+Run it from the top-level directory:
+
+    python integration_tests/benchmark_library_startup.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+))
+from core.testing import (
+    DatabaseTest,
+    package_setup,
+)
+from core.lane import Lane
+from core.model import (
+    ConfigurationSetting,
+    ExternalIntegration,
+    create,
+)
+from api.authenticator import BasicAuthenticationProvider
+from api.config import Configuration
+from api.controller import CirculationManager
+
+library_count = 500
+lanes_per_library = 10
+
+def timed(message, function, *args):
+    a = time.time()
+    result = function(*args)
+    print "%-50s %.2fs" % (message, time.time() - a)
+    return result
+
+class LibraryStartupBenchmark(DatabaseTest):
+
+    def create_libraries(self):
+        libraries = []
+        for i in range(library_count):
+            library = self._library(short_name="library%d" % i)
+            integration, ignore = create(
+                self._db, ExternalIntegration,
+                protocol="api.simple_authentication",
+                goal=ExternalIntegration.PATRON_AUTH_GOAL
+            )
+            p = BasicAuthenticationProvider
+            integration.setting(p.TEST_IDENTIFIER).value = "user%d" % i
+            integration.setting(p.TEST_PASSWORD).value = "password"
+            library.integrations.append(integration)
+            library.collections.append(self._collection())
+            ConfigurationSetting.for_library(
+                Configuration.LARGE_COLLECTION_LANGUAGES, library
+            ).value = '["eng"]'
+            for j in range(lanes_per_library):
+                create(self._db, Lane, library=library,
+                       display_name="Lane %d" % j, priority=j)
+            libraries.append(library)
+        self._db.commit()
+        return libraries
+
+    def run(self):
+        libraries = timed(
+            "Create %d libraries" % library_count, self.create_libraries
+        )
+        manager = timed(
+            "Start the CirculationManager", CirculationManager,
+            self._db, True
+        )
+
+        def first_request(library):
+            manager.top_level_lanes[library.id]
+            manager.circulation_apis[library.id]
+            manager.custom_index_views.get(library.id)
+            manager.auth.library_authenticators[library.short_name]
+        timed("Set up one library on its first request",
+              first_request, libraries[0])
+
+        def set_up_everything():
+            for library in libraries:
+                first_request(library)
+        timed("Set up every library (the old startup cost)",
+              set_up_everything)
+
+        timed("Reload settings, nothing changed", manager.load_settings)
+
+        ConfigurationSetting.for_library(
+            Configuration.LOAN_LIMIT, libraries[0]
+        ).value = "5"
+        timed("Reload settings, one library changed",
+              manager.load_settings)
+        created = [
+            library for library in libraries
+            if manager.circulation_apis.is_created(library.id)
+        ]
+        print "Libraries kept across the reload: %d of %d" % (
+            len(created), library_count
+        )
+
+package_setup()
+LibraryStartupBenchmark.setup_class()
+benchmark = LibraryStartupBenchmark()
+benchmark.setup()
+try:
+    benchmark.run()
+finally:
+    benchmark.teardown()
+    LibraryStartupBenchmark.teardown_class()
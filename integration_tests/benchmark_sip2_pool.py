@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""Measure SIP2 patron authentication throughput against a local fake
+SIP2 server, for several connection pool sizes.
+
+The fake server sleeps for a fixed amount of time before answering
+each request, to simulate a slow ILS. With a single connection,
+throughput is bounded by that latency; with a pool, concurrent
+requests are spread across connections.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import SocketServer
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+))
+from api.sip.client import SIPClientPool
+
+# Seconds the fake ILS takes to answer a request.
+latency = 0.02
+requests_per_thread = 25
+thread_count = 16
+pool_sizes = [1, 2, 4, 8, 16]
+
+PATRON_INFORMATION_RESPONSE = "64              000201610210000142637000000000000000000000000AOnypl |AA12345|AESHELDON, ALICE|BZ0030|CA0050|CB0050|BLY|CQY|BV0|CC15.00|BEfoo@example.com|AY1AZD1B7\r"
+LOGIN_RESPONSE = "941\r"
+
+class FakeSIPHandler(SocketServer.StreamRequestHandler):
+    """Answer login and patron information requests with canned data."""
+
+    def handle(self):
+        while True:
+            data = ""
+            while not data.endswith("\r"):
+                tmp = self.request.recv(4096)
+                if not tmp:
+                    return
+                data += tmp
+            time.sleep(latency)
+            if data.startswith("93"):
+                response = LOGIN_RESPONSE
+            else:
+                response = PATRON_INFORMATION_RESPONSE
+            self.request.sendall(response)
+
+class FakeSIPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class AuthenticationThread(threading.Thread):
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.pool = pool
+        self.exceptions = []
+
+    def run(self):
+        for i in range(requests_per_thread):
+            try:
+                self.pool.patron_information("12345", "0000")
+            except Exception, e:
+                self.exceptions.append(e)
+
+def benchmark(port, size):
+    pool = SIPClientPool(
+        size=size, target_server="127.0.0.1", target_port=port,
+        login_user_id="user", login_password="pass"
+    )
+    threads = [AuthenticationThread(pool) for i in range(thread_count)]
+    a = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - a
+    pool.close()
+    errors = sum(len(thread.exceptions) for thread in threads)
+    return elapsed, errors
+
+server = FakeSIPServer(("127.0.0.1", 0), FakeSIPHandler)
+port = server.server_address[1]
+server_thread = threading.Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+
+total = requests_per_thread * thread_count
+print "%d requests from %d threads, %.0fms simulated ILS latency" % (
+    total, thread_count, latency * 1000
+)
+print "------------------"
+for size in pool_sizes:
+    elapsed, errors = benchmark(port, size)
+    print "Pool size %2d: %.2fs, %.1f requests/sec, %d errors" % (
+        size, elapsed, total/elapsed, errors
+    )
+server.shutdown()
@@ -13,6 +13,10 @@ import time
 import urlparse
 import logging
 import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from threading import Lock
 
 from sqlalchemy import (
     or_,
@@ -34,6 +38,7 @@ from core.metadata_layer import (
     LinkData,
 )
 from core.model import (
+    CachedFeed,
     CirculationEvent,
     Collection,
     ConfigurationSetting,
@@ -314,10 +319,32 @@ class UpdateStaffPicksScript(Script):
         return StringIO(representation.content)
 
 
+def _cache_lanes_in_worker(args):
+    """Cache feeds for some of a library's lanes, in a worker process
+    with its own database session and request context.
+
+    This is a module-level function so that multiprocessing can find it.
+
+    :return: A list of per-lane timings, as kept by
+    CacheRepresentationPerLane.
+    """
+    script_class, cmd_args, library_id, lane_ids = args
+    script = script_class(cmd_args=cmd_args)
+    script.workers = 1
+    return script.process_lanes_by_id(library_id, lane_ids)
+
+
 class CacheRepresentationPerLane(LaneSweeperScript):
 
     name = "Cache one representation per lane"
 
+    # The type of CachedFeed created by this script. Used to decide
+    # whether a lane's feeds are out of date.
+    CACHED_FEED_TYPE = None
+
+    # The number of slow lanes to mention once a library is done.
+    SLOW_LANES_TO_REPORT = 10
+
     @classmethod
     def arg_parser(cls, _db):
         parser = LaneSweeperScript.arg_parser(_db)
@@ -338,11 +365,25 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             type=int,
             default=1
         )
+        parser.add_argument(
+            '--workers',
+            help='Spread the lanes across this many worker processes.',
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            '--dirty-only',
+            help="Only regenerate a lane's feeds if works in the lane have changed since they were cached.",
+            action='store_true',
+            dest='dirty_only'
+        )
         return parser
 
     def __init__(self, _db=None, cmd_args=None, testing=False, *args, **kwargs):
         super(CacheRepresentationPerLane, self).__init__(_db, *args, **kwargs)
         self.parse_args(cmd_args)
+        self.lane_timings = []
+        self.pending_lanes = []
         from api.app import app
         app.manager = CirculationManager(self._db, testing=testing)
         self.app = app
@@ -361,6 +402,11 @@ class CacheRepresentationPerLane(LaneSweeperScript):
                     self.log.warn("Ignored unrecognized language code %s", alpha)
         self.max_depth = parsed.max_depth
         self.min_depth = parsed.min_depth
+        self.workers = max(parsed.workers, 1)
+        self.dirty_only = parsed.dirty_only
+
+        # Worker processes will need to parse the same arguments.
+        self.cmd_args = cmd_args
 
         # Return the parsed arguments in case a subclass needs to
         # process more args.
@@ -407,17 +453,38 @@ class CacheRepresentationPerLane(LaneSweeperScript):
 
     def process_library(self, library):
         begin = time.time()
+        self.lane_timings = []
+        self.pending_lanes = []
         client = self.app.test_client()
         ctx = self.app.test_request_context(base_url=self.base_url)
         ctx.push()
         super(CacheRepresentationPerLane, self).process_library(library)
         ctx.pop()
+        if self.pending_lanes:
+            self.lane_timings.extend(
+                self.process_lanes_in_workers(library, self.pending_lanes)
+            )
         end = time.time()
         self.log.info(
             "Processed library %s in %.2fsec", library.short_name, end-begin
         )
+        self.report_lane_timings(library)
 
     def process_lane(self, lane):
+        if self.dirty_only and not self.lane_is_dirty(lane):
+            self.log.info(
+                "Skipping %s; nothing has changed since its feeds were cached.",
+                lane.full_identifier
+            )
+            return []
+        if self.workers > 1:
+            # Leave this lane for one of the worker processes.
+            if isinstance(lane, Lane):
+                self.pending_lanes.append(lane.id)
+            else:
+                self.pending_lanes.append(None)
+            return []
+
         annotator = self.app.manager.annotator(lane)
         a = time.time()
         self.log.info("Generating feed(s) for %s", lane.full_identifier)
@@ -428,13 +495,138 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             "Generated %d feed(s) for %s. Took %.2fsec to make %d bytes.",
             len(cached_feeds), lane.full_identifier, (b-a), total_size
         )
+        self.lane_timings.append(
+            (b-a, lane.full_identifier, len(cached_feeds))
+        )
         return cached_feeds
 
+    def process_lanes_in_workers(self, library, lane_ids):
+        """Split a library's lanes into shards and cache each shard's
+        feeds in a separate process.
+
+        :param lane_ids: The IDs of the lanes to process. None stands
+        for the library's top-level WorkList.
+
+        :return: A list of per-lane timings.
+        """
+        shards = [lane_ids[i::self.workers] for i in range(self.workers)]
+        shards = [x for x in shards if x]
+        self.log.info(
+            "Processing %d lanes for %s in %d worker processes.",
+            len(lane_ids), library.short_name, len(shards)
+        )
+
+        # Database connections can't be shared with the worker
+        # processes, so give ours back and close them before starting
+        # the workers. The session itself stays open, so `library`
+        # and the other objects it has loaded can still be used
+        # afterwards; a new connection will be opened when needed.
+        library_id = library.id
+        self._db.commit()
+        bind = self._db.get_bind()
+        if hasattr(bind, 'dispose'):
+            bind.dispose()
+
+        pool = self.worker_pool(len(shards))
+        try:
+            results = pool.map(
+                _cache_lanes_in_worker,
+                [(self.__class__, self.cmd_args, library_id, shard)
+                 for shard in shards]
+            )
+        finally:
+            pool.close()
+            pool.join()
+        return [timing for result in results for timing in result]
+
+    def worker_pool(self, size):
+        """Create the pool of processes that will cache a library's
+        lanes.
+        """
+        return multiprocessing.Pool(size)
+
+    def process_lanes_by_id(self, library_id, lane_ids):
+        """Cache feeds for the given lanes. This is the work done
+        by a worker process.
+
+        :return: A list of per-lane timings.
+        """
+        library = get_one(self._db, Library, id=library_id)
+        ctx = self.app.test_request_context(base_url=self.base_url)
+        ctx.push()
+        try:
+            for lane_id in lane_ids:
+                if lane_id is None:
+                    lane = self.app.manager.top_level_lanes[library.id]
+                else:
+                    lane = get_one(self._db, Lane, id=lane_id)
+                if not lane:
+                    continue
+                self.process_lane(lane)
+                self._db.commit()
+        finally:
+            ctx.pop()
+        return self.lane_timings
+
+    def lane_is_dirty(self, lane):
+        """Have any works in this lane changed since its feeds were
+        cached?
+
+        Only changes to works still in the lane are noticed, not works
+        that have left it.
+        """
+        if not isinstance(lane, Lane) or not self.CACHED_FEED_TYPE:
+            # We can't tell, so assume the worst.
+            return True
+
+        last_cached = self.last_cached(lane)
+        if not last_cached:
+            # This lane has never been cached.
+            return True
+        return self.works_changed_since(lane, last_cached)
+
+    def last_cached(self, lane):
+        """When was the oldest of this lane's feeds cached?"""
+        return self._db.query(func.min(CachedFeed.timestamp)).filter(
+            CachedFeed.lane_id==lane.id
+        ).filter(
+            CachedFeed.type==self.CACHED_FEED_TYPE
+        ).scalar()
+
+    def works_changed_since(self, lane, timestamp):
+        """Has any work in the given lane changed since `timestamp`?"""
+        from core.model import MaterializedWorkWithGenre as work_model
+        qu = lane.works(self._db)
+        if qu is None:
+            return True
+        updated = func.greatest(
+            work_model.availability_time, work_model.first_appearance,
+            work_model.last_update_time
+        )
+        return qu.filter(updated > timestamp).limit(1).count() > 0
+
+    def report_lane_timings(self, library):
+        """Log the lanes that took longest to process, so they're
+        easy to find.
+        """
+        if not self.lane_timings:
+            return
+        slowest = sorted(self.lane_timings, reverse=True)
+        self.log.info(
+            "Slowest lanes for %s:", library.short_name
+        )
+        for elapsed, identifier, feeds in slowest[:self.SLOW_LANES_TO_REPORT]:
+            self.log.info(
+                "%.2fsec for %d feed(s): %s", elapsed, feeds, identifier
+            )
+
 class CacheFacetListsPerLane(CacheRepresentationPerLane):
     """Cache the first two pages of every relevant facet list for this lane."""
 
     name = "Cache OPDS feeds"
 
+    CACHED_FEED_TYPE = CachedFeed.PAGE_TYPE
+
     @classmethod
     def arg_parser(cls, _db):
         parser = CacheRepresentationPerLane.arg_parser(_db)
@@ -555,6 +747,8 @@ class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
 
     name = "Cache OPDS group feed for each lane"
 
+    CACHED_FEED_TYPE = CachedFeed.GROUPS_TYPE
+
     def should_process_lane(self, lane):
         # OPDS group feeds are only generated for lanes that have sublanes.
         if not lane.children:
@@ -563,6 +757,17 @@ class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
             return False
         return True
 
+    def lane_is_dirty(self, lane):
+        if super(CacheOPDSGroupFeedPerLane, self).lane_is_dirty(lane):
+            return True
+        # A grouped feed also shows works from each sublane.
+        last_cached = self.last_cached(lane)
+        for sublane in lane.children:
+            if (isinstance(sublane, Lane) and
+                self.works_changed_since(sublane, last_cached)):
+                return True
+        return False
+
     def do_generate(self, lane):
         feeds = []
         annotator = self.app.manager.annotator(lane)
@@ -1025,11 +1230,67 @@ class OPDSForDistributorsReaperScript(OPDSImportScript):
     PROTOCOL = OPDSForDistributorsImporter.NAME
 
 
+class PremirroredUploader(object):
+    """Wrap a MirrorUploader so that files can be uploaded ahead of
+    time, from other threads. When the metadata layer later asks for
+    one of those files to be mirrored, it's just marked as mirrored.
+    """
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self.uploaded = set()
+        self.lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.mirror, name)
+
+    def upload(self, url, media_type, content):
+        """Upload some content to the given URL.
+
+        :return: True if the upload succeeded.
+        """
+        representation = Representation(media_type=media_type, content=content)
+        self.mirror.mirror_one(representation, url)
+        if representation.mirror_exception or not representation.mirrored_at:
+            return False
+        with self.lock:
+            self.uploaded.add(url)
+        return True
+
+    def mirror_one(self, representation, mirror_to, *args, **kwargs):
+        with self.lock:
+            uploaded = mirror_to in self.uploaded
+        if uploaded:
+            representation.set_as_mirrored(mirror_to)
+            return
+        return self.mirror.mirror_one(
+            representation, mirror_to, *args, **kwargs
+        )
+
+
 class DirectoryImportScript(Script):
     """Import some books into a collection, based on a file containing
     metadata and directories containing ebook and cover files.
     """
 
+    # Commit after importing this many titles.
+    DEFAULT_BATCH_SIZE = 100
+
+    # Stop reading ahead once this many bytes of files are waiting to
+    # be imported.
+    DEFAULT_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+    # Files read ahead of time by prepare_files, keyed by
+    # (base filename, directory).
+    located_files = {}
+
+    in_flight_bytes = 0
+    max_in_flight_bytes = DEFAULT_MAX_IN_FLIGHT_BYTES
+    read_ahead = 2
+    in_flight_lock = Lock()
+    titles_imported = 0
+    bytes_read = 0
+
     @classmethod
     def arg_parser(cls, _db):
         parser = argparse.ArgumentParser()
@@ -1074,6 +1335,28 @@ class DirectoryImportScript(Script):
             help=u"Show what would be imported, but don't actually do the import.",
             action='store_true',
         )
+        parser.add_argument(
+            '--batch-size',
+            help=u"Commit to the database after importing this many titles.",
+            type=int,
+            default=cls.DEFAULT_BATCH_SIZE,
+        )
+        parser.add_argument(
+            '--workers',
+            help=u"Use this many threads to read and upload ebook and cover files.",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            '--max-in-flight-mb',
+            help=u"Stop reading ahead once this many megabytes of ebook and cover files are waiting to be imported.",
+            type=int,
+            default=cls.DEFAULT_MAX_IN_FLIGHT_BYTES / (1024*1024),
+        )
+        parser.add_argument(
+            '--checkpoint-file',
+            help=u"Keep track of the import's progress in this file. If the import is interrupted, running it again with the same file will pick up where it left off.",
+        )
         return parser
 
     def do_run(self, cmd_args=None):
@@ -1090,13 +1373,17 @@ class DirectoryImportScript(Script):
         return self.run_with_arguments(
             collection_name, data_source_name,
             metadata_file, metadata_format, cover_directory,
-            ebook_directory, rights_uri, dry_run
+            ebook_directory, rights_uri, dry_run,
+            batch_size=parsed.batch_size, workers=parsed.workers,
+            checkpoint_file=parsed.checkpoint_file,
+            max_in_flight_bytes=parsed.max_in_flight_mb * 1024 * 1024,
         )
 
     def run_with_arguments(
             self, collection_name, data_source_name, metadata_file,
             metadata_format, cover_directory, ebook_directory, rights_uri,
-            dry_run
+            dry_run, batch_size=None, workers=None, checkpoint_file=None,
+            max_in_flight_bytes=None, output=sys.stdout
     ):
         if dry_run:
             self.log.warn(
@@ -1108,17 +1395,263 @@ class DirectoryImportScript(Script):
 
         if dry_run:
             mirror = None
+            checkpoint_file = None
+
+        batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.max_in_flight_bytes = (
+            max_in_flight_bytes or self.DEFAULT_MAX_IN_FLIGHT_BYTES
+        )
+        pool = None
+        if workers and workers > 1:
+            pool = ThreadPool(workers)
+            self.read_ahead = workers * 2
+            if mirror:
+                # Files will be uploaded by the worker threads, before
+                # the metadata layer gets to them.
+                mirror = PremirroredUploader(mirror)
 
         replacement_policy = ReplacementPolicy.from_license_source(self._db)
         replacement_policy.mirror = mirror
+        self.titles_imported = 0
+        self.bytes_read = 0
+        started = time.time()
+
+        # If an earlier import was interrupted, skip the records it
+        # already took care of.
+        position = 0
+        done = self.read_checkpoint(checkpoint_file)
+        if done:
+            self.log.info(
+                "Skipping %d records that were already imported.", done
+            )
+
         metadata_records = self.load_metadata(metadata_file, metadata_format, data_source_name)
-        for metadata in metadata_records:
-            self.work_from_metadata(
-                collection, metadata, replacement_policy, cover_directory,
-                ebook_directory, rights_uri
+        batch = []
+        try:
+            for metadata in metadata_records:
+                position += 1
+                if position <= done:
+                    continue
+                batch.append(metadata)
+                if len(batch) >= batch_size:
+                    self.import_batch(
+                        collection, batch, replacement_policy,
+                        cover_directory, ebook_directory, rights_uri, pool
+                    )
+                    self.finish_batch(dry_run, checkpoint_file, position)
+                    batch = []
+            if batch:
+                self.import_batch(
+                    collection, batch, replacement_policy, cover_directory,
+                    ebook_directory, rights_uri, pool
+                )
+                self.finish_batch(dry_run, checkpoint_file, position)
+        finally:
+            if pool:
+                pool.close()
+
+        # The import is complete, so the next one should start over.
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        if dry_run:
+            self.report_throughput(output, time.time() - started)
+
+    def report_throughput(self, output, elapsed):
+        """Say how quickly titles and files were processed."""
+        elapsed = max(elapsed, 0.001)
+        megabytes = self.bytes_read / (1024.0 * 1024)
+        output.write(
+            "Processed %d titles and %.1f MB of files in %.1fs (%.1f titles/s, %.1f MB/s)\n" % (
+                self.titles_imported, megabytes, elapsed,
+                self.titles_imported / elapsed, megabytes / elapsed
             )
-            if not dry_run:
-                self._db.commit()
+        )
+
+    def import_batch(self, collection, batch, policy, cover_directory,
+                     ebook_directory, rights_uri, pool=None):
+        """Import a number of titles.
+
+        :param pool: A ThreadPool. If this is provided, the ebook and
+          cover files are read (and uploaded, if there's a mirror) by
+          the pool while earlier titles are being imported. Each
+          title is only written to the database once its files are
+          ready.
+        """
+        args = (cover_directory, ebook_directory, rights_uri)
+        if not pool:
+            for metadata in batch:
+                self.work_from_metadata(collection, metadata, policy, *args)
+                self.titles_imported += 1
+            return
+
+        pending = deque()
+        try:
+            for metadata in batch:
+                # Don't read too far ahead of the titles that are
+                # being imported.
+                while pending and (
+                    len(pending) >= self.read_ahead
+                    or self.in_flight_bytes >= self.max_in_flight_bytes
+                ):
+                    self.import_prepared(
+                        collection, policy, pending.popleft(), *args
+                    )
+                pending.append(
+                    self.prepare(pool, metadata, policy.mirror,
+                                 cover_directory, ebook_directory)
+                )
+            while pending:
+                self.import_prepared(
+                    collection, policy, pending.popleft(), *args
+                )
+        finally:
+            for metadata, result in pending:
+                # Let any work that's still going on finish, so it
+                # doesn't outlive this batch.
+                result.wait()
+            self.located_files = {}
+            self.in_flight_bytes = 0
+
+    def prepare(self, pool, metadata, mirror, cover_directory,
+                ebook_directory):
+        """Start reading and uploading a title's files in the pool.
+
+        :return: A 2-tuple (metadata, AsyncResult).
+        """
+        # Anything that needs the database happens here, on the
+        # main thread. The worker only looks at attributes that have
+        # already been loaded.
+        identifier, ignore = metadata.primary_identifier.load(self._db)
+        data_source = metadata.data_source(self._db)
+        identifier.identifier, identifier.type, data_source.name
+        result = pool.apply_async(
+            self.prepare_files,
+            (identifier, data_source, metadata.title, mirror,
+             cover_directory, ebook_directory)
+        )
+        return metadata, result
+
+    def prepare_files(self, identifier, data_source, title, mirror,
+                      cover_directory, ebook_directory):
+        """Read a title's ebook and cover files and, if possible, upload
+        them to the mirror. This runs in a worker thread.
+
+        :return: A 2-tuple (files, size). `files` maps (base
+          filename, directory) to the results of `_locate_file`.
+        """
+        files = dict()
+        size = 0
+        searches = [(ebook_directory, Representation.COMMON_EBOOK_EXTENSIONS,
+                     "ebook file", self.book_url)]
+        if cover_directory:
+            searches.append(
+                (cover_directory, Representation.COMMON_IMAGE_EXTENSIONS,
+                 "cover image", self.cover_url)
+            )
+        for directory, extensions, file_type, url_for in searches:
+            located = self._locate_file(
+                identifier.identifier, directory, extensions, file_type
+            )
+            files[(identifier.identifier, directory)] = located
+            ignore, media_type, content = located
+            if not content:
+                continue
+            size += len(content)
+            if isinstance(mirror, PremirroredUploader):
+                url = url_for(mirror, identifier, data_source, media_type,
+                              title=title)
+                mirror.upload(url, media_type, content)
+
+        with self.in_flight_lock:
+            self.in_flight_bytes += size
+        return files, size
+
+    def import_prepared(self, collection, policy, prepared, *args):
+        """Import a title once its files are ready."""
+        metadata, result = prepared
+        files, size = result.get()
+        self.located_files = files
+        try:
+            self.work_from_metadata(collection, metadata, policy, *args)
+            self.titles_imported += 1
+        finally:
+            self.located_files = {}
+            with self.in_flight_lock:
+                self.in_flight_bytes -= size
+
+    def finish_batch(self, dry_run, checkpoint_file, position):
+        """Commit a batch of titles and record how far we've gotten."""
+        if dry_run:
+            return
+        self._db.commit()
+        self.write_checkpoint(checkpoint_file, position)
+
+    @classmethod
+    def read_checkpoint(cls, checkpoint_file):
+        """Find out how many records an interrupted import got through."""
+        if not checkpoint_file or not os.path.exists(checkpoint_file):
+            return 0
+        with open(checkpoint_file) as f:
+            value = f.read().strip()
+        if not value:
+            return 0
+        return int(value)
+
+    @classmethod
+    def write_checkpoint(cls, checkpoint_file, position):
+        if not checkpoint_file:
+            return
+        # Write to a temporary file and move it into place, so a crash
+        # can't leave a half-written checkpoint behind.
+        temporary = checkpoint_file + ".tmp"
+        with open(temporary, 'w') as f:
+            f.write("%d\n" % position)
+        os.rename(temporary, checkpoint_file)
+
+    def locate_file(self, base_filename, directory, extensions, file_type):
+        """Find an acceptable file in the given directory, using a file
+        read by `prepare_files` if there is one.
+        """
+        key = (base_filename, directory)
+        if key in self.located_files:
+            located = self.located_files[key]
+        else:
+            located = self._locate_file(
+                base_filename, directory, extensions, file_type
+            )
+        ignore, ignore, content = located
+        if content:
+            self.bytes_read += len(content)
+        return located
+
+    @classmethod
+    def book_url(cls, mirror, identifier, data_source, media_type,
+                 title=None):
+        """Find the URL a book file will be mirrored to."""
+        extension = Representation.FILE_EXTENSIONS[media_type]
+        if mirror:
+            return mirror.book_url(
+                identifier, '.' + extension, data_source=data_source,
+                title=title
+            )
+        # This is a dry run and we won't be mirroring anything.
+        return identifier.identifier + "." + extension
+
+    @classmethod
+    def cover_url(cls, mirror, identifier, data_source, media_type,
+                  title=None):
+        """Find the URL a cover image will be mirrored to."""
+        cover_filename = (
+            identifier.identifier
+            + '.' + Representation.FILE_EXTENSIONS[media_type]
+        )
+        if mirror:
+            return mirror.cover_image_url(
+                data_source, identifier, cover_filename
+            )
+        # This is a dry run and we won't be mirroring anything.
+        return cover_filename
 
     def load_collection(self, collection_name, data_source_name):
         """Create or locate a Collection with the given name.
@@ -1177,17 +1710,18 @@ class DirectoryImportScript(Script):
         return collection, mirror
 
     def load_metadata(self, metadata_file, metadata_format, data_source_name):
-        """Read a metadata file and convert the data into Metadata records."""
-        metadata_records = []
+        """Read a metadata file and convert the data into Metadata records.
 
+        :return: A generator that reads the file one record at a time.
+        """
         if metadata_format == 'marc':
             extractor = MARCExtractor()
         elif metadata_format == 'onix':
             extractor = ONIXExtractor()
 
         with open(metadata_file) as f:
-            metadata_records.extend(extractor.parse(f, data_source_name))
-        return metadata_records
+            for metadata in extractor.iterate(f, data_source_name):
+                yield metadata
 
     def work_from_metadata(self, collection, metadata, policy, *args, **kwargs):
         self.annotate_metadata(metadata, policy, *args, **kwargs)
@@ -1256,7 +1790,7 @@ class DirectoryImportScript(Script):
         :return: A CirculationData that contains the book as an open-access
         download, or None if no such book can be found.
         """
-        ignore, book_media_type, book_content = self._locate_file(
+        ignore, book_media_type, book_content = self.locate_file(
             identifier.identifier, ebook_directory,
             Representation.COMMON_EBOOK_EXTENSIONS,
             "ebook file",
@@ -1266,16 +1800,9 @@ class DirectoryImportScript(Script):
             # no point in proceeding.
             return
 
-        if mirror:
-            book_url = mirror.book_url(
-                identifier,
-                '.' + Representation.FILE_EXTENSIONS[book_media_type],
-                data_source=data_source,
-                title=title
-            )
-        else:
-            # This is a dry run and we won't be mirroring anything.
-            book_url = identifier.identifier + "." + Representation.FILE_EXTENSIONS[book_media_type]
+        book_url = self.book_url(
+            mirror, identifier, data_source, book_media_type, title=title
+        )
 
         book_link = LinkData(
             rel=Hyperlink.OPEN_ACCESS_DOWNLOAD,
@@ -1305,26 +1832,17 @@ class DirectoryImportScript(Script):
        :return: A LinkData containing a cover of the book, or None
        if no book cover can be found.
        """
-       cover_filename, cover_media_type, cover_content = self._locate_file(
+       cover_filename, cover_media_type, cover_content = self.locate_file(
            identifier.identifier, cover_directory,
            Representation.COMMON_IMAGE_EXTENSIONS, "cover image"
        )
 
        if not cover_content:
            return None
-       cover_filename = (
-           identifier.identifier
-           + '.' + Representation.FILE_EXTENSIONS[cover_media_type]
+       cover_url = self.cover_url(
+           mirror, identifier, data_source, cover_media_type
        )
 
-       if mirror:
-           cover_url = mirror.cover_image_url(
-               data_source, identifier, cover_filename
-           )
-       else:
-           # This is a dry run and we won't be mirroring anything.
-           cover_url = cover_filename
-
        cover_link = LinkData(
            rel=Hyperlink.IMAGE,
            href=cover_url,
@@ -1454,11 +1972,23 @@ You'll get another chance to back out before the database session is committed."
 
 class NovelistSnapshotScript(LibraryInputScript):
 
+    @classmethod
+    def arg_parser(cls, _db):
+        parser = LibraryInputScript.arg_parser(_db)
+        parser.add_argument(
+            '--incremental',
+            help="Only send items that have changed since the last snapshot.",
+            action='store_true'
+        )
+        return parser
+
     def do_run(self, output=sys.stdout, *args, **kwargs):
         parsed = self.parse_command_line(self._db, *args, **kwargs)
         api = NoveListAPI.from_config(parsed.libraries[0])
         if (api):
-            response = api.put_items_novelist(parsed.libraries[0])
+            response = api.put_items_novelist(
+                parsed.libraries[0], incremental=parsed.incremental
+            )
 
             if (response):
                 result = "NoveList Snapshot"
@@ -1467,6 +1997,35 @@ class NovelistSnapshotScript(LibraryInputScript):
 
                 output.write(result)
 
+class NovelistRecommendationsScript(LibraryInputScript):
+    """Fetch NoveList recommendations for each library's most popular
+    books ahead of time, so they're ready when patrons ask for them."""
+
+    @classmethod
+    def arg_parser(cls, _db):
+        parser = LibraryInputScript.arg_parser(_db)
+        parser.add_argument(
+            '--limit',
+            help="Look at this many of each library's most popular books.",
+            type=int,
+            default=None
+        )
+        return parser
+
+    def do_run(self, output=sys.stdout, *args, **kwargs):
+        parsed = self.parse_command_line(self._db, *args, **kwargs)
+        for library in parsed.libraries:
+            if not NoveListAPI.is_configured(library):
+                continue
+            api = NoveListAPI.from_config(library)
+            fetched = api.prefetch_recommendations(library, limit=parsed.limit)
+            self._db.commit()
+            output.write(
+                "Fetched recommendations for %d books in %s\n" % (
+                    fetched, library.short_name
+                )
+            )
+
 class ODLBibliographicImportScript(OPDSImportScript):
     """Import bibliographic information from the feed associated
     with an ODL collection."""
@@ -30,6 +30,7 @@ from api.admin.controller import (
 from api.admin.problem_details import *
 from api.admin.exceptions import *
 from api.admin.routes import setup_admin
+from api.monitor import DashboardStatsMonitor
 from api.config import (
     Configuration,
     temp_config,
@@ -2626,6 +2627,19 @@ class TestDashboardController(AdminControllerTest):
             eq_(1, patron_data.get('loans'))
             eq_(1, patron_data.get('holds'))
 
+    def test_stats_uses_stored_statistics(self):
+        # Once the monitor has stored some statistics, they're used
+        # instead of being calculated on every request.
+        stats = DashboardStatsMonitor.calculate(self._db)
+        stats['patrons']['total'] = 1000
+        DashboardStatsMonitor.store(self._db, stats)
+
+        with self.app.test_request_context("/"):
+            response = self.manager.admin_dashboard_controller.stats()
+            eq_(1000, response['patrons']['total'])
+            eq_(stats['inventory'], response['inventory'])
+            eq_(stats['vendors'], response['vendors'])
+
     def test_stats_inventory(self):
         with self.app.test_request_context("/"):
 
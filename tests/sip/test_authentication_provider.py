@@ -60,10 +60,15 @@ class TestSIP2AuthenticationProvider(DatabaseTest):
         # Default port is 6001.
         eq_(6001, client.target_port)
 
-        # Try again, specifying a port.
+        # By default, only one connection is made to the server.
+        eq_(1, client.size)
+
+        # Try again, specifying a port and a connection pool size.
         integration.setting(p.PORT).value = "1234"
+        integration.setting(p.CONNECTION_POOL_SIZE).value = "4"
         provider = p(self._default_library, integration, connect=False)
         eq_(1234, provider.client.target_port)
+        eq_(4, provider.client.size)
         
     def test_remote_authenticate(self):
         integration = self._external_integration(self._str)
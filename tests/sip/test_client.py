@@ -11,6 +11,7 @@ from api.sip.client import (
     CannotSendMockSIPClient,
     MockSIPClient,
     SIPClient,
+    SIPClientPool,
 )
 
 class MockSocket(object):
@@ -131,6 +132,143 @@ class TestNetworkError(object):
         eq_(expect, sip.status)
 
 
+class TestSCStatus(object):
+
+    def test_sc_status(self):
+        sip = MockSIPClient()
+        sip.queue_response('98YYYYNN01000320161005    1147342.00AOnypl |AMNYPL|BXYYYYYYYYYYYYYYYY|AY0AZEC6A')
+        response = sip.sc_status()
+        eq_('9900002.00|AY0AZFC2D\r', sip.requests[-1])
+        eq_('Y', response['online_status'])
+        eq_('2.00', response['protocol_version'])
+        eq_('nypl ', response['institution_id'])
+        eq_('NYPL', response['library_name'])
+
+
+class TestSIPClientPool(object):
+
+    def test_configuration_comes_from_first_client(self):
+        pool = SIPClientPool(
+            size=3, client_class=MockSIPClient, login_user_id='user_id',
+            login_password='password', separator='^'
+        )
+        eq_(3, pool.size)
+        eq_('user_id', pool.login_user_id)
+        eq_('password', pool.login_password)
+        eq_('^', pool.separator)
+
+        # One connection was created immediately.
+        eq_(1, len(pool.idle))
+        eq_(0, pool.in_use)
+
+    def test_connections_are_reused(self):
+        pool = SIPClientPool(size=2, client_class=MockSIPClient)
+        [(client, last_used)] = pool.idle
+        client.queue_response('941')
+        pool.login('user_id', 'password')
+
+        # The same connection was used, and it went back into the pool.
+        eq_(1, len(client.requests))
+        eq_([client], [x for x, last_used in pool.idle])
+        eq_(0, pool.in_use)
+
+    def test_each_connection_has_its_own_state(self):
+        pool = SIPClientPool(
+            size=2, client_class=MockSIPClient, login_user_id='user_id',
+            login_password='password'
+        )
+        client1 = pool.checkout()
+        client2 = pool.checkout()
+        assert client1 != client2
+        eq_(2, pool.in_use)
+
+        client1.queue_response('941')
+        client1.login('user_id', 'password')
+        eq_(1, client1.sequence_number)
+        eq_(0, client2.sequence_number)
+
+        pool.checkin(client1)
+        pool.checkin(client2)
+        eq_(0, pool.in_use)
+        eq_(2, len(pool.idle))
+
+    def test_checkout_times_out_when_pool_is_exhausted(self):
+        pool = SIPClientPool(
+            size=1, checkout_timeout=0, client_class=MockSIPClient
+        )
+        client = pool.checkout()
+        assert_raises(IOError, pool.checkout)
+
+        # Once the connection is returned, it can be checked out again.
+        pool.checkin(client)
+        eq_(client, pool.checkout())
+
+    def test_failed_request_discards_connection(self):
+        pool = SIPClientPool(size=1, client_class=CannotSendMockSIPClient)
+        [(client, last_used)] = pool.idle
+        assert_raises(IOError, pool.login, 'user_id', 'password')
+
+        # The client reconnected and retried once, as usual, and was
+        # then closed and removed from the pool.
+        eq_(['Creating new socket connection.',
+             'I was unable to send data.'] * 2 +
+            ['Closing socket connection.'], client.status)
+        eq_([], pool.idle)
+        eq_(0, pool.in_use)
+
+        # The next request gets a brand new connection.
+        assert client != pool.checkout()
+
+    def test_idle_connections_are_evicted(self):
+        pool = SIPClientPool(
+            size=2, max_idle_time=10, client_class=MockSIPClient
+        )
+        [(old, last_used)] = pool.idle
+        pool.idle = [(old, last_used-100)]
+
+        # The stale connection is closed rather than reused.
+        new = pool.checkout()
+        assert new != old
+        eq_('Closing socket connection.', old.status[-1])
+
+        # Returning a connection to the pool also sweeps out any
+        # stale connections.
+        other = pool.checkout()
+        pool.checkin(other)
+        pool.idle = [(other, last_used-100)]
+        pool.checkin(new)
+        eq_([new], [x for x, last_used in pool.idle])
+        eq_('Closing socket connection.', other.status[-1])
+
+    def test_health_check(self):
+        pool = SIPClientPool(
+            size=1, health_check_interval=10, client_class=MockSIPClient
+        )
+        [(client, last_used)] = pool.idle
+
+        # A connection that's been idle for a while is checked with an
+        # SC status request before being reused.
+        pool.idle = [(client, last_used-20)]
+        client.queue_response('98YYYYNN01000320161005    1147342.00AOnypl |BXYYYYYYYYYYYYYYYY|AY0AZEC6A')
+        eq_(client, pool.checkout())
+        assert client.requests[-1].startswith('99')
+        pool.checkin(client)
+
+        # If the health check fails, the connection is discarded.
+        pool.idle = [(client, last_used-20)]
+        client.queue_response('garbage')
+        new = pool.checkout()
+        assert new != client
+        eq_('Closing socket connection.', client.status[-1])
+
+    def test_close(self):
+        pool = SIPClientPool(size=1, client_class=MockSIPClient)
+        [(client, last_used)] = pool.idle
+        pool.close()
+        eq_([], pool.idle)
+        eq_('Closing socket connection.', client.status[-1])
+
+
 class TestLogin(object):
        
     def test_login_success(self):
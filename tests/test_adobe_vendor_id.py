@@ -705,6 +705,22 @@ class TestAuthdataUtility(VendorIDTest):
         eq_(None, AuthdataUtility.from_config(library))
 
             
+    def test_for_library(self):
+        library = self._default_library
+        self.initialize_adobe(library)
+
+        # A preloaded AuthdataUtility is used if there is one.
+        eq_(self.authdata,
+            AuthdataUtility.for_library(library, {library.id: self.authdata}))
+
+        # A library known to have no AuthdataUtility gets None.
+        eq_(None, AuthdataUtility.for_library(library, {library.id: None}))
+
+        # Otherwise the AuthdataUtility is loaded from configuration.
+        for registry in (None, {}):
+            utility = AuthdataUtility.for_library(library, registry)
+            eq_(self.TEST_VENDOR_ID, utility.vendor_id)
+
     def test_decode_round_trip(self):        
         patron_identifier = "Patron identifier"
         vendor_id, authdata = self.authdata.encode(patron_identifier)
@@ -272,6 +272,71 @@ class TestAnnotationWriter(AnnotationTest, ControllerTest):
             page = AnnotationWriter.annotation_page_for(patron, identifier)
             eq_(0, len(page['items']))
 
+    def test_annotation_page_for_with_paging(self):
+        patron = self._patron()
+        annotations = []
+        for i in range(5):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+            )
+            annotations.append(annotation)
+        newest_first = list(reversed(annotations))
+
+        with self.app.test_request_context("/"):
+            # The first page has two annotations and a link to the
+            # next page.
+            page = AnnotationWriter.annotation_page_for(patron, size=2)
+            eq_([x.id for x in newest_first[:2]],
+                [int(x['id'].split('/')[-1]) for x in page['items']])
+            assert "after=%s" % newest_first[1].id in page['next']
+            assert "size=2" in page['next']
+
+            # The next page picks up where the first one left off.
+            page = AnnotationWriter.annotation_page_for(
+                patron, after=newest_first[1].id, size=2
+            )
+            eq_([x.id for x in newest_first[2:4]],
+                [int(x['id'].split('/')[-1]) for x in page['items']])
+            assert "after=%s" % newest_first[1].id in page['id']
+
+            # The last page has no link to a next page.
+            page = AnnotationWriter.annotation_page_for(
+                patron, after=newest_first[3].id, size=2
+            )
+            eq_(1, len(page['items']))
+            assert 'next' not in page
+
+            # The container counts all of the annotations, but its
+            # first page only has as many as were asked for.
+            container, timestamp = AnnotationWriter.annotation_container_for(
+                patron, size=2
+            )
+            eq_(5, container['total'])
+            eq_(2, len(container['first']['items']))
+
+    def test_etag(self):
+        # An empty container's ETag and the value compared against
+        # If-None-Match come from the same place.
+        eq_('W/""', AnnotationWriter.etag(0, None))
+        eq_("", AnnotationWriter.etag_value(0, None))
+
+        changed = datetime.datetime(2018, 1, 1, 12, 30)
+        eq_('W/"2018-01-01T12:30:00/3"', AnnotationWriter.etag(3, changed))
+        eq_("2018-01-01T12:30:00/3", AnnotationWriter.etag_value(3, changed))
+
+    def test_last_modified(self):
+        # Timestamps are stored in UTC, so the local timezone of the
+        # server doesn't matter.
+        eq_(1, AnnotationWriter.last_modified(
+            datetime.datetime(1970, 1, 1, 0, 0, 1)
+        ))
+        eq_(1514809800, AnnotationWriter.last_modified(
+            datetime.datetime(2018, 1, 1, 12, 30, 0, 500)
+        ))
+
     def test_detail_target(self):
         patron = self._patron()
         identifier = self._identifier()
@@ -370,6 +435,26 @@ class TestAnnotationParser(AnnotationTest):
         }
         return data
 
+    def test_parse_compacts_annotation(self):
+        self.pool.loan_to(self.patron)
+        AnnotationWriter.compacted_cache.clear()
+        data = self._sample_jsonld()
+        annotation = AnnotationParser.parse(
+            self._db, json.dumps(data), self.patron
+        )
+
+        # The compacted target and body were cached when the annotation
+        # was parsed, so they don't have to be calculated when it's
+        # served.
+        eq_(data['body'], AnnotationWriter.compacted_cache[annotation.content])
+        assert annotation.target in AnnotationWriter.compacted_cache
+
+        # What's served is a copy of what's in the cache.
+        body = AnnotationWriter.compact(annotation.content)
+        eq_(data['body'], body)
+        body['type'] = 'Something else'
+        eq_(data['body'], AnnotationWriter.compact(annotation.content))
+
     def test_parse_invalid_json(self):
         annotation = AnnotationParser.parse(self._db, "not json", self.patron)
         eq_(INVALID_ANNOTATION_FORMAT, annotation)
@@ -14,6 +14,7 @@ import json
 import os
 from money import Money
 import re
+import threading
 import urllib
 import urlparse
 import flask
@@ -1997,6 +1998,174 @@ class TestBasicAuthenticationProviderAuthenticate(AuthenticatorTest):
         # new identifiers.
         eq_(new_username, patron.username)
 
+    def test_credential_cache(self):
+        patron = self._patron()
+        patrondata = PatronData(
+            permanent_id=patron.external_identifier,
+            authorization_identifier=patron.authorization_identifier,
+        )
+        integration = self._external_integration(
+            self._str, ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        integration.setting(MockBasic.CREDENTIAL_CACHE_TTL).value = 600
+
+        class CountingMockBasic(MockBasic):
+            remote_calls = 0
+            def remote_authenticate(self, username, password):
+                self.remote_calls += 1
+                return super(CountingMockBasic, self).remote_authenticate(
+                    username, password
+                )
+        provider = CountingMockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        eq_(600, provider.credential_cache_ttl)
+
+        # The first authentication goes to the source of truth.
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, provider.remote_calls)
+
+        # The credentials themselves are not stored anywhere.
+        [key] = provider.credential_cache.keys()
+        assert "user" not in key
+        assert "pass" not in key
+
+        # The second authentication uses the cached PatronData.
+        last_sync = patron.last_external_sync
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, provider.remote_calls)
+
+        # Reapplying the cached PatronData didn't count as a sync.
+        eq_(last_sync, patron.last_external_sync)
+
+        # A different password is checked with the source of truth,
+        # and replaces the old cache entry.
+        other_credentials = dict(username="user", password="newpass")
+        eq_(patron, provider.authenticate(self._db, other_credentials))
+        eq_(2, provider.remote_calls)
+        eq_(1, len(provider.credential_cache))
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(3, provider.remote_calls)
+
+        # If the patron is blocked, the cache entry is not used.
+        patron.block_reason = PatronData.EXCESSIVE_FINES
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(4, provider.remote_calls)
+
+        # A PatronData that says the patron is blocked is not cached.
+        patrondata.block_reason = PatronData.EXCESSIVE_FINES
+        provider.authenticate(self._db, self.credentials)
+        eq_({}, provider.credential_cache)
+
+    def test_credential_cache_expires(self):
+        patron = self._patron()
+        patrondata = PatronData(permanent_id=patron.external_identifier)
+        integration = self._external_integration(
+            self._str, ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        integration.setting(MockBasic.CREDENTIAL_CACHE_TTL).value = 600
+        provider = MockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        provider.authenticate(self._db, self.credentials)
+        eq_(patrondata, provider.cached_patrondata("user", "pass"))
+
+        # Make the cache entry expire.
+        [(key, (expires, cached))] = provider.credential_cache.items()
+        provider.credential_cache[key] = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=1), cached
+        )
+        eq_(None, provider.cached_patrondata("user", "pass"))
+        eq_({}, provider.credential_cache)
+
+    def test_credential_cache_is_bounded(self):
+        patrondata = PatronData(permanent_id=self._str)
+        integration = self._external_integration(
+            self._str, ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        integration.setting(MockBasic.CREDENTIAL_CACHE_TTL).value = 600
+        provider = MockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        provider.MAX_CACHED_CREDENTIALS = 2
+
+        # Expired entries are removed the next time anything is
+        # cached, even if nobody asks for them again.
+        provider.cache_patrondata("user1", "pass", patrondata)
+        [key] = provider.credential_cache.keys()
+        expires, cached = provider.credential_cache[key]
+        provider.credential_cache[key] = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=1), cached
+        )
+        provider.cache_patrondata("user2", "pass", patrondata)
+        eq_(1, len(provider.credential_cache))
+        eq_(None, provider.cached_patrondata("user1", "pass"))
+        eq_(patrondata, provider.cached_patrondata("user2", "pass"))
+        eq_(["user2"], provider.credential_cache_key_for_username.keys())
+
+        # Once the cache is full, the oldest entries are forgotten
+        # to make room for new ones.
+        provider.cache_patrondata("user3", "pass", patrondata)
+        provider.cache_patrondata("user4", "pass", patrondata)
+        eq_(2, len(provider.credential_cache))
+        eq_(None, provider.cached_patrondata("user2", "pass"))
+        eq_(patrondata, provider.cached_patrondata("user3", "pass"))
+        eq_(patrondata, provider.cached_patrondata("user4", "pass"))
+        eq_(set(["user3", "user4"]),
+            set(provider.credential_cache_key_for_username.keys()))
+        eq_(2, len(provider.credential_cache_username_for_key))
+
+    def test_credential_cache_is_thread_safe(self):
+        patrondata = PatronData(permanent_id=self._str)
+        integration = self._external_integration(
+            self._str, ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        integration.setting(MockBasic.CREDENTIAL_CACHE_TTL).value = 600
+        provider = MockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        provider.MAX_CACHED_CREDENTIALS = 5
+
+        # Many request threads cache, look up, and invalidate
+        # credentials at once.
+        errors = []
+        def hammer(thread):
+            try:
+                for i in range(200):
+                    username = "user%d" % ((thread * 7 + i) % 20)
+                    provider.cache_patrondata(username, "pass", patrondata)
+                    provider.cached_patrondata(username, "pass")
+                    if i % 3 == 0:
+                        provider.invalidate_cached_credentials(username)
+            except Exception, e:
+                errors.append(e)
+        threads = [
+            threading.Thread(target=hammer, args=(i,)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_([], errors)
+
+        # The cache and its bookkeeping still agree with each other.
+        assert len(provider.credential_cache) <= 5
+        eq_(set(provider.credential_cache.keys()),
+            set(provider.credential_cache_username_for_key.keys()))
+        eq_(set(provider.credential_cache.keys()),
+            set(provider.credential_cache_key_for_username.values()))
+        for username, key in provider.credential_cache_key_for_username.items():
+            eq_(username, provider.credential_cache_username_for_key[key])
+
+    def test_credential_cache_disabled_by_default(self):
+        patron = self._patron()
+        patrondata = PatronData(permanent_id=patron.external_identifier)
+        provider = self.mock_basic(patrondata=patrondata)
+        eq_(0, provider.credential_cache_ttl)
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_({}, provider.credential_cache)
+        eq_(None, provider.cached_patrondata("user", "pass"))
+
     # Notice what's missing: If a patron has no permanent identifier,
     # _and_ their username and authorization identifier both change,
     # then we have no way of locating them in our database. They will
@@ -400,6 +400,47 @@ class TestCirculationMonitor(Axis360Test):
         eq_(9, licensepool.licenses_owned)
 
 
+    def test_process_batch(self):
+        monitor = Axis360CirculationMonitor(
+            self._db, self.collection, api_class=MockAxis360API,
+        )
+        processed = []
+        old_process_book = monitor.process_book
+        def process_book(bibliographic, availability, **kwargs):
+            processed.append(kwargs)
+            return old_process_book(bibliographic, availability, **kwargs)
+        monitor.process_book = process_book
+
+        # The first time through, the book is new.
+        books = [(self.BIBLIOGRAPHIC_DATA, self.AVAILABILITY_DATA)]
+        monitor.process_batch(books)
+        [kwargs] = processed
+        eq_(None, kwargs['license_pool'])
+        eq_(None, kwargs['edition'])
+        [license_pool] = self._db.query(LicensePool).filter(
+            LicensePool.collection==self.collection
+        ).all()
+        eq_(9, license_pool.licenses_owned)
+
+        # The second time, its LicensePool and Edition were found
+        # ahead of time and passed in.
+        availability = CirculationData(
+            data_source=DataSource.AXIS_360,
+            primary_identifier=self.BIBLIOGRAPHIC_DATA.primary_identifier,
+            licenses_owned=10,
+            licenses_available=10,
+            licenses_reserved=0,
+            patrons_in_hold_queue=0,
+            last_checked=datetime.datetime(2015, 5, 21),
+        )
+        monitor.process_batch([(self.BIBLIOGRAPHIC_DATA, availability)])
+        kwargs = processed[-1]
+        eq_(license_pool, kwargs['license_pool'])
+        edition = kwargs['edition']
+        eq_(license_pool.identifier, edition.primary_identifier)
+        eq_(DataSource.AXIS_360, edition.data_source.name)
+        eq_(10, license_pool.licenses_owned)
+
 class TestReaper(Axis360Test):
 
     def test_instantiate(self):
@@ -15,6 +15,9 @@ from datetime import (
     datetime, 
     timedelta,
 )
+import threading
+import time
+from sqlalchemy import event
 
 from api.circulation_exceptions import *
 from api.circulation import (
@@ -24,6 +27,7 @@ from api.circulation import (
     FulfillmentInfo,
     LoanInfo,
     HoldInfo,
+    PatronActivityExecutor,
 )
 
 from core.config import CannotLoadConfiguration
@@ -636,6 +640,60 @@ class TestCirculationAPI(DatabaseTest):
         result = try_to_fulfill()
         eq_(fulfillment, result)
             
+    def test_borrow_and_fulfill_sync_only_one_collection(self):
+        # The patron has loans in two collections.
+        other_collection = self._collection()
+        edition, other_pool = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=other_collection
+        )
+        other_loan, ignore = other_pool.loan_to(self.patron)
+        other_loan.start = self.YESTERDAY
+
+        class CountingCirculationAPI(MockCirculationAPI):
+            calls = []
+            def patron_activity(self, patron, pin, collection_ids=None):
+                self.calls.append(collection_ids)
+                return [], [], True
+
+        circulation = CountingCirculationAPI(
+            self._db, self._default_library,
+            api_map={ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI}
+        )
+        circulation.api_for_collection[other_collection.id] = object()
+        circulation.collection_ids_for_sync.append(other_collection.id)
+
+        # When the patron renews a loan, only the collection containing
+        # that loan is synced.
+        loan, ignore = self.pool.loan_to(self.patron)
+        loan.start = self.YESTERDAY
+        loaninfo = LoanInfo(
+            self.pool.collection, self.pool.data_source,
+            self.identifier.type, self.identifier.identifier,
+            self.YESTERDAY, self.IN_TWO_WEEKS,
+        )
+        circulation.queue_checkout(self.pool, loaninfo)
+        circulation.borrow(
+            self.patron, '1234', self.pool, self.delivery_mechanism
+        )
+        eq_([[self.collection.id]], circulation.calls)
+
+        # The loan in the other collection was left alone, even though
+        # the vendor didn't mention it.
+        assert other_loan in self.patron.loans
+
+        # When fulfillment fails for lack of a loan, only the
+        # collection containing the book is synced.
+        self._db.delete(loan)
+        self._db.commit()
+        assert_raises(
+            NoActiveLoan, circulation.fulfill, self.patron, '1234',
+            self.pool, self.delivery_mechanism
+        )
+        eq_([[self.collection.id]] * 2, circulation.calls)
+        assert other_loan in self.patron.loans
+
     def test_revoke_loan_sends_analytics_event(self):
         self.pool.loan_to(self.patron)
         self.remote.queue_checkin(True)
@@ -732,7 +790,7 @@ class TestCirculationAPI(DatabaseTest):
         loan.start = self.YESTERDAY
 
         class IncompleteCirculationAPI(MockCirculationAPI):
-            def patron_activity(self, patron, pin):
+            def patron_activity(self, patron, pin, collection_ids=None):
                 # A remote API failed, and we don't know if
                 # the patron has any loans or holds.
                 return [], [], False
@@ -749,7 +807,7 @@ class TestCirculationAPI(DatabaseTest):
         eq_([loan], loans)
 
         class CompleteCirculationAPI(MockCirculationAPI):
-            def patron_activity(self, patron, pin):
+            def patron_activity(self, patron, pin, collection_ids=None):
                 # All the remote API calls succeeded, so
                 # now we know the patron has no loans.
                 return [], [], True
@@ -763,6 +821,74 @@ class TestCirculationAPI(DatabaseTest):
         loans = self._db.query(Loan).all()
         eq_([], loans)
         
+    def test_sync_bookshelf_respects_minimum_interval(self):
+        self._default_library.setting(
+            Configuration.MINIMUM_BOOKSHELF_SYNC_INTERVAL
+        ).value = 600
+
+        class CountingCirculationAPI(MockCirculationAPI):
+            calls = []
+            def patron_activity(self, patron, pin, collection_ids=None):
+                self.calls.append(collection_ids)
+                return super(CountingCirculationAPI, self).patron_activity(
+                    patron, pin, collection_ids
+                )
+
+        circulation = CountingCirculationAPI(
+            self._db, self._default_library,
+            api_map={ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI}
+        )
+        eq_(600, circulation.minimum_sync_interval)
+        circulation.add_remote_loan(
+            self.pool.collection, self.pool.data_source,
+            self.identifier.type, self.identifier.identifier,
+            self.YESTERDAY, self.TOMORROW
+        )
+
+        # The first sync goes to the vendor.
+        loans, holds = circulation.sync_bookshelf(self.patron, "1234")
+        eq_([[self.collection.id]], circulation.calls)
+        [loan] = loans
+        eq_(self.pool, loan.license_pool)
+        assert (self.patron.id, self.collection.id) in circulation.last_bookshelf_sync
+
+        # The second sync is served from the database.
+        loans, holds = circulation.sync_bookshelf(self.patron, "1234")
+        eq_(1, len(circulation.calls))
+        eq_([loan], loans)
+
+        # A forced sync goes to the vendor anyway.
+        circulation.sync_bookshelf(self.patron, "1234", force=True)
+        eq_([[self.collection.id], None], circulation.calls)
+
+        # Revoking a loan means the next sync goes to the vendor.
+        circulation.queue_checkin(self.pool, True)
+        circulation.revoke_loan(self.patron, "1234", self.pool)
+        eq_({}, circulation.last_bookshelf_sync)
+        circulation.sync_bookshelf(self.patron, "1234")
+        eq_(3, len(circulation.calls))
+
+        # So does releasing a hold.
+        circulation.queue_release_hold(self.pool, True)
+        circulation.release_hold(self.patron, "1234", self.pool)
+        eq_({}, circulation.last_bookshelf_sync)
+
+    def test_sync_bookshelf_without_minimum_interval_always_syncs(self):
+        class CountingCirculationAPI(MockCirculationAPI):
+            calls = []
+            def patron_activity(self, patron, pin, collection_ids=None):
+                self.calls.append(collection_ids)
+                return [], [], True
+
+        circulation = CountingCirculationAPI(
+            self._db, self._default_library,
+            api_map={ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI}
+        )
+        eq_(0, circulation.minimum_sync_interval)
+        circulation.sync_bookshelf(self.patron, "1234")
+        circulation.sync_bookshelf(self.patron, "1234")
+        eq_([None, None], circulation.calls)
+
     def test_sync_bookshelf_updates_local_loan_and_hold_with_modified_timestamps(self):
         # We have a local loan that supposedly runs from yesterday
         # until tomorrow.
@@ -805,6 +931,38 @@ class TestCirculationAPI(DatabaseTest):
         eq_(self.IN_TWO_WEEKS, hold.end)
         eq_(0, hold.position)
 
+    def test_sync_bookshelf_with_repeated_remote_loan_and_hold(self):
+        # The patron already has a loan and a hold.
+        loan, ignore = self.pool.loan_to(self.patron)
+        edition, pool2 = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        hold, ignore = pool2.on_hold_to(self.patron)
+
+        # The remote mentions each of them twice.
+        for i in range(2):
+            self.circulation.add_remote_loan(
+                self.pool.collection, self.pool.data_source,
+                self.identifier.type, self.identifier.identifier,
+                self.TODAY, self.IN_TWO_WEEKS
+            )
+            self.circulation.add_remote_hold(
+                pool2.collection, pool2.data_source, pool2.identifier.type,
+                pool2.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS,
+                0
+            )
+        loans, holds = self.circulation.sync_bookshelf(self.patron, "1234")
+
+        # The existing loan and hold are used once each, and no new
+        # ones are created.
+        eq_([loan], loans)
+        eq_([hold], holds)
+        self._db.flush()
+        eq_([loan], self.patron.loans)
+        eq_([hold], self.patron.holds)
+
     def test_sync_bookshelf_applies_locked_delivery_mechanism_to_loan(self):
 
         # By the time we hear about the patron's loan, they've already
@@ -833,6 +991,69 @@ class TestCirculationAPI(DatabaseTest):
         self._db.commit()
         assert loan.fulfillment in pool.delivery_mechanisms
         
+    def test_sync_bookshelf_query_count_does_not_grow_with_bookshelf(self):
+        # The patron has 100 items on their bookshelf. 90 of them are
+        # already known locally, but the vendor has new dates for
+        # them; the other 10 are new to us.
+        def make_pool():
+            edition, pool = self._edition(
+                data_source_name=DataSource.BIBLIOTHECA,
+                identifier_type=Identifier.BIBLIOTHECA_ID,
+                with_license_pool=True, collection=self.collection
+            )
+            return pool
+
+        def add_remote(method, pool, *args):
+            method(
+                pool.collection, pool.data_source, pool.identifier.type,
+                pool.identifier.identifier, *args
+            )
+
+        loans = []
+        holds = []
+        for i in range(50):
+            pool = make_pool()
+            if i < 45:
+                loan, ignore = pool.loan_to(self.patron)
+                loan.start = self.YESTERDAY
+                loans.append(loan)
+            add_remote(self.circulation.add_remote_loan, pool,
+                       self.TODAY, self.IN_TWO_WEEKS)
+
+            pool = make_pool()
+            if i < 45:
+                hold, ignore = pool.on_hold_to(self.patron)
+                hold.position = 10
+                holds.append(hold)
+            add_remote(self.circulation.add_remote_hold, pool,
+                       self.TODAY, self.IN_TWO_WEEKS, 5)
+
+        # One stale local loan will be deleted.
+        stale, ignore = make_pool().loan_to(self.patron)
+        stale.start = self.YESTERDAY
+        self._db.flush()
+
+        statements = []
+        def count(*args, **kwargs):
+            statements.append(args[2])
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            loans, holds = self.sync_bookshelf()
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+
+        eq_(50, len(loans))
+        eq_(50, len(holds))
+        eq_(set([self.IN_TWO_WEEKS]), set(x.end for x in loans))
+        eq_(set([5]), set(x.position for x in holds))
+        assert stale not in self._db.query(Loan).all()
+
+        # Resolving each item separately took several hundred queries.
+        # Now it's a handful of SELECTs, the inserts for the ten new
+        # items, and a few batched UPDATEs and DELETEs.
+        assert len(statements) < 40, "%d queries" % len(statements)
+
     def test_patron_activity(self):
         # Get a CirculationAPI that doesn't mock out its API's patron activity.
         circulation = CirculationAPI(
@@ -856,6 +1077,162 @@ class TestCirculationAPI(DatabaseTest):
         eq_(0, len(holds))
         eq_(False, complete)        
 
+    def test_patron_activity_with_executor(self):
+        # A CirculationAPI can use a long-lived PatronActivityExecutor
+        # instead of creating new threads every time.
+        loaninfo = LoanInfo(
+            self.collection, self.pool.data_source.name,
+            self.identifier.type, self.identifier.identifier,
+            self.YESTERDAY, self.TOMORROW
+        )
+        release = threading.Event()
+
+        class Fast(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                return [loaninfo]
+
+        class Slow(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                release.wait(5)
+                return []
+
+        executor = PatronActivityExecutor(workers=2, timeout=0.1)
+        circulation = CirculationAPI(
+            self._db, self._default_library, executor=executor
+        )
+        circulation.api_for_collection = { 1: Fast() }
+
+        # When every vendor responds in time, the sync is complete.
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_([loaninfo], loans)
+        eq_([], holds)
+        eq_(True, complete)
+        eq_(2, len(executor.threads))
+
+        # The vendor's response time was recorded.
+        [(upper_bound, count)] = [
+            x for x in executor.latency_histograms()['Fast'] if x[1]
+        ]
+        eq_(PatronActivityExecutor.LATENCY_BUCKETS[0], upper_bound)
+        eq_(1, count)
+
+        # When a vendor is too slow, we don't wait for it, but the sync
+        # is marked as incomplete.
+        circulation.api_for_collection = { 1: Fast(), 2: Slow() }
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_([loaninfo], loans)
+        eq_(False, complete)
+        eq_(1, executor.timeouts['Slow'])
+        eq_(0, executor.timeouts['Fast'])
+
+        # The same worker threads were used both times.
+        eq_(2, len(executor.threads))
+        release.set()
+        executor.shutdown()
+        eq_([], executor.threads)
+
+    def test_patron_activity_vendor_timeouts_and_limits(self):
+        release = threading.Event()
+
+        class Slow(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                release.wait(5)
+                return []
+
+        class Patient(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                time.sleep(0.2)
+                return []
+
+        class MockSession(object):
+            removed = 0
+            def remove(self):
+                self.removed += 1
+
+        def wait_for(condition):
+            for i in range(50):
+                if condition():
+                    return
+                time.sleep(0.1)
+
+        session = MockSession()
+        executor = PatronActivityExecutor(
+            workers=4, timeout=0.1, vendor_timeouts=dict(Patient=2),
+            max_tasks_per_collection=1, session=session
+        )
+        circulation = CirculationAPI(
+            self._db, self._default_library, executor=executor
+        )
+
+        # Each vendor gets its own timeout. Patient is slower than the
+        # default timeout, but it has a longer one of its own.
+        circulation.api_for_collection = { 1: Slow(), 2: Patient() }
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(False, complete)
+        eq_(1, executor.timeouts['Slow'])
+        eq_(0, executor.timeouts['Patient'])
+        wait_for(lambda: executor.running[('Patient', 2)] == 0)
+        eq_(1, executor.running[('Slow', 1)])
+
+        # Slow's first collection is still tying up a worker, so the
+        # next sync doesn't give it another one. The sync is
+        # incomplete, but Patient is still checked, and so is another
+        # collection that happens to use the same vendor.
+        circulation.api_for_collection[3] = Slow()
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(False, complete)
+        eq_(1, executor.rejections['Slow'])
+        eq_(2, executor.timeouts['Slow'])
+        eq_(0, executor.rejections['Patient'])
+        eq_(0, executor.timeouts['Patient'])
+        eq_(1, executor.running[('Slow', 3)])
+
+        # Once Slow finishes, its workers are freed up. Every task's
+        # worker removed its database session when it was done.
+        release.set()
+        wait_for(lambda: session.removed == 4)
+        eq_(0, executor.running[('Slow', 1)])
+        eq_(0, executor.running[('Slow', 3)])
+        eq_(4, session.removed)
+        executor.shutdown()
+
+    def test_patron_activity_timeout_starts_when_task_runs(self):
+        class Sleepy(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                time.sleep(0.3)
+                return []
+
+        # With only one worker, the second collection waits for the
+        # first to finish. The time spent waiting doesn't count
+        # against its timeout.
+        executor = PatronActivityExecutor(workers=1, timeout=0.5)
+        circulation = CirculationAPI(
+            self._db, self._default_library, executor=executor
+        )
+        circulation.api_for_collection = { 1: Sleepy(), 2: Sleepy() }
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(True, complete)
+        eq_(0, executor.timeouts['Sleepy'])
+        eq_(0, executor.rejections['Sleepy'])
+        executor.shutdown()
+
+    def test_executor_limit_is_sized_from_workers(self):
+        eq_(5, PatronActivityExecutor(workers=10).max_tasks_per_collection)
+        eq_(1, PatronActivityExecutor(workers=1).max_tasks_per_collection)
+        eq_(3, PatronActivityExecutor(
+            workers=10, max_tasks_per_collection=3
+        ).max_tasks_per_collection)
+
     def test_can_fulfill_without_loan(self):
         """Can a title can be fulfilled without an active loan?  It depends on
         the BaseCirculationAPI implementation for that title's colelction.
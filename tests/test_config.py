@@ -4,12 +4,18 @@ from nose.tools import (
     set_trace,
 )
 import json
+from sqlalchemy import event
 
+from core.lane import Facets
 from core.model import (
     ConfigurationSetting
 )
 from . import DatabaseTest
-from api.config import Configuration
+from api.config import (
+    Configuration,
+    ConfigurationSnapshot,
+    SiteConfigurationWatcher,
+)
 
 class TestConfiguration(DatabaseTest):
 
@@ -106,3 +112,166 @@ class TestConfiguration(DatabaseTest):
         eq_([['fre', 'jpn'], ['spa', 'ukr', 'ira'], ['nav']],
             m(different_sizes))
         
+
+
+class TestConfigurationSnapshot(DatabaseTest):
+
+    def test_from_database(self):
+        library = self._default_library
+        other = self._library(short_name="other")
+        integration = self._external_integration(self._str)
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.PATRON_WEB_CLIENT_URL
+        ).value = "http://web/"
+        ConfigurationSetting.for_library(
+            Configuration.LOAN_LIMIT, other
+        ).value = "5"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, "username", other, integration
+        ).value = "someone"
+
+        snapshot = ConfigurationSnapshot.from_database(self._db, "version")
+        eq_("version", snapshot.version)
+
+        # Libraries can be found by short name.
+        eq_(library.id, snapshot.library_id(library.short_name))
+        eq_(other.id, snapshot.library_id("other"))
+        eq_(None, snapshot.library_id("no such library"))
+        eq_(library.id, snapshot.library_id(None))
+
+        # Settings can be found without going to the database.
+        eq_("http://web/", snapshot.sitewide(
+            Configuration.PATRON_WEB_CLIENT_URL
+        ))
+        eq_("5", snapshot.for_library(Configuration.LOAN_LIMIT, other))
+        eq_("5", snapshot.for_library(Configuration.LOAN_LIMIT, other.id))
+        eq_(None, snapshot.for_library(Configuration.LOAN_LIMIT, library))
+        eq_("someone", snapshot.setting(
+            "username", library=other, integration=integration
+        ))
+        eq_(None, snapshot.setting("username", integration=integration))
+
+        # Changes made after the snapshot is taken don't show up in it.
+        ConfigurationSetting.for_library(
+            Configuration.LOAN_LIMIT, other
+        ).value = "6"
+        eq_("5", snapshot.for_library(Configuration.LOAN_LIMIT, other))
+
+
+    def test_library_settings(self):
+        library = self._default_library
+        ConfigurationSetting.for_library(
+            Configuration.LOAN_LIMIT, library
+        ).value = "5"
+        ConfigurationSetting.for_library(
+            Configuration.MAX_OUTSTANDING_FINES, library
+        ).value = "$1.50"
+        ConfigurationSetting.for_library(
+            Configuration.DEFAULT_FACET_KEY_PREFIX
+            + Facets.ORDER_FACET_GROUP_NAME, library
+        ).value = Facets.ORDER_AUTHOR
+        ConfigurationSetting.for_library(
+            Configuration.ENABLED_FACETS_KEY_PREFIX
+            + Facets.ORDER_FACET_GROUP_NAME, library
+        ).value = json.dumps([Facets.ORDER_AUTHOR, Facets.ORDER_TITLE])
+        lending_policy = object()
+        snapshot = ConfigurationSnapshot.from_database(
+            self._db, lending_policy=lending_policy
+        )
+
+        # The snapshot answers the same questions as Configuration,
+        # without going to the database.
+        for configuration in (Configuration, snapshot):
+            eq_(5, configuration.loan_limit(library))
+            eq_(None, configuration.hold_limit(library))
+            eq_(Configuration.max_outstanding_fines(library).amount,
+                configuration.max_outstanding_fines(library).amount)
+        eq_(lending_policy, snapshot.lending_policy)
+
+        # It also knows about the library's facets.
+        eq_(library.default_facet(Facets.ORDER_FACET_GROUP_NAME),
+            snapshot.default_facet(Facets.ORDER_FACET_GROUP_NAME, library))
+        eq_(library.enabled_facets(Facets.ORDER_FACET_GROUP_NAME),
+            snapshot.enabled_facets(Facets.ORDER_FACET_GROUP_NAME, library))
+        facet_config = snapshot.facet_config(library)
+        eq_(Facets.ORDER_AUTHOR,
+            facet_config.default_facet(Facets.ORDER_FACET_GROUP_NAME))
+        eq_([Facets.ORDER_AUTHOR, Facets.ORDER_TITLE],
+            facet_config.enabled_facets(Facets.ORDER_FACET_GROUP_NAME))
+
+        # Settings that haven't been set get their defaults.
+        eq_(Facets.DEFAULT_FACET.get(Facets.AVAILABILITY_FACET_GROUP_NAME),
+            snapshot.default_facet(Facets.AVAILABILITY_FACET_GROUP_NAME,
+                                   library))
+
+    def test_library(self):
+        library = self._default_library
+        snapshot = ConfigurationSnapshot.from_database(self._db)
+
+        # If a session already has the library, that's what's used.
+        eq_(library, snapshot.library(self._db, library.id))
+
+        # Otherwise, the snapshot's copy of the library is put into
+        # the session without a database query.
+        self._db.expunge(library)
+        statements = []
+        def count(*args, **kwargs):
+            statements.append(args[2])
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            copy = snapshot.library(self._db, library.id)
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+        eq_([], statements)
+        eq_(library.id, copy.id)
+        eq_(library.short_name, copy.short_name)
+        assert copy in self._db
+
+        # An unknown library isn't found.
+        eq_(None, snapshot.library(self._db, -1))
+
+    def test_library_fingerprint(self):
+        library = self._default_library
+        other = self._library()
+        integration = self._external_integration(self._str)
+        other.integrations.append(integration)
+
+        def fingerprints():
+            snapshot = ConfigurationSnapshot.from_database(self._db)
+            return (snapshot.library_fingerprint(library.id),
+                    snapshot.library_fingerprint(other.id))
+        library_before, other_before = fingerprints()
+
+        # Changing an integration used by one library only changes
+        # that library's fingerprint.
+        integration.setting("key").value = "value"
+        library_after, other_after = fingerprints()
+        eq_(library_before, library_after)
+        assert other_before != other_after
+
+        # Changing a sitewide setting changes every fingerprint.
+        ConfigurationSetting.sitewide(self._db, "key").value = "value"
+        library_last, other_last = fingerprints()
+        assert library_after != library_last
+        assert other_after != other_last
+
+        # Changing anything about a library itself, such as its name,
+        # changes that library's fingerprint.
+        for column, value in (("name", "A new name"),
+                              ("uuid", "a-new-uuid"),
+                              ("short_name", "new")):
+            setattr(other, column, value)
+            library_renamed, other_renamed = fingerprints()
+            eq_(library_last, library_renamed)
+            assert other_last != other_renamed
+            other_last = other_renamed
+
+class TestSiteConfigurationWatcher(DatabaseTest):
+
+    def test_check(self):
+        watcher = SiteConfigurationWatcher(self._db.get_bind())
+        eq_(None, watcher.last_update)
+        eq_(Configuration.site_configuration_last_update(self._db, timeout=0),
+            watcher.check())
+        eq_(watcher.check(), watcher.last_update)
@@ -13,6 +13,7 @@ from time import mktime
 from decimal import Decimal
 
 import flask
+from sqlalchemy import event
 from flask import (
     url_for,
     Response,
@@ -394,6 +395,11 @@ class TestCirculationManager(CirculationControllerTest):
         assert isinstance(manager.shared_collection_api,
                           SharedCollectionAPI)
 
+        # The new library's AuthdataUtility has been loaded, so it
+        # won't be loaded from the database on every request.
+        assert isinstance(manager.authdata_utilities[library.id],
+                          AuthdataUtility)
+
         # Controllers that don't depend on site configuration
         # have not been reloaded.
         eq_(index_controller, manager.index_controller)
@@ -401,6 +407,75 @@ class TestCirculationManager(CirculationControllerTest):
         # Restore the CustomIndexView.for_library implementation
         CustomIndexView.for_library = old_for_library
 
+    def test_load_settings_is_lazy_and_incremental(self):
+        manager = self.manager
+        library = self._default_library
+        other = self._library()
+        self.library_setup(other)
+        manager.load_settings()
+
+        # Nothing has been created for the new library yet.
+        assert other.id in manager.circulation_apis
+        eq_(False, manager.circulation_apis.is_created(other.id))
+        eq_(False, manager.custom_index_views.is_created(other.id))
+        eq_(False, manager.top_level_lanes.is_created(other.id))
+        eq_(False, manager.auth.library_authenticators.is_created(
+            other.short_name
+        ))
+
+        # Things are created the first time they're needed.
+        api = manager.circulation_apis[other.id]
+        eq_(other.id, api.library_id)
+        authenticator = manager.auth.library_authenticators[other.short_name]
+        assert isinstance(authenticator, LibraryAuthenticator)
+        default_api = manager.circulation_apis[library.id]
+        default_authenticator = manager.auth.library_authenticators[
+            library.short_name
+        ]
+
+        # If nothing has changed, reloading the settings keeps
+        # everything that was created.
+        manager.load_settings()
+        eq_(api, manager.circulation_apis[other.id])
+        eq_(authenticator,
+            manager.auth.library_authenticators[other.short_name])
+
+        # If one library's configuration changes, only that library's
+        # objects are created again.
+        ConfigurationSetting.for_library(
+            Configuration.LOAN_LIMIT, other
+        ).value = "3"
+        manager.load_settings()
+        eq_(False, manager.circulation_apis.is_created(other.id))
+        assert api != manager.circulation_apis[other.id]
+        assert authenticator != manager.auth.library_authenticators[
+            other.short_name
+        ]
+        eq_(default_api, manager.circulation_apis[library.id])
+        eq_(default_authenticator,
+            manager.auth.library_authenticators[library.short_name])
+
+        # Renaming a library also counts as a change, since its
+        # LibraryAuthenticator holds on to the name.
+        authenticator = manager.auth.library_authenticators[other.short_name]
+        other.name = "A new name"
+        manager.load_settings()
+        new_authenticator = manager.auth.library_authenticators[
+            other.short_name
+        ]
+        assert authenticator != new_authenticator
+        eq_("A new name", new_authenticator.library_name)
+        eq_(default_authenticator,
+            manager.auth.library_authenticators[library.short_name])
+
+        # A sitewide change affects every library.
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.PATRON_WEB_CLIENT_URL
+        ).value = "http://web/"
+        manager.load_settings()
+        eq_(False, manager.circulation_apis.is_created(library.id))
+        eq_(False, manager.circulation_apis.is_created(other.id))
+
     def test_exception_during_external_search_initialization_is_stored(self):
 
         class BadSearch(CirculationManager):
@@ -440,6 +515,10 @@ class TestCirculationManager(CirculationControllerTest):
         assert isinstance(ex, CannotLoadConfiguration)
         assert ex.message.startswith("Short Client Token configuration is incomplete")
 
+        # Nothing was kept for this library, so the error will happen
+        # again when the configuration is actually used.
+        assert self.library.id not in self.manager.authdata_utilities
+
     def test_setup_adobe_vendor_id_does_not_override_existing_configuration(self):
         # Our circulation manager is perfectly happy with its Adobe Vendor ID
         # configuration, which it got from one of its libraries.
@@ -756,6 +835,75 @@ class TestBaseController(CirculationControllerTest):
             assert new_name in self.manager.auth.library_authenticators
 
 
+    def test_library_for_request_uses_configuration_snapshot(self):
+        # The CirculationManager took a snapshot of the configuration
+        # when it loaded its settings.
+        snapshot = self.manager.configuration
+        eq_(self._default_library.id,
+            snapshot.library_id(self._default_library.short_name))
+
+        # A library that was created after the snapshot was taken
+        # isn't in the snapshot, but it can still be found.
+        new_library = self._library(short_name="newlibrary")
+        eq_(None, snapshot.library_id("newlibrary"))
+        with self.app.test_request_context("/"):
+            eq_(new_library, self.controller.library_for_request("newlibrary"))
+
+        # A library that has been renamed can't be found under its
+        # old name.
+        old_name = self._default_library.short_name
+        self._default_library.short_name = "renamed"
+        with self.app.test_request_context("/"):
+            eq_(LIBRARY_NOT_FOUND, self.controller.library_for_request(old_name))
+            eq_(self._default_library,
+                self.controller.library_for_request("renamed"))
+
+    def test_library_for_request_does_not_query_library(self):
+        # Once a library is in the configuration snapshot, it can be
+        # found without querying the database for it.
+        library = self._library(short_name="snapshotted")
+        self.manager.load_settings()
+        library_id = library.id
+        self._db.expunge(library)
+
+        statements = []
+        def count(*args, **kwargs):
+            statements.append(args[2])
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            with self.app.test_request_context("/"):
+                found = self.controller.library_for_request("snapshotted")
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+        eq_(library_id, found.id)
+        eq_("snapshotted", found.short_name)
+        eq_([], [x for x in statements if 'libraries' in x])
+
+    def test_reload_settings_if_changed_uses_watcher(self):
+        class MockWatcher(object):
+            last_update = None
+        watcher = MockWatcher()
+        self.manager.configuration_watcher = watcher
+
+        old_configuration = self.manager.configuration
+        last_update = self.manager.site_configuration_last_update
+
+        # The watcher hasn't seen a change, so nothing happens, even
+        # though the database says the configuration has changed.
+        model.site_configuration_has_changed(self._db, timeout=0)
+        watcher.last_update = last_update
+        self.manager.reload_settings_if_changed()
+        eq_(old_configuration, self.manager.configuration)
+
+        # Once the watcher sees the change, the settings are
+        # reloaded and a new snapshot is put in place.
+        watcher.last_update = datetime.datetime.utcnow()
+        self.manager.reload_settings_if_changed()
+        assert old_configuration != self.manager.configuration
+        eq_(watcher.last_update, self.manager.site_configuration_last_update)
+        eq_(watcher.last_update, self.manager.configuration.version)
+
 class FullLaneSetupTest(CirculationControllerTest):
     """Most lane-based tests don't need the full multi-tier setup of lanes
     that we would see in a real site. We use a smaller setup to save time
@@ -1497,6 +1645,101 @@ class TestLoanController(CirculationControllerTest):
             eq_("here's your book", response.data)
             eq_([], self._db.query(Loan).all())
 
+    def test_fulfill_streams_remote_content(self):
+        class MockRaw(object):
+            def __init__(self, data):
+                self.data = data
+                self.reads = []
+
+            def read(self, amt, decode_content=True):
+                self.reads.append((amt, decode_content))
+                chunk, self.data = self.data[:amt], self.data[amt:]
+                return chunk
+
+        class MockRemoteResponse(object):
+            def __init__(self, status_code, headers, data):
+                self.status_code = status_code
+                self.headers = headers
+                self.raw = MockRaw(data)
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+
+        remote = MockRemoteResponse(
+            206, {"Content-Length": "6",
+                  "Content-Range": "bytes 0-5/100",
+                  "Content-Encoding": "deflate",
+                  "Content-Type": "application/octet-stream",
+                  "Connection": "keep-alive"},
+            "abcdef"
+        )
+        requests = []
+        def do_stream(url, headers, **kwargs):
+            requests.append((url, headers, kwargs))
+            return remote
+
+        # This book isn't open access, so its content will have to be
+        # fetched from the remote server.
+        self.pool.open_access = False
+        fulfillment = FulfillmentInfo(
+            self.pool.collection, DataSource.ENKI,
+            self.pool.identifier.type, self.pool.identifier.identifier,
+            content_link="http://enki/book", content_type="application/pdf",
+            content=None, content_expires=None
+        )
+
+        controller = self.manager.loans
+        controller.STREAMING_CHUNK_SIZE = 4
+        headers = dict(Authorization=self.valid_auth, Range="bytes=0-5")
+        with self.request_context_with_library("/", headers=headers):
+            patron = controller.authenticated_patron_from_request()
+            self.pool.loan_to(patron)
+            self.manager.d_circulation.queue_fulfill(self.pool, fulfillment)
+            response = controller.fulfill(
+                self.pool.id, self.mech2.delivery_mechanism.id,
+                do_stream=do_stream
+            )
+
+            # The client's Range header was passed on, along with the
+            # Accept-Encoding header that Enki needs.
+            [(url, sent_headers, kwargs)] = requests
+            eq_("http://enki/book", url)
+            eq_(dict(Range="bytes=0-5", **{"Accept-Encoding": "deflate"}),
+                sent_headers)
+            eq_(True, kwargs['stream'])
+
+            # Nothing has been read from the remote server yet.
+            eq_([], remote.raw.reads)
+
+            # The response passes on the remote server's status code
+            # and the headers that describe the content, but not
+            # headers like Connection.
+            eq_(206, response.status_code)
+            eq_("6", response.headers['Content-Length'])
+            eq_("bytes 0-5/100", response.headers['Content-Range'])
+            eq_("deflate", response.headers['Content-Encoding'])
+            eq_("application/pdf", response.headers['Content-Type'])
+            assert 'Connection' not in response.headers
+
+            # The content is passed along a chunk at a time, without
+            # being decoded.
+            eq_(["abcd", "ef"], list(response.response))
+            eq_([(4, False), (4, False), (4, False)], remote.raw.reads)
+            eq_(True, remote.closed)
+
+            # If the remote server can't be reached, we get a problem
+            # detail.
+            def doomed_stream(url, headers, **kwargs):
+                raise RemoteIntegrationException("fulfill service", "Error!")
+            self.manager.d_circulation.queue_fulfill(self.pool, fulfillment)
+            response = controller.fulfill(
+                self.pool.id, self.mech2.delivery_mechanism.id,
+                do_stream=doomed_stream
+            )
+            assert isinstance(response, ProblemDetail)
+            eq_(502, response.status_code)
+
     def test_revoke_loan(self):
          with self.request_context_with_library(
                  "/", headers=dict(Authorization=self.valid_auth)):
@@ -1562,6 +1805,13 @@ class TestLoanController(CirculationControllerTest):
 
         ConfigurationSetting.for_library(
             Configuration.MAX_OUTSTANDING_FINES, self._default_library).value = "$0.50"
+
+        # Library settings are read from the configuration snapshot,
+        # so it needs to be taken again.
+        self.manager.load_settings()
+        self.manager.d_circulation = self.manager.circulation_apis[
+            self._default_library.id
+        ]
         with self.request_context_with_library(
                 "/", headers=dict(Authorization=self.valid_auth)):
 
@@ -1719,6 +1969,187 @@ class TestAnnotationController(CirculationControllerTest):
             eq_(AnnotationWriter.CONTENT_TYPE, response.headers['Content-Type'])
             eq_('W/""', response.headers['ETag'])
 
+    def test_get_container_pages(self):
+        annotations = []
+        for i in range(3):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=self.default_patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+            )
+            annotations.append(annotation)
+
+        with self.request_context_with_library(
+                "/?size=2", headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            container = json.loads(response.data)
+            eq_(3, container['total'])
+            eq_(2, len(container['first']['items']))
+            assert "after=%s" % annotations[1].id in container['first']['next']
+
+        # Asking for a later page gets an AnnotationPage instead of
+        # a container.
+        with self.request_context_with_library(
+                "/?size=2&after=%s" % annotations[1].id,
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            page = json.loads(response.data)
+            eq_("AnnotationPage", page['type'])
+            eq_(1, len(page['items']))
+            assert 'next' not in page
+
+        for query in ("size=many", "size=0", "size=-5", "after=0",
+                      "after=-1&size=2"):
+            with self.request_context_with_library(
+                    "/?" + query, headers=dict(Authorization=self.valid_auth)):
+                self.manager.annotations.authenticated_patron_from_request()
+                problem = self.manager.annotations.container()
+                eq_(INVALID_INPUT.uri, problem.uri)
+
+        # A client can't ask for an enormous page.
+        with self.request_context_with_library(
+                "/?size=100000", headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            container = json.loads(response.data)
+            eq_(3, len(container['first']['items']))
+            assert ("size=%d" % AnnotationWriter.MAX_PAGE_SIZE
+                    in container['first']['id'])
+
+    def test_get_container_conditionally(self):
+        annotation, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self.identifier,
+            motivation=Annotation.IDLING,
+        )
+        annotation.timestamp = datetime.datetime.now() - datetime.timedelta(hours=1)
+        headers = dict(Authorization=self.valid_auth)
+
+        def get(**extra):
+            extra.update(headers)
+            with self.request_context_with_library("/", headers=extra):
+                self.manager.annotations.authenticated_patron_from_request()
+                return self.manager.annotations.container()
+
+        response = get()
+        eq_(200, response.status_code)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # If the client already has this version of the container,
+        # it gets a 304 response with no content.
+        response = get(**{"If-None-Match": etag})
+        eq_(304, response.status_code)
+        eq_("", response.data)
+        eq_(etag, response.headers['ETag'])
+
+        response = get(**{"If-Modified-Since": last_modified})
+        eq_(304, response.status_code)
+
+        # Deleting an annotation changes the ETag and the
+        # modification time, even though the deleted annotation
+        # isn't in the container anymore.
+        with self.request_context_with_library(
+                "/", method="DELETE", headers=headers):
+            self.manager.annotations.authenticated_patron_from_request()
+            self.manager.annotations.detail(annotation.id)
+        eq_(False, annotation.active)
+        response = get(**{"If-None-Match": etag})
+        eq_(200, response.status_code)
+        assert etag != response.headers['ETag']
+        response = get(**{"If-Modified-Since": last_modified})
+        eq_(200, response.status_code)
+
+    def test_get_empty_container_conditionally(self):
+        headers = dict(Authorization=self.valid_auth)
+
+        def get(**extra):
+            extra.update(headers)
+            with self.request_context_with_library("/", headers=extra):
+                self.manager.annotations.authenticated_patron_from_request()
+                return self.manager.annotations.container()
+
+        # A patron with no annotations gets a container with an
+        # empty ETag and no Last-Modified header.
+        response = get()
+        eq_(200, response.status_code)
+        etag = response.headers['ETag']
+        eq_('W/""', etag)
+        assert 'Last-Modified' not in response.headers
+
+        # An empty ETag never matches, so the (empty) container is
+        # sent again rather than a stale 304.
+        response = get(**{"If-None-Match": etag})
+        eq_(200, response.status_code)
+        eq_(etag, response.headers['ETag'])
+
+        # Once there's an annotation, its ETag can be matched.
+        annotation, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self.identifier,
+            motivation=Annotation.IDLING,
+        )
+        annotation.timestamp = datetime.datetime.utcnow()
+        response = get(**{"If-None-Match": etag})
+        eq_(200, response.status_code)
+        new_etag = response.headers['ETag']
+        assert etag != new_etag
+        response = get(**{"If-None-Match": new_etag})
+        eq_(304, response.status_code)
+
+    def test_get_container_since(self):
+        old, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self._identifier(),
+            motivation=Annotation.IDLING,
+        )
+        old.timestamp = datetime.datetime(2018, 1, 1)
+        new, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self._identifier(),
+            motivation=Annotation.IDLING,
+        )
+        new.timestamp = datetime.datetime(2018, 1, 3)
+        deleted, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self._identifier(),
+            motivation=Annotation.IDLING,
+        )
+        deleted.active = False
+        deleted.timestamp = datetime.datetime(2018, 1, 3)
+
+        with self.request_context_with_library(
+                "/?since=2018-01-02T00:00:00",
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            container = json.loads(response.data)
+
+            # Only the annotation that changed since the given time is
+            # included, but the total counts all the annotations.
+            eq_(2, container['total'])
+            [item] = container['first']['items']
+            assert item['id'].endswith("/%s" % new.id)
+            eq_("2018-01-03T00:00:00", item['modified'])
+
+            # The annotation that was deleted is listed separately.
+            [deleted_url] = container['first']['deleted']
+            assert deleted_url.endswith("/%s" % deleted.id)
+
+        with self.request_context_with_library(
+                "/?since=yesterday", headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            problem = self.manager.annotations.container()
+            eq_(INVALID_INPUT.uri, problem.uri)
+
     def test_get_container_with_item(self):
         self.pool.loan_to(self.default_patron)
 
@@ -1750,7 +2181,7 @@ class TestAnnotationController(CirculationControllerTest):
 
             eq_(AnnotationWriter.CONTENT_TYPE, response.headers['Accept-Post'])
             eq_(AnnotationWriter.CONTENT_TYPE, response.headers['Content-Type'])
-            expected_etag = 'W/"%s"' % annotation.timestamp
+            expected_etag = 'W/"%s/1"' % annotation.timestamp.isoformat()
             eq_(expected_etag, response.headers['ETag'])
             expected_time = format_date_time(mktime(annotation.timestamp.timetuple()))
             eq_(expected_time, response.headers['Last-Modified'])
@@ -1793,7 +2224,7 @@ class TestAnnotationController(CirculationControllerTest):
 
             assert 'Accept-Post' not in response.headers.keys()
             eq_(AnnotationWriter.CONTENT_TYPE, response.headers['Content-Type'])
-            expected_etag = 'W/"%s"' % annotation.timestamp
+            expected_etag = 'W/"%s/1"' % annotation.timestamp.isoformat()
             eq_(expected_etag, response.headers['ETag'])
             expected_time = format_date_time(mktime(annotation.timestamp.timetuple()))
             eq_(expected_time, response.headers['Last-Modified'])
@@ -7,7 +7,10 @@ from api.config import (
     CannotLoadConfiguration,
 )
 from core.analytics import Analytics
-from api.google_analytics_provider import GoogleAnalyticsProvider
+from api.google_analytics_provider import (
+    AnalyticsEventSender,
+    GoogleAnalyticsProvider,
+)
 from . import DatabaseTest
 from core.model import (
     get_one_or_create,
@@ -18,6 +21,8 @@ from core.model import (
     ExternalIntegration,
     LicensePool
 )
+import os
+import tempfile
 import unicodedata
 import urlparse
 import datetime
@@ -30,6 +35,81 @@ class MockGoogleAnalyticsProvider(GoogleAnalyticsProvider):
         self.url = url
         self.params = params
 
+class MockAnalyticsEventSender(AnalyticsEventSender):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['background'] = False
+        super(MockAnalyticsEventSender, self).__init__(*args, **kwargs)
+        self.posts = []
+        self.fail = False
+
+    def post(self, url, data):
+        if self.fail:
+            raise Exception("Analytics server is down")
+        self.posts.append((url, data))
+
+class TestAnalyticsEventSender(object):
+
+    def test_batch_url(self):
+        eq_("http://www.google-analytics.com/batch",
+            AnalyticsEventSender.batch_url(
+                "http://www.google-analytics.com/collect"
+            ))
+        eq_(None, AnalyticsEventSender.batch_url("http://example.com/"))
+
+    def test_hits_are_sent_in_batches(self):
+        sender = MockAnalyticsEventSender()
+        url = "http://www.google-analytics.com/collect"
+        for i in range(45):
+            eq_(True, sender.enqueue(url, "ea=%d" % i))
+        sender.enqueue("http://example.com/", "ea=other")
+        eq_([], sender.posts)
+        eq_(46, sender.queued)
+
+        sender.flush()
+        batches = [data.split("\n") for batch_url, data in sender.posts
+                   if batch_url == "http://www.google-analytics.com/batch"]
+        eq_([20, 20, 5], [len(batch) for batch in batches])
+        eq_(["ea=%d" % i for i in range(45)], sum(batches, []))
+
+        # A URL that isn't a /collect URL gets one hit per request.
+        assert ("http://example.com/", "ea=other") in sender.posts
+        eq_(46, sender.sent)
+        eq_(0, sender.dropped)
+
+    def test_overflow(self):
+        sender = MockAnalyticsEventSender(max_queue_size=2)
+        url = "http://www.google-analytics.com/collect"
+        eq_(True, sender.enqueue(url, "ea=1"))
+        eq_(True, sender.enqueue(url, "ea=2"))
+
+        # With no spill file, a hit that doesn't fit is dropped.
+        eq_(False, sender.enqueue(url, "ea=3"))
+        eq_(dict(queued=2, sent=0, dropped=1, spilled=0), sender.counts)
+
+        # With a spill file, it's written to disk and sent later.
+        handle, sender.spill_path = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(sender.spill_path)
+        try:
+            eq_(True, sender.enqueue(url, "ea=4"))
+            eq_(1, sender.spilled)
+            sender.flush()
+            eq_([("http://www.google-analytics.com/batch", "ea=1\nea=2"),
+                 ("http://www.google-analytics.com/batch", "ea=4")],
+                sender.posts)
+            eq_(False, os.path.exists(sender.spill_path))
+        finally:
+            if os.path.exists(sender.spill_path):
+                os.remove(sender.spill_path)
+
+    def test_failed_requests_are_counted_as_dropped(self):
+        sender = MockAnalyticsEventSender()
+        sender.fail = True
+        sender.enqueue("http://www.google-analytics.com/collect", "ea=1")
+        sender.flush()
+        eq_(dict(queued=1, sent=0, dropped=1, spilled=0), sender.counts)
+
 class TestGoogleAnalyticsProvider(DatabaseTest):
 
     def test_init(self):
@@ -0,0 +1,54 @@
+from nose.tools import (
+    set_trace, eq_,
+    assert_raises,
+)
+
+from api.util.lazy import LazyDict
+
+class TestLazyDict(object):
+
+    def test_values_created_on_demand(self):
+        created = []
+        def factory(key):
+            created.append(key)
+            return key * 2
+        d = LazyDict(factory, [1, 2], {3: "three"})
+
+        # The keys are known, but no values have been created.
+        eq_(3, len(d))
+        assert 1 in d
+        assert 3 in d
+        assert 4 not in d
+        eq_(set([1, 2, 3]), set(d.keys()))
+        eq_([], created)
+
+        eq_(2, d[1])
+        eq_(2, d.get(1))
+        eq_("three", d[3])
+        eq_(None, d.get(4))
+        assert_raises(KeyError, lambda: d[4])
+
+        # Each value was only created once.
+        eq_([1], created)
+        eq_(True, d.is_created(1))
+        eq_(False, d.is_created(2))
+
+        # Values can be set directly.
+        d[2] = "two"
+        eq_("two", d[2])
+        eq_([1], created)
+
+        del d[2]
+        assert 2 not in d
+
+    def test_created_values(self):
+        d = LazyDict(lambda key: key * 2, [1, 2, 3])
+        d[1]
+        d[2]
+
+        # Only values that have already been created are returned.
+        eq_({1: 2}, LazyDict.created_values(d, [1, 3]))
+
+        # Normal dictionaries work too.
+        eq_({1: "a"}, LazyDict.created_values({1: "a", 2: "b"}, [1, 3]))
+        eq_({}, LazyDict.created_values(None, [1]))
@@ -12,11 +12,13 @@ from . import (
 
 from core.model import (
     Annotation,
+    CirculationEvent,
     Collection,
     CoverageRecord,
     DataSource,
     ExternalIntegration,
     Identifier,
+    get_one_or_create,
 )
 from core.opds_import import MockMetadataWranglerOPDSLookup
 from core.testing import (
@@ -26,6 +28,7 @@ from core.testing import (
 from core.util.opds_writer import OPDSFeed
 
 from api.monitor import (
+    DashboardStatsMonitor,
     HoldReaper,
     IdlingAnnotationReaper,
     LoanlikeReaperMonitor,
@@ -588,3 +591,142 @@ class TestIdlingAnnotationReaper(DatabaseTest):
         reaper = IdlingAnnotationReaper(self._db)
         qu = self._db.query(Annotation).filter(reaper.where_clause)
         eq_([reapable], qu.all())
+
+
+class TestDashboardStatsMonitor(DatabaseTest):
+
+    def event(self, pool, type, delta=None, patron_id=None):
+        event, ignore = get_one_or_create(
+            self._db, CirculationEvent, license_pool=pool, type=type,
+            start=datetime.datetime.utcnow(), delta=delta,
+            foreign_patron_id=patron_id,
+        )
+        return event
+
+    def test_run_once(self):
+        patron = self._patron()
+        edition, pool = self._edition(
+            with_license_pool=True, with_open_access_download=False,
+            data_source_name=DataSource.OVERDRIVE
+        )
+        pool.open_access = False
+        pool.licenses_owned = 5
+        pool.licenses_available = 4
+        pool.loan_to(patron, end=datetime.datetime.now() + datetime.timedelta(days=1))
+
+        # Nothing has been stored yet.
+        eq_(None, DashboardStatsMonitor.stored(self._db))
+
+        monitor = DashboardStatsMonitor(self._db)
+        monitor.run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(dict(total=1, with_active_loans=1, with_active_loans_or_holds=1,
+                 loans=1, holds=0), stats['patrons'])
+        eq_(dict(titles=1, licenses=5, available_licenses=4),
+            stats['inventory'])
+        eq_(dict(overdrive=1), stats['vendors'])
+        assert 'full_refresh_at' in stats
+
+    def test_incremental(self):
+        edition, pool = self._edition(
+            with_license_pool=True, with_open_access_download=False,
+            data_source_name=DataSource.OVERDRIVE
+        )
+        pool.open_access = False
+        pool.licenses_owned = 5
+        pool.licenses_available = 5
+        old_event = self.event(pool, CirculationEvent.CM_CHECKOUT, patron_id="a")
+
+        monitor = DashboardStatsMonitor(self._db, incremental=True)
+        monitor.run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(old_event.id, stats['last_event_id'])
+        eq_(0, stats['patrons']['loans'])
+
+        # Circulation events come in, but the license pools aren't
+        # otherwise changed.
+        self.event(pool, CirculationEvent.CM_CHECKOUT, patron_id="a")
+        self.event(pool, CirculationEvent.CM_HOLD_PLACE, patron_id="c")
+        self.event(pool, CirculationEvent.DISTRIBUTOR_LICENSE_ADD, delta=2)
+        self.event(pool, CirculationEvent.DISTRIBUTOR_CHECKOUT, delta=-1)
+
+        # Events for open-access books don't affect the license counts.
+        edition, open_access_pool = self._edition(
+            with_license_pool=True, with_open_access_download=True
+        )
+        self.event(
+            open_access_pool, CirculationEvent.DISTRIBUTOR_LICENSE_ADD,
+            delta=10
+        )
+        last = self.event(pool, CirculationEvent.DISTRIBUTOR_TITLE_REMOVE)
+
+        # Loans and holds are counted from the database rather than
+        # from events. A loan on an open-access book doesn't count,
+        # since it has no end date.
+        patron = self._patron()
+        open_access_pool.loan_to(patron)
+        pool.on_hold_to(patron)
+
+        # The next incremental run adjusts the stored statistics
+        # using those events.
+        monitor.run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(0, stats['patrons']['loans'])
+        eq_(1, stats['patrons']['holds'])
+        eq_(7, stats['inventory']['licenses'])
+        eq_(4, stats['inventory']['available_licenses'])
+        eq_({}, stats['vendors'])
+        eq_(last.id, stats['last_event_id'])
+
+        # Once it's been a while since the last full refresh,
+        # everything is recalculated.
+        stats['full_refresh_at'] = (
+            datetime.datetime.utcnow()
+            - DashboardStatsMonitor.FULL_REFRESH_INTERVAL
+        ).strftime(DashboardStatsMonitor.TIME_FORMAT)
+        DashboardStatsMonitor.store(self._db, stats)
+        monitor.run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(5, stats['inventory']['licenses'])
+        eq_(dict(overdrive=1, open_access=1), stats['vendors'])
+
+        # A monitor that's not incremental always recalculates.
+        self.event(pool, CirculationEvent.DISTRIBUTOR_LICENSE_ADD, delta=2)
+        DashboardStatsMonitor(self._db).run_once(None, None)
+        eq_(5, DashboardStatsMonitor.stored(self._db)['inventory']['licenses'])
+
+    def test_events_during_full_refresh_are_applied_later(self):
+        edition, pool = self._edition(
+            with_license_pool=True, with_open_access_download=False,
+            data_source_name=DataSource.OVERDRIVE
+        )
+        pool.open_access = False
+        pool.licenses_owned = 5
+        pool.licenses_available = 5
+        before = self.event(pool, CirculationEvent.DISTRIBUTOR_CHECKOUT)
+
+        test = self
+        class Mock(DashboardStatsMonitor):
+            def calculate(self, _db):
+                # The aggregates are calculated, and then an event
+                # comes in before the full refresh is finished.
+                stats = super(Mock, self).calculate(_db)
+                self.during = test.event(
+                    pool, CirculationEvent.DISTRIBUTOR_LICENSE_ADD, delta=2
+                )
+                return stats
+
+        monitor = Mock(self._db, incremental=True)
+        monitor.run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(5, stats['inventory']['licenses'])
+
+        # The full refresh didn't see that event, so it's not marked
+        # as applied...
+        eq_(before.id, stats['last_event_id'])
+
+        # ...and the next incremental run picks it up.
+        DashboardStatsMonitor(self._db, incremental=True).run_once(None, None)
+        stats = DashboardStatsMonitor.stored(self._db)
+        eq_(7, stats['inventory']['licenses'])
+        eq_(monitor.during.id, stats['last_event_id'])
@@ -8,7 +8,10 @@ from nose.tools import (
 
 from . import DatabaseTest, sample_data
 
-from core.metadata_layer import Metadata
+from core.metadata_layer import (
+    IdentifierData,
+    Metadata,
+)
 from core.model import (
     get_one,
     get_one_or_create,
@@ -448,6 +451,146 @@ class TestNoveListAPI(DatabaseTest):
 
         self.novelist.put = oldPut
 
+    def test_put_items_novelist_in_batches(self):
+        editions = []
+        for i in range(3):
+            edition = self._edition(identifier_type=Identifier.ISBN)
+            self._licensepool(edition, collection=self._default_collection)
+            editions.append(edition)
+
+        # The second request fails once and is tried again.
+        responses = [
+            MockRequestsResponse(200, content=json.dumps(
+                {'Customer': 'NYPL', 'RecordsReceived': 2, 'InvalidRecords': 0}
+            )),
+            MockRequestsResponse(500, content="error"),
+            MockRequestsResponse(200, content=json.dumps(
+                {'Customer': 'NYPL', 'RecordsReceived': 1, 'InvalidRecords': 1}
+            )),
+        ]
+        uploads = []
+        def mockHTTPPut(url, headers, **kwargs):
+            uploads.append(json.loads(kwargs['data'])['Records'])
+            return responses.pop(0)
+        self.novelist.put = mockHTTPPut
+
+        response = self.novelist.put_items_novelist(
+            self._default_library, batch_size=2
+        )
+
+        # The record counts were added up across the batches.
+        eq_({'Customer': 'NYPL', 'RecordsReceived': 3, 'InvalidRecords': 1},
+            response)
+        eq_([2, 1, 1], [len(records) for records in uploads])
+        eq_(uploads[1], uploads[2])
+        eq_(sorted([e.primary_identifier.identifier for e in editions]),
+            sorted([r['ISBN'] for r in uploads[0] + uploads[1]]))
+
+        # The time of the upload was recorded.
+        setting = self.novelist.last_upload_setting(self._default_library)
+        assert setting.value is not None
+
+        # An incremental upload only sends what's changed since then.
+        # Nothing has, so nothing is sent.
+        del uploads[:]
+        eq_(None, self.novelist.put_items_novelist(
+            self._default_library, incremental=True
+        ))
+        eq_([], uploads)
+
+        # If a batch keeps failing, the upload gives up and the time
+        # of the last successful upload stays the same.
+        setting.value = None
+        responses = [MockRequestsResponse(500, content="error")] * 3
+        def failingHTTPPut(url, headers, **kwargs):
+            uploads.append(kwargs['data'])
+            return responses.pop(0)
+        self.novelist.put = failingHTTPPut
+        eq_(None, self.novelist.put_items_novelist(self._default_library))
+        eq_(NoveListAPI.UPLOAD_ATTEMPTS, len(uploads))
+        eq_(None, setting.value)
+
+    def test_recommendations(self):
+        work = self._work(with_license_pool=True)
+        identifier = work.presentation_edition.primary_identifier
+        recommended = self._work(with_license_pool=True)
+        recommended_identifier = recommended.license_pools[0].identifier
+
+        lookups = []
+        def lookup(identifier):
+            lookups.append(identifier)
+            return self.lookup_result
+        self.novelist.lookup = lookup
+
+        # The first time, NoveList is asked, and the recommendations
+        # that we know about are kept.
+        self.lookup_result = Metadata(
+            DataSource.NOVELIST, recommendations=[
+                IdentifierData(recommended_identifier.type,
+                               recommended_identifier.identifier),
+                IdentifierData(Identifier.ISBN, "not-in-the-database"),
+            ]
+        )
+        eq_([recommended_identifier], self.novelist.recommendations(
+            self._default_library, identifier
+        ))
+        eq_([identifier], lookups)
+
+        # After that, the recommendations come from the cache.
+        eq_([recommended_identifier], self.novelist.recommendations(
+            self._default_library, identifier
+        ))
+        eq_(1, len(lookups))
+
+        # Each library has its own recommendations.
+        other_library = self._library()
+        self.lookup_result = None
+        eq_([], self.novelist.recommendations(other_library, identifier))
+        eq_(2, len(lookups))
+
+        # The lack of recommendations is also cached, but not for as
+        # long.
+        eq_([], self.novelist.recommendations(other_library, identifier))
+        eq_(2, len(lookups))
+        representation = self.novelist.recommendations_representation(
+            other_library, identifier
+        )
+        representation.fetched_at -= datetime.timedelta(
+            seconds=self.novelist.NO_RECOMMENDATIONS_MAX_AGE + 1
+        )
+        eq_(None, self.novelist.cached_recommendations(
+            other_library, identifier
+        ))
+        eq_([recommended_identifier], self.novelist.cached_recommendations(
+            self._default_library, identifier
+        ))
+
+    def test_prefetch_recommendations(self):
+        popular = self._work(with_license_pool=True)
+        [pool] = popular.license_pools
+        pool.licenses_owned = 1
+        pool.licenses_available = 0
+        pool.patrons_in_hold_queue = 5
+        unpopular = self._work(with_license_pool=True)
+
+        lookups = []
+        def lookup(identifier):
+            lookups.append(identifier)
+            return None
+        self.novelist.lookup = lookup
+
+        # Only the most popular book is looked at.
+        eq_(1, self.novelist.prefetch_recommendations(
+            self._default_library, limit=1
+        ))
+        eq_([popular.presentation_edition.primary_identifier], lookups)
+
+        # Its recommendations are cached, so the next time around the
+        # other book is looked up.
+        eq_(1, self.novelist.prefetch_recommendations(self._default_library))
+        eq_(unpopular.presentation_edition.primary_identifier, lookups[-1])
+        eq_(0, self.novelist.prefetch_recommendations(self._default_library))
+
     def test_make_novelist_data_object(self):
         bad_data = []
         result = self.novelist.make_novelist_data_object(bad_data)
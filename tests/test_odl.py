@@ -9,6 +9,8 @@ import datetime
 import re
 import base64
 
+from sqlalchemy import event
+
 from . import DatabaseTest
 from core.model import (
     Collection,
@@ -820,6 +822,80 @@ class TestODLWithConsolidatedCopiesAPI(DatabaseTest, BaseODLTest):
             eq_(0, hold.position)
             assert hold.end - datetime.datetime.utcnow() - datetime.timedelta(days=3) < datetime.timedelta(hours=1)
 
+    def test_update_hold_queue_query_count(self):
+        # Updating the queue takes the same number of queries no
+        # matter how many holds there are.
+        self.pool.licenses_owned = 2
+        now = datetime.datetime.utcnow()
+        self.pool.loan_to(self._patron(), end=now + datetime.timedelta(days=1))
+
+        # Each hold is placed an hour after the one before.
+        placed = []
+        def place_holds(count):
+            for i in range(count):
+                self.pool.on_hold_to(
+                    self._patron(),
+                    start=now - datetime.timedelta(hours=100-len(placed)),
+                    position=1
+                )
+                placed.append(i)
+            self._db.flush()
+
+        def count_queries():
+            statements = []
+            def count(*args, **kwargs):
+                statements.append(args[2])
+            connection = self._db.connection()
+            event.listen(connection, "before_cursor_execute", count)
+            try:
+                self.api.update_hold_queue(self.pool)
+                self._db.flush()
+            finally:
+                event.remove(connection, "before_cursor_execute", count)
+            return len([x for x in statements if x.startswith("SELECT")])
+
+        place_holds(2)
+        few_holds = count_queries()
+        place_holds(20)
+        many_holds = count_queries()
+        eq_(few_holds, many_holds)
+
+        # Every hold got a position and an end date.
+        holds = sorted(self.pool.holds, key=lambda x: x.start)
+        eq_(0, holds[0].position)
+        eq_(range(2, 23), [x.position for x in holds[1:]])
+        for hold in holds:
+            assert hold.end is not None
+
+    def test_update_hold_queue_holds_with_same_start(self):
+        # Holds placed at the same time share a place in line.
+        self.pool.licenses_owned = 2
+        now = datetime.datetime.utcnow()
+        self.pool.loan_to(self._patron(), end=now + datetime.timedelta(days=1))
+
+        starts = [
+            now - datetime.timedelta(hours=3),
+            now - datetime.timedelta(hours=2),
+            now - datetime.timedelta(hours=2),
+            now - datetime.timedelta(hours=1),
+        ]
+        holds = []
+        for start in starts:
+            hold, ignore = self.pool.on_hold_to(
+                self._patron(), start=start, position=1
+            )
+            holds.append(hold)
+        self._db.flush()
+
+        self.api.update_hold_queue(self.pool)
+
+        # The first hold gets the one remaining license. The next two
+        # were placed at the same time, so each has only the first
+        # hold ahead of it. The last hold has three holds ahead of it.
+        eq_([0, 2, 2, 4], [x.position for x in holds])
+        for hold in holds:
+            assert hold.end is not None
+
     def test_place_hold_success(self):
         tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
         self.pool.licenses_owned = 1
@@ -1406,6 +1482,66 @@ class TestODLConsolidatedCopiesMonitor(DatabaseTest, BaseODLTest):
         expected_url = "http://copies?since=%sZ" % expected_time.isoformat()
         eq_(expected_url, api.requests[2][0])
 
+    def test_run_once_resumes_from_checkpoint(self):
+        data_source = DataSource.lookup(self._db, "Feedbooks", autocreate=True)
+        collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        collection.external_integration.set_setting(
+            Collection.DATA_SOURCE_NAME_SETTING,
+            data_source.name
+        )
+        api = MockODLWithConsolidatedCopiesAPI(self._db, collection)
+        monitor = ODLConsolidatedCopiesMonitor(self._db, collection, api=api)
+
+        edition1, pool1 = self._edition(
+            with_license_pool=True,
+            identifier_type=Identifier.URI,
+            collection=collection,
+            data_source_name=data_source.name,
+        )
+        edition2, pool2 = self._edition(
+            with_license_pool=True,
+            identifier_type=Identifier.URI,
+            collection=collection,
+            data_source_name=data_source.name,
+        )
+
+        page1 = {
+            "links": [{ "href": "/page2", "rel": "next" }],
+            "copies": [
+                { "identifier": pool1.identifier.identifier,
+                  "licenses": 3,
+                },
+            ],
+        }
+        page2 = {
+            "links": [],
+            "copies": [
+                { "identifier": pool2.identifier.identifier,
+                  "licenses": 5,
+                },
+            ],
+        }
+
+        # The first page is processed, but the request for the second
+        # page fails.
+        api.queue_response(200, content=json.dumps(page1))
+        assert_raises(Exception, monitor.run_once, None, None)
+        eq_(3, pool1.licenses_owned)
+        eq_(3, pool1.licenses_available)
+        eq_("http://copies/page2", monitor.checkpoint.value)
+
+        # The next run starts from the second page, even though it
+        # has a start time.
+        api.queue_response(200, content=json.dumps(page2))
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        monitor.run_once(yesterday, None)
+        eq_("http://copies/page2", api.requests[-1][0])
+        eq_(5, pool2.licenses_owned)
+        eq_(5, pool2.licenses_available)
+
+        # Now that the feed is done, there's no checkpoint.
+        eq_(None, monitor.checkpoint.value)
+
 class TestODLHoldReaper(DatabaseTest, BaseODLTest):
 
     def test_run_once(self):
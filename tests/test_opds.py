@@ -10,6 +10,7 @@ from nose.tools import (
     assert_raises,
 )
 import feedparser
+from sqlalchemy import event
 from . import DatabaseTest
 
 from core.lane import (
@@ -63,6 +64,7 @@ from api.config import (
     temp_config,
 )
 from api.opds import (
+    AcquisitionLinkCache,
     CirculationManagerAnnotator,
     LibraryAnnotator,
     SharedCollectionAnnotator,
@@ -541,6 +543,57 @@ class TestLibraryAnnotator(VendorIDTest):
         # But the borrow link is gone.
         assert u'http://opds-spec.org/acquisition/borrow' not in links
 
+    def test_annotate_work_entry_with_acquisition_link_cache(self):
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        identifier = pool.identifier
+        edition = pool.presentation_edition
+
+        class Mock(LibraryAnnotator):
+            calls = 0
+            def acquisition_links(self, *args, **kwargs):
+                Mock.calls += 1
+                return super(Mock, self).acquisition_links(*args, **kwargs)
+
+        cache = AcquisitionLinkCache()
+        def links(active_loans_by_work={}):
+            annotator = Mock(
+                None, self.lane, self._default_library, test_mode=True,
+                active_loans_by_work=active_loans_by_work,
+                acquisition_link_cache=cache
+            )
+            feed = AcquisitionFeed(self._db, "test", "url", [], annotator)
+            entry = feed._make_entry_xml(work, edition)
+            annotator.annotate_work_entry(
+                work, pool, edition, identifier, feed, entry
+            )
+            return [etree.tostring(x) for x in entry.findall(
+                "{%s}link" % AtomFeed.ATOM_NS
+            ) if 'acquisition' in x.get('rel')]
+
+        # The first time, the links are generated and cached.
+        first = links()
+        eq_(1, Mock.calls)
+        assert any('borrow' in x for x in first)
+
+        # The second time, the cached links are used.
+        eq_(first, links())
+        eq_(1, Mock.calls)
+
+        # When the LicensePool's availability changes, the cached
+        # links are out of date and they're generated again.
+        pool.licenses_available += 1
+        links()
+        eq_(2, Mock.calls)
+        links()
+        eq_(2, Mock.calls)
+
+        # Links for a patron who has a loan are never cached.
+        loan, ignore = pool.loan_to(self._patron())
+        links({work: loan})
+        links({work: loan})
+        eq_(4, Mock.calls)
+
     def test_annotate_feed(self):
         lane = self._lane()
         linksets = []
@@ -954,6 +1007,42 @@ class TestLibraryAnnotator(VendorIDTest):
         # ...but it's empty.
         assert '<entry>' not in unicode(feed_obj)
 
+    def test_preload_loans_and_holds_query_count(self):
+        def count_queries(size):
+            patron = self._patron()
+            for i in range(size):
+                work = self._work(with_open_access_download=True)
+                work.license_pools[0].loan_to(patron)
+                work = self._work(with_license_pool=True)
+                work.license_pools[0].on_hold_to(patron)
+            self._db.flush()
+            self._db.expire_all()
+
+            statements = []
+            def count(*args, **kwargs):
+                statements.append(args[2])
+            connection = self._db.connection()
+            event.listen(connection, "before_cursor_execute", count)
+            try:
+                # Build and serialize the whole feed, the same way the
+                # loans controller does.
+                feed_obj = LibraryLoanAndHoldAnnotator.active_loans_for(
+                    None, patron, test_mode=True
+                )
+                raw = unicode(feed_obj)
+            finally:
+                event.remove(connection, "before_cursor_execute", count)
+            eq_(size * 2, len(feedparser.parse(raw)['entries']))
+            return len(statements)
+
+        # The number of queries needed to render the feed doesn't
+        # depend on the number of loans and holds.
+        few = count_queries(2)
+        many = count_queries(20)
+        assert many - few <= 2, (
+            "%d queries for 2 loans and holds, %d for 20" % (few, many)
+        )
+
     def test_acquisition_feed_includes_license_information(self):
         work = self._work(with_open_access_download=True)
         pool = work.license_pools[0]
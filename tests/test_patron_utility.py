@@ -49,6 +49,24 @@ class TestPatronUtility(DatabaseTest):
         patron.last_external_sync = six_seconds_ago
         eq_(True, PatronUtility.needs_external_sync(patron))
 
+    def test_needs_bookshelf_sync(self):
+        now = datetime.datetime.utcnow()
+        one_minute_ago = now - datetime.timedelta(minutes=1)
+        m = PatronUtility.needs_bookshelf_sync
+
+        # A bookshelf that's never been synced needs to be synced.
+        eq_(True, m(None, 300))
+
+        # A bookshelf synced within the minimum interval does not.
+        eq_(False, m(one_minute_ago, 300))
+
+        # A bookshelf synced before the minimum interval does.
+        eq_(True, m(one_minute_ago, 30))
+
+        # If there's no minimum interval, a sync is always needed.
+        eq_(True, m(one_minute_ago, 0))
+        eq_(True, m(one_minute_ago, None))
+
     def test_has_borrowing_privileges(self):
         """Test the methods that encapsulate the determination
         of whether or not a patron can borrow books.
@@ -1,4 +1,5 @@
 from nose.tools import (
+    assert_raises,
     assert_raises_regexp,
     set_trace,
     eq_,
@@ -8,6 +9,10 @@ import contextlib
 import datetime
 import flask
 import json
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 
 from api.adobe_vendor_id import (
@@ -56,6 +61,7 @@ from core.model import (
     Hyperlink,
     Identifier,
     get_one,
+    Library,
     Representation,
     RightsStatus,
     Timestamp,
@@ -80,6 +86,7 @@ from scripts import (
     InstanceInitializationScript,
     LanguageListScript,
     NovelistSnapshotScript,
+    PremirroredUploader,
 )
 
 class TestAdobeAccountIDResetScript(DatabaseTest):
@@ -225,6 +232,123 @@ class TestCacheFacetListsPerLane(TestLaneScript):
             eq_(4, len(cached_feeds))
 
 
+    def test_dirty_only(self):
+        script = CacheFacetListsPerLane(
+            self._db, ["--pages=1", "--dirty-only"], testing=True
+        )
+        eq_(True, script.dirty_only)
+        work = self._work(fiction=True, with_license_pool=True)
+        lane = self._lane(fiction=True)
+        self.add_to_materialized_view([work])
+        with script.app.test_request_context("/"):
+            flask.request.library = self._default_library
+
+            # The lane's feeds have never been cached, so they're
+            # generated.
+            eq_(1, len(script.process_lane(lane)))
+
+            # Nothing has changed, so the lane is skipped.
+            eq_([], script.process_lane(lane))
+
+            # Once a work in the lane changes, the feeds are generated
+            # again.
+            work.last_update_time = (
+                datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+            )
+            self.add_to_materialized_view([work])
+            eq_(1, len(script.process_lane(lane)))
+
+        # The time taken for each lane that was processed was recorded.
+        eq_([lane.full_identifier, lane.full_identifier],
+            [identifier for (elapsed, identifier, feeds)
+             in script.lane_timings])
+
+    def test_workers(self):
+        script = CacheFacetListsPerLane(
+            self._db, ["--pages=1", "--workers=4"], testing=True
+        )
+        eq_(4, script.workers)
+        lane = self._lane()
+
+        # With more than one worker, lanes are set aside for the
+        # worker processes instead of being processed right away.
+        with script.app.test_request_context("/"):
+            eq_([], script.process_lane(lane))
+        eq_([lane.id], script.pending_lanes)
+
+        # This is what a worker process does with its share of the
+        # lanes.
+        script.workers = 1
+        timings = script.process_lanes_by_id(
+            self._default_library.id, [lane.id]
+        )
+        [(elapsed, identifier, feeds)] = timings
+        eq_(lane.full_identifier, identifier)
+        eq_(1, feeds)
+
+    def test_process_library_with_workers(self):
+        class MockPool(object):
+            def __init__(self, size):
+                self.size = size
+                self.closed = self.joined = False
+
+            def map(self, function, args):
+                self.args = args
+                return [
+                    [(1.0, "lane %s" % lane_id, 1) for lane_id in lane_ids]
+                    for script_class, cmd_args, library_id, lane_ids in args
+                ]
+
+            def close(self):
+                self.closed = True
+
+            def join(self):
+                self.joined = True
+
+        class Mock(CacheFacetListsPerLane):
+            def worker_pool(self, size):
+                self.pool = MockPool(size)
+                return self.pool
+
+        library = self._default_library
+        lane1 = self._lane()
+        lane2 = self._lane()
+        lane3 = self._lane()
+        script = Mock(
+            self._db, ["--pages=1", "--workers=2"], testing=True
+        )
+        script.process_library(library)
+
+        # The lanes were split between two workers.
+        pool = script.pool
+        eq_(2, pool.size)
+        eq_(True, pool.closed)
+        eq_(True, pool.joined)
+        shards = [lane_ids for (script_class, cmd_args, library_id, lane_ids)
+                  in pool.args]
+        eq_(2, len(shards))
+        lane_ids = sorted(
+            [lane_id for shard in shards for lane_id in shard
+             if lane_id is not None]
+        )
+        eq_(sorted([lane1.id, lane2.id, lane3.id]), lane_ids)
+        eq_(set([library.id]),
+            set(library_id for (script_class, cmd_args, library_id, lane_ids)
+                in pool.args))
+
+        # The workers' timings were collected.
+        eq_(sum(len(shard) for shard in shards), len(script.lane_timings))
+
+        # The library is still attached to the database session, so
+        # it can be used once the workers are done -- for instance,
+        # to process it again.
+        eq_(library, self._db.query(Library).filter(
+            Library.id==library.id).one())
+        assert library.short_name
+        script.process_library(library)
+        eq_(2, script.pool.size)
+
+
 class TestCacheOPDSGroupFeedPerLane(TestLaneScript):
 
     def test_do_run(self):
@@ -419,8 +543,9 @@ class TestDirectoryImportScript(DatabaseTest):
         arguments and calls run_with_arguments.
         """
         class Mock(DirectoryImportScript):
-            def run_with_arguments(self, *args):
+            def run_with_arguments(self, *args, **kwargs):
                 self.ran_with = args
+                self.ran_with_kwargs = kwargs
 
         script = Mock(self._db)
         script.do_run(
@@ -432,11 +557,17 @@ class TestDirectoryImportScript(DatabaseTest):
                 "--cover-directory=covers",
                 "--ebook-directory=ebooks",
                 "--rights-uri=rights",
-                "--dry-run"
+                "--dry-run",
+                "--batch-size=10",
+                "--workers=4",
+                "--checkpoint-file=checkpoint",
             ]
         )
         eq_(('coll1', 'ds1', 'metadata', 'marc', 'covers', 'ebooks', 'rights', True),
             script.ran_with)
+        eq_(dict(batch_size=10, workers=4, checkpoint_file='checkpoint',
+                 max_in_flight_bytes=DirectoryImportScript.DEFAULT_MAX_IN_FLIGHT_BYTES),
+            script.ran_with_kwargs)
 
     def test_run_with_arguments(self):
 
@@ -522,6 +653,209 @@ class TestDirectoryImportScript(DatabaseTest):
         for policy in policy1, policy2:
             eq_(mirror, policy.mirror)
 
+    def test_run_with_arguments_in_batches(self):
+        records = range(5)
+        collection = self._default_collection
+
+        class Mock(DirectoryImportScript):
+            def __init__(self, _db):
+                super(DirectoryImportScript, self).__init__(_db)
+                self.imported = []
+                self.commits = []
+                self.fail_on = None
+
+            def load_collection(self, *args):
+                return collection, None
+
+            def load_metadata(self, *args, **kwargs):
+                for record in records:
+                    yield record
+
+            def work_from_metadata(self, collection, metadata, *args):
+                if metadata == self.fail_on:
+                    raise Exception("Crash!")
+                self.imported.append(metadata)
+
+            def finish_batch(self, dry_run, checkpoint_file, position):
+                self.commits.append(position)
+                super(Mock, self).finish_batch(
+                    dry_run, checkpoint_file, position
+                )
+
+        directory = tempfile.mkdtemp()
+        checkpoint = os.path.join(directory, "checkpoint")
+        args = ["collection name", "data source name", "metadata file",
+                "marc", "cover directory", "ebook directory", "rights URI",
+                False]
+        try:
+            # The import crashes partway through the second batch.
+            script = Mock(self._db)
+            script.fail_on = 3
+            assert_raises(
+                Exception, script.run_with_arguments, *args,
+                batch_size=2, checkpoint_file=checkpoint
+            )
+            eq_([0, 1, 2], script.imported)
+            eq_([2], script.commits)
+            eq_(2, DirectoryImportScript.read_checkpoint(checkpoint))
+
+            # Running it again picks up after the last batch that was
+            # committed.
+            script = Mock(self._db)
+            script.run_with_arguments(
+                *args, batch_size=2, checkpoint_file=checkpoint
+            )
+            eq_([2, 3, 4], script.imported)
+            eq_([4, 5], script.commits)
+
+            # Once the import is done, the checkpoint is removed.
+            eq_(False, os.path.exists(checkpoint))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_import_batch_with_pool(self):
+        class Mock(MockDirectoryImportScript):
+            def _locate_file(self, *args):
+                self.searches.append(args[:2])
+                return super(Mock, self)._locate_file(*args)
+
+            def work_from_metadata(self, collection, metadata, *args):
+                self.imported.append((
+                    metadata.primary_identifier.identifier,
+                    self.locate_file(
+                        metadata.primary_identifier.identifier,
+                        'ebooks', [], "ebook file"
+                    ),
+                    self.locate_file(
+                        metadata.primary_identifier.identifier,
+                        'covers', [], "cover image"
+                    ),
+                ))
+
+        filesystem = {
+            'ebooks': ('book.epub', Representation.EPUB_MEDIA_TYPE, 'epub'),
+            'covers': ('cover.jpg', Representation.JPEG_MEDIA_TYPE, 'jpg'),
+        }
+        script = Mock(self._db, mock_filesystem=filesystem)
+        script.imported = []
+        script.searches = []
+        script.read_ahead = 2
+        batch = [
+            Metadata(
+                DataSource.GUTENBERG,
+                primary_identifier=IdentifierData(Identifier.ISBN, isbn)
+            )
+            for isbn in ("1234", "5678", "9012")
+        ]
+        policy = ReplacementPolicy(mirror=None)
+        pool = ThreadPool(2)
+        try:
+            script.import_batch(
+                self._default_collection, batch, policy, 'covers',
+                'ebooks', None, pool
+            )
+        finally:
+            pool.close()
+
+        # Titles are imported in order, each with its own files.
+        ebook = filesystem['ebooks']
+        cover = filesystem['covers']
+        eq_([("1234", ebook, cover), ("5678", ebook, cover),
+             ("9012", ebook, cover)], script.imported)
+        eq_(3, script.titles_imported)
+        eq_(3 * len('epubjpg'), script.bytes_read)
+
+        # The files were read by the pool, and work_from_metadata
+        # didn't need to look for them again.
+        eq_(6, len(script.searches))
+        eq_(set([("1234", "ebooks"), ("1234", "covers"),
+                 ("5678", "ebooks"), ("5678", "covers"),
+                 ("9012", "ebooks"), ("9012", "covers")]),
+            set(script.searches))
+
+        # Nothing is left waiting to be imported.
+        eq_(0, script.in_flight_bytes)
+        eq_({}, script.located_files)
+
+    def test_premirrored_uploader(self):
+        class MockMirror(object):
+            def __init__(self):
+                self.mirrored = []
+                self.fail = False
+
+            def mirror_one(self, representation, mirror_to):
+                self.mirrored.append((representation.content, mirror_to))
+                if self.fail:
+                    representation.mirror_exception = "Failed"
+                else:
+                    representation.set_as_mirrored(mirror_to)
+
+            def book_url(self, *args, **kwargs):
+                return "http://books/"
+
+        mirror = MockMirror()
+        uploader = PremirroredUploader(mirror)
+
+        # Methods the uploader doesn't override go to the real mirror.
+        eq_("http://books/", uploader.book_url())
+
+        # A successful upload is remembered.
+        eq_(True, uploader.upload(
+            "http://books/1.epub", Representation.EPUB_MEDIA_TYPE, "epub"
+        ))
+        eq_([("epub", "http://books/1.epub")], mirror.mirrored)
+
+        # A failed upload isn't.
+        mirror.fail = True
+        eq_(False, uploader.upload(
+            "http://books/2.epub", Representation.EPUB_MEDIA_TYPE, "epub"
+        ))
+        mirror.fail = False
+        mirror.mirrored = []
+
+        # A file that was already uploaded is just marked as mirrored.
+        representation, ignore = self._representation(
+            media_type=Representation.EPUB_MEDIA_TYPE, content="epub"
+        )
+        uploader.mirror_one(representation, "http://books/1.epub")
+        eq_([], mirror.mirrored)
+        eq_("http://books/1.epub", representation.mirror_url)
+        assert representation.mirrored_at != None
+
+        # Any other file is sent to the real mirror.
+        representation, ignore = self._representation(
+            media_type=Representation.EPUB_MEDIA_TYPE, content="epub"
+        )
+        uploader.mirror_one(representation, "http://books/2.epub")
+        eq_([("epub", "http://books/2.epub")], mirror.mirrored)
+
+    def test_dry_run_reports_throughput(self):
+        class Mock(MockDirectoryImportScript):
+            def load_collection(self, *args):
+                return self._default_collection, None
+
+            def load_metadata(self, *args, **kwargs):
+                return [object(), object()]
+
+            def work_from_metadata(self, collection, metadata, *args):
+                self.locate_file("1234", 'ebooks', [], "ebook file")
+
+        script = Mock(self._db, mock_filesystem={
+            'ebooks': ('book.epub', Representation.EPUB_MEDIA_TYPE, 'epub'),
+        })
+        script._default_collection = self._default_collection
+        output = StringIO()
+        script.run_with_arguments(
+            "collection name", "data source name", "metadata file", "marc",
+            None, "ebooks", None, True, output=output
+        )
+        eq_(2, script.titles_imported)
+        eq_(8, script.bytes_read)
+        report = output.getvalue()
+        assert report.startswith("Processed 2 titles and 0.0 MB of files in ")
+        assert "titles/s" in report
+        assert "MB/s" in report
+
     def test_load_collection_no_site_wide_mirror(self):
         # Calling load_collection creates a new collection with
         # the given data source.
@@ -0,0 +1,108 @@
+# encoding: utf-8
+from nose.tools import (
+    set_trace, eq_,
+)
+import flask
+from flask import Flask
+
+from api.util.url import URLTemplateBuilder
+
+class TestURLTemplateBuilder(object):
+
+    def setup(self):
+        # An app with a few routes set up the way library_route sets
+        # them up.
+        self.app = app = Flask(__name__)
+        def view(**kwargs):
+            return ""
+        for endpoint, path in [
+            ('borrow', '/works/<identifier_type>/<path:identifier>/borrow'),
+            ('borrow', '/works/<identifier_type>/<path:identifier>/borrow/<mechanism_id>'),
+            ('fulfill', '/works/<license_pool_id>/fulfill'),
+        ]:
+            app.add_url_rule("/<library_short_name>" + path, endpoint, view)
+            app.add_url_rule(path, endpoint, view)
+
+        self.calls = []
+        def url_for(*args, **kwargs):
+            self.calls.append(args)
+            return flask.url_for(*args, **kwargs)
+        self.builder = URLTemplateBuilder(url_for)
+
+    def test_url_for_matches_flask(self):
+        values = [
+            dict(identifier_type="ISBN", identifier="9781234567890"),
+            dict(identifier_type="URI", identifier="http://example.com/1"),
+            dict(identifier_type="Some Type", identifier=u"é ?&/1"),
+            dict(identifier_type="ISBN", identifier="9781234567890",
+                 mechanism_id=3),
+            dict(identifier_type="ISBN", identifier="9781234567890",
+                 mechanism_id=None),
+        ]
+        with self.app.test_request_context("/"):
+            for kwargs in values:
+                for external in (True, False):
+                    expect = flask.url_for(
+                        "borrow", library_short_name="L",
+                        _external=external, **kwargs
+                    )
+                    eq_(expect, self.builder.url_for(
+                        "borrow", library_short_name="L",
+                        _external=external, **kwargs
+                    ))
+
+            # Arguments that aren't part of the route go into the
+            # query string.
+            expect = flask.url_for(
+                "fulfill", library_short_name="L", license_pool_id=5,
+                extra="a/b c"
+            )
+            eq_(expect, self.builder.url_for(
+                "fulfill", library_short_name="L", license_pool_id=5,
+                extra="a/b c"
+            ))
+
+    def test_template_is_reused(self):
+        with self.app.test_request_context("/"):
+            for i in range(10):
+                self.builder.url_for(
+                    "fulfill", library_short_name="L", license_pool_id=i,
+                    _external=True
+                )
+            # The URL function was called once to build the template
+            # and once to test it; the rest of the URLs came from the
+            # template.
+            eq_(2, len(self.calls))
+            eq_(
+                "http://localhost/L/works/9/fulfill",
+                self.builder.url_for(
+                    "fulfill", library_short_name="L", license_pool_id=9,
+                    _external=True
+                )
+            )
+
+            # A different library gets a different template.
+            eq_(
+                "http://localhost/M/works/9/fulfill",
+                self.builder.url_for(
+                    "fulfill", library_short_name="M", license_pool_id=9,
+                    _external=True
+                )
+            )
+            eq_(4, len(self.calls))
+
+    def test_unknown_route_falls_back_to_url_function(self):
+        with self.app.test_request_context("/"):
+            try:
+                self.builder.url_for("no_such_route", foo="bar")
+                raise Exception("Expected an error.")
+            except Exception, e:
+                assert "no_such_route" in str(e)
+            # No template was built, so the next call goes straight
+            # to the URL function.
+            del self.calls[:]
+            try:
+                self.builder.url_for("no_such_route", foo="bar")
+            except Exception, e:
+                pass
+            eq_(1, len(self.calls))